@@ -30,6 +30,7 @@ from pajbot.models.pleblist import PleblistSong
 from pajbot.models.sock import SocketClientManager
 from pajbot.models.module import ModuleManager
 from pajbot.managers import RedisManager
+from pajbot.managers.leaderboard import LeaderboardManager
 from pajbot.apiwrappers import TwitchAPI
 from pajbot.tbutil import time_since
 from pajbot.tbutil import find
@@ -455,8 +456,10 @@ def user_profile(username):
     if user is None:
         return render_template('no_user.html'), 404
 
-    rank = session.query(func.Count(User.id)).filter(User.points > user.points).one()
-    rank = rank[0] + 1
+    rank = LeaderboardManager.get_rank('points', user.username, user.points)
+    if rank is None:
+        rank = session.query(func.Count(User.id)).filter(User.points > user.points).one()
+        rank = rank[0] + 1
     user.rank = rank
 
     user_duel_stats = session.query(UserDuelStats).filter_by(user_id=user.id).one_or_none()
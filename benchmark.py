@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Replays a chat log through Bot.on_pubmsg with local stand-ins for IRC, Redis,
+MySQL and the Twitch API, and reports throughput, latency percentiles and
+a per-handler/per-command breakdown.
+
+Examples:
+./benchmark.py --generate 20000 --banphrases 1500 --custom-emotes 300
+./benchmark.py --log recorded_chat.log --modules banphrase,linkchecker,linefarming
+"""
+
+import os
+import sys
+import logging
+import argparse
+
+os.chdir(os.path.dirname(os.path.realpath(__file__)))
+
+log = logging.getLogger('pajbot')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Replay a chat log through the bot and measure it')
+    parser.add_argument('--log', '-l',
+                        help='Raw IRC chat log to replay (one line per message, including tags)')
+    parser.add_argument('--generate', '-g', type=int, default=10000,
+                        help='Number of synthetic chat lines to generate if no --log is given (default: 10000)')
+    parser.add_argument('--streamer', default='pajlada',
+                        help='Channel the log was recorded in (default: pajlada)')
+    parser.add_argument('--modules', default=None,
+                        help='Comma-separated list of module IDs to enable (default: modules enabled by default)')
+    parser.add_argument('--banphrases', type=int, default=0,
+                        help='Number of synthetic banphrases to create')
+    parser.add_argument('--custom-emotes', type=int, default=0,
+                        help='Number of synthetic BTTV/custom emotes to create')
+    parser.add_argument('--commands', type=int, default=0,
+                        help='Number of synthetic commands to create')
+    parser.add_argument('--warmup', type=int, default=500,
+                        help='Number of messages replayed before measuring (default: 500)')
+    parser.add_argument('--top', type=int, default=25,
+                        help='Number of rows in the per-section breakdown (default: 25)')
+    parser.add_argument('--verbose', '-v', action='store_true',
+                        help='Show log output from the bot while replaying')
+
+    return parser.parse_args()
+
+
+def run(args):
+    from pajbot.benchmark import BenchmarkBot
+    from pajbot.benchmark import create_benchmark_config
+    from pajbot.benchmark import generate_chat_log
+    from pajbot.benchmark import load_chat_log
+    from pajbot.benchmark import parse_chat_line
+    from pajbot.benchmark import seed_benchmark_data
+    from pajbot.benchmark.replay import DEFAULT_TWITCH_EMOTES
+    from pajbot.benchmark.replay import get_custom_emote_codes
+    from pajbot.modules import available_modules
+
+    if args.modules is None:
+        modules = [module.ID for module in available_modules if module.ENABLED_DEFAULT]
+    else:
+        modules = [module_id.strip() for module_id in args.modules.split(',') if len(module_id.strip()) > 0]
+
+    seed = seed_benchmark_data(num_banphrases=args.banphrases,
+            num_custom_emotes=args.custom_emotes,
+            num_commands=args.commands,
+            twitch_emotes=DEFAULT_TWITCH_EMOTES)
+
+    bot = BenchmarkBot(create_benchmark_config(streamer=args.streamer), modules=modules, seed_data=seed)
+
+    if args.log:
+        events = load_chat_log(args.log)
+    else:
+        lines = generate_chat_log(args.generate + args.warmup, args.streamer,
+                twitch_emotes=DEFAULT_TWITCH_EMOTES,
+                custom_emotes=get_custom_emote_codes(args.custom_emotes))
+        events = [parse_chat_line(line) for line in lines]
+
+    if len(events) <= args.warmup:
+        log.error('Not enough messages to replay ({} messages, {} warmup)'.format(len(events), args.warmup))
+        sys.exit(1)
+
+    print('Enabled modules: {}'.format(', '.join(module.ID for module in bot.module_manager.modules)))
+    print('Banphrases: {}, custom emotes: {}, commands: {}'.format(
+        len(bot.banphrase_manager.enabled_banphrases), len(bot.emotes.custom_data), len(bot.commands)))
+
+    result = bot.replay(events, warmup=args.warmup)
+
+    print(result.format_report(top=args.top))
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    if args.verbose:
+        from pajbot.tbutil import init_logging
+        init_logging('pajbot')
+    else:
+        logging.basicConfig(level=logging.CRITICAL)
+
+    run(args)
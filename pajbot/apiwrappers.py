@@ -4,8 +4,11 @@ import json
 import logging
 import requests
 import datetime
+import time
+import concurrent.futures
 
 from pajbot.managers import RedisManager
+from pajbot.tbutil import RateLimiter
 
 log = logging.getLogger('pajbot')
 
@@ -263,6 +266,97 @@ class TwitchAPI(APIBase):
 
         return [], attempt + 1, False
 
+    def get_subscribers_page(self, streamer, limit=100, offset=0):
+        """Returns a tuple with a list of subscribers within the limit+offset
+        range, and the total number of subscribers.
+        Raises an exception if the subscribers could not be fetched.
+
+        Arguments:
+        streamer -- the streamer whose subscriber we want to fetch.
+
+        Keyword arguments:
+        limit -- Maximum number of subscribers fetched. (default: 100)
+        offset - Offset for pagination. (default: 0)
+        """
+
+        data = self.get(['channels', streamer, 'subscriptions'], {'limit': limit, 'offset': offset}, base=self.kraken_url)
+        if not data:
+            raise ValueError('No data returned while fetching subscribers')
+
+        return [u['user']['name'] for u in data['subscriptions']], data['_total']
+
+    def get_all_subscribers(self, streamer, callback, concurrency=4, requests_per_second=5, limit=100, attempts=3, retry_delay=3, chunk_size=1000):
+        """Fetches all subscribers of the streamer, `concurrency` pages at a time.
+
+        The first page tells us how many subscribers there are, the rest of
+        the pages are then fetched concurrently. Each page is tried up to
+        `attempts` times, `retry_delay` seconds apart.
+
+        The subscribers are passed on to the callback in chunks of at least
+        `chunk_size` subscribers as they come in, not in any particular
+        order: callback(subscribers, first, last). `first` is True for the
+        first chunk, and `last` is True for the last chunk.
+
+        Returns True if all pages were fetched. If one of the pages couldn't
+        be fetched, the callback is never called with `last` set to True
+        and False is returned.
+
+        Arguments:
+        streamer -- the streamer whose subscriber we want to fetch.
+        callback -- called with every chunk of subscribers.
+
+        Keyword arguments:
+        concurrency -- Maximum number of pages that are fetched at the same time. (default: 4)
+        requests_per_second -- Maximum number of requests per second. (default: 5)
+        limit -- Number of subscribers per page. (default: 100)
+        """
+
+        rate_limiter = RateLimiter(requests_per_second)
+
+        def fetch_page(offset):
+            for attempt in range(1, attempts + 1):
+                rate_limiter.wait()
+                try:
+                    return self.get_subscribers_page(streamer, limit, offset)
+                except urllib.error.HTTPError as e:
+                    log.warning('Non-standard HTTP Code returned while fetching subscribers at offset {0} (attempt {1}/{2}): {3}'.format(offset, attempt, attempts, e.code))
+                    if attempt == attempts:
+                        raise
+                except:
+                    log.exception('Unhandled exception caught while fetching subscribers at offset {0} (attempt {1}/{2})'.format(offset, attempt, attempts))
+                    if attempt == attempts:
+                        raise
+
+                time.sleep(retry_delay)
+
+        try:
+            subscribers, total = fetch_page(0)
+        except:
+            log.error('Unable to fetch the first page of subscribers, aborting')
+            return False
+
+        offsets = range(limit, total, limit)
+        log.debug('{0} subscribers, fetching {1} more pages'.format(total, len(offsets)))
+
+        first = True
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [executor.submit(fetch_page, offset) for offset in offsets]
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    subscribers.extend(future.result()[0])
+                    if len(subscribers) >= chunk_size:
+                        callback(subscribers, first, False)
+                        first = False
+                        subscribers = []
+            except:
+                log.error('Unable to fetch a page of subscribers, aborting')
+                for future in futures:
+                    future.cancel()
+                return False
+
+        callback(subscribers, first, True)
+        return True
+
     def get_chatters(self, streamer):
         """Returns a list of chatters in the stream."""
         chatters = []
@@ -0,0 +1,8 @@
+from pajbot.benchmark.fakes import FakeRedis
+from pajbot.benchmark.fakes import FakeTwitchAPI
+from pajbot.benchmark.replay import BenchmarkBot
+from pajbot.benchmark.replay import create_benchmark_config
+from pajbot.benchmark.replay import generate_chat_log
+from pajbot.benchmark.replay import load_chat_log
+from pajbot.benchmark.replay import parse_chat_line
+from pajbot.benchmark.replay import seed_benchmark_data
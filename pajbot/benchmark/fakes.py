@@ -0,0 +1,457 @@
+import fnmatch
+import logging
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import scoped_session
+from sqlalchemy.pool import StaticPool
+
+from pajbot.models.db import DBManager, Base
+
+log = logging.getLogger('pajbot')
+
+
+def init_sqlite_db(url='sqlite://'):
+    """ Point the DBManager at an in-memory SQLite database and create all tables.
+
+    A StaticPool is used so every session (on every thread) shares the same
+    in-memory database. The MySQL-specific utf8mb4_bin collation used by some
+    of our models is registered as a plain binary comparison.
+    """
+
+    engine = create_engine(url,
+            connect_args={'check_same_thread': False},
+            poolclass=StaticPool)
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        dbapi_connection.create_collation('utf8mb4_bin', lambda a, b: (a > b) - (a < b))
+
+    DBManager.engine = engine
+    DBManager.Session = sessionmaker(bind=engine, autoflush=False)
+    DBManager.ScopedSession = scoped_session(sessionmaker(bind=engine))
+
+    Base.metadata.create_all(engine)
+
+    return engine
+
+
+class FakeRedis:
+    """ In-memory stand-in for the parts of redis.Redis that pajbot uses.
+    Values are stored and returned as strings, like a client created with
+    decode_responses=True.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+        self.num_calls = 0
+
+    def _now(self):
+        return time.time()
+
+    def _alive(self, key):
+        expire_at = self.expires.get(key, None)
+        if expire_at is not None and expire_at <= self._now():
+            self.data.pop(key, None)
+            del self.expires[key]
+        return key in self.data
+
+    def _hash(self, key, create=False):
+        if self._alive(key):
+            return self.data[key]
+        if create:
+            self.data[key] = {}
+            return self.data[key]
+        return {}
+
+    def get(self, key):
+        self.num_calls += 1
+        if self._alive(key):
+            return self.data[key]
+        return None
+
+    def mget(self, keys, *args):
+        self.num_calls += 1
+        if isinstance(keys, str):
+            keys = [keys] + list(args)
+        return [self.data[key] if self._alive(key) else None for key in keys]
+
+    def set(self, key, value):
+        self.num_calls += 1
+        self.data[key] = str(value)
+        self.expires.pop(key, None)
+        return True
+
+    def setex(self, name, time, value):
+        self.num_calls += 1
+        self.data[name] = str(value)
+        self.expires[name] = self._now() + time
+        return True
+
+    def expire(self, key, time):
+        self.num_calls += 1
+        if not self._alive(key):
+            return False
+        self.expires[key] = self._now() + time
+        return True
+
+    def delete(self, *keys):
+        self.num_calls += 1
+        num_deleted = 0
+        for key in keys:
+            if self._alive(key):
+                del self.data[key]
+                self.expires.pop(key, None)
+                num_deleted += 1
+        return num_deleted
+
+    def keys(self, pattern='*'):
+        self.num_calls += 1
+        return [key for key in list(self.data) if self._alive(key) and fnmatch.fnmatchcase(key, pattern)]
+
+    def scan_iter(self, match='*', count=None):
+        # Like SCAN, every batch of keys is a round trip
+        count = count or 10
+        keys = self.keys(match)
+        for i in range(0, len(keys), count):
+            if i > 0:
+                self.num_calls += 1
+            for key in keys[i:i + count]:
+                yield key
+
+    def hget(self, key, field):
+        self.num_calls += 1
+        return self._hash(key).get(str(field), None)
+
+    def hmget(self, key, fields, *args):
+        self.num_calls += 1
+        if isinstance(fields, str):
+            fields = [fields] + list(args)
+        h = self._hash(key)
+        return [h.get(str(field), None) for field in fields]
+
+    def hkeys(self, key):
+        self.num_calls += 1
+        return list(self._hash(key))
+
+    def hgetall(self, key):
+        self.num_calls += 1
+        return dict(self._hash(key))
+
+    def hset(self, key, field, value):
+        self.num_calls += 1
+        h = self._hash(key, create=True)
+        new_field = str(field) not in h
+        h[str(field)] = str(value)
+        return 1 if new_field else 0
+
+    def hsetnx(self, key, field, value):
+        self.num_calls += 1
+        h = self._hash(key, create=True)
+        if str(field) in h:
+            return 0
+        h[str(field)] = str(value)
+        return 1
+
+    def hmset(self, key, mapping):
+        self.num_calls += 1
+        h = self._hash(key, create=True)
+        for field, value in mapping.items():
+            h[str(field)] = str(value)
+        return True
+
+    def hdel(self, key, *fields):
+        self.num_calls += 1
+        h = self._hash(key)
+        num_deleted = 0
+        for field in fields:
+            if h.pop(str(field), None) is not None:
+                num_deleted += 1
+        if self._alive(key) and len(h) == 0:
+            del self.data[key]
+        return num_deleted
+
+    def hincrby(self, key, field, amount=1):
+        self.num_calls += 1
+        h = self._hash(key, create=True)
+        h[str(field)] = str(int(h.get(str(field), 0)) + amount)
+        return int(h[str(field)])
+
+    def exists(self, *keys):
+        self.num_calls += 1
+        return sum(1 for key in keys if self._alive(key))
+
+    def rename(self, src, dst):
+        self.num_calls += 1
+        if not self._alive(src):
+            raise KeyError(src)
+        self.data[dst] = self.data.pop(src)
+        self.expires.pop(dst, None)
+        return True
+
+    def zadd(self, key, mapping):
+        self.num_calls += 1
+        z = self._hash(key, create=True)
+        num_added = sum(1 for member in mapping if str(member) not in z)
+        for member, score in mapping.items():
+            z[str(member)] = float(score)
+        return num_added
+
+    def zscore(self, key, member):
+        self.num_calls += 1
+        return self._hash(key).get(str(member), None)
+
+    def zcard(self, key):
+        self.num_calls += 1
+        return len(self._hash(key))
+
+    def zcount(self, key, min, max):
+        self.num_calls += 1
+
+        def parse_bound(bound):
+            bound = str(bound)
+            exclusive = bound.startswith('(')
+            return float(bound.lstrip('(')), exclusive
+
+        min, min_exclusive = parse_bound(min)
+        max, max_exclusive = parse_bound(max)
+        return sum(1 for score in self._hash(key).values()
+                if (score > min if min_exclusive else score >= min) and (score < max if max_exclusive else score <= max))
+
+    def zrevrange(self, key, start, end, withscores=False, score_cast_func=float):
+        self.num_calls += 1
+        members = sorted(self._hash(key).items(), key=lambda item: (item[1], item[0]), reverse=True)
+        members = members[start:] if end == -1 else members[start:end + 1]
+        if withscores:
+            return [(member, score_cast_func(score)) for member, score in members]
+        return [member for member, score in members]
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def register_script(self, script):
+        return FakeScript(self, script)
+
+    def _tokens_balance(self, keys, args):
+        num_tokens = 0
+        for value in self._hash(keys[0]).values():
+            try:
+                num_tokens += int(value)
+            except ValueError:
+                pass
+        return num_tokens
+
+    def _tokens_spend(self, keys, args):
+        cost = int(args[0])
+        if self._tokens_balance(keys, args) < cost:
+            return None
+
+        spent = []
+        tokens = self._hash(keys[0])
+        for stream_id, value in list(tokens.items()):
+            if cost <= 0:
+                break
+            try:
+                value = int(value)
+            except ValueError:
+                continue
+            if value > 0:
+                decrease_by = min(cost, value)
+                tokens[stream_id] = str(value - decrease_by)
+                cost -= decrease_by
+                spent += [stream_id, decrease_by]
+        return spent
+
+    def _tokens_award(self, keys, args):
+        tokens = self._hash(keys[0], create=True)
+        if str(args[0]) in tokens:
+            return None
+        tokens[str(args[0])] = str(args[1])
+        return self._tokens_balance(keys, args)
+
+    def _warn_user(self, keys, args):
+        chances_used = len([key for key in keys if self._alive(key)])
+        free_keys = [key for key in keys if not self._alive(key)]
+        if len(free_keys) > 0:
+            self.data[free_keys[0]] = '1'
+            self.expires[free_keys[0]] = self._now() + int(args[0])
+        return chances_used
+
+    def _replace_leaderboards(self, keys, args):
+        for i in range(0, len(keys), 3):
+            new_key, updates_key, key = keys[i:i + 3]
+            if self._alive(updates_key):
+                self._hash(new_key, create=True).update(self.data.pop(updates_key))
+                self.expires.pop(updates_key, None)
+            if self._alive(new_key):
+                self.data[key] = self.data.pop(new_key)
+                self.expires.pop(new_key, None)
+            else:
+                self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return 0
+
+    def evalscript(self, script, keys, args):
+        """ Runs one of the Lua scripts pajbot registers, emulated in Python """
+        from pajbot.models.user import TOKENS_BALANCE_SCRIPT
+        from pajbot.models.user import TOKENS_SPEND_SCRIPT
+        from pajbot.models.user import TOKENS_AWARD_SCRIPT
+        from pajbot.models.user import WARN_USER_SCRIPT
+        from pajbot.managers.leaderboard import REPLACE_LEADERBOARDS_SCRIPT
+
+        scripts = {
+                TOKENS_BALANCE_SCRIPT: self._tokens_balance,
+                TOKENS_SPEND_SCRIPT: self._tokens_spend,
+                TOKENS_AWARD_SCRIPT: self._tokens_award,
+                WARN_USER_SCRIPT: self._warn_user,
+                REPLACE_LEADERBOARDS_SCRIPT: self._replace_leaderboards,
+                }
+
+        self.num_calls += 1
+        return scripts[script](list(keys), list(args))
+
+
+class FakeScript:
+    """ Stand-in for redis.client.Script, see FakeRedis.evalscript """
+
+    def __init__(self, registered_client, script):
+        self.registered_client = registered_client
+        self.script = script
+
+    def __call__(self, keys=[], args=[], client=None):
+        if client is None:
+            client = self.registered_client
+        return client.evalscript(self.script, keys, args)
+
+
+class FakePipeline:
+    """ Queues up calls and runs them against the FakeRedis on execute() """
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        method = getattr(self.redis, name)
+
+        def queue_command(*args, **kwargs):
+            self.commands.append((method, args, kwargs))
+            return self
+
+        return queue_command
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.commands = []
+
+    def execute(self):
+        num_calls = self.redis.num_calls
+        results = [method(*args, **kwargs) for method, args, kwargs in self.commands]
+        # A pipeline is a single round trip
+        self.redis.num_calls = num_calls + 1
+        self.commands = []
+        return results
+
+
+class FakeTwitchAPI:
+    """ Stand-in for TwitchAPI that never touches the network. """
+
+    def __init__(self, chatters=[], subscribers=[]):
+        self.chatters = list(chatters)
+        self.subscribers = list(subscribers)
+
+    def get_subscribers(self, streamer, limit=25, offset=0, attempt=0):
+        return self.subscribers[offset:offset + limit], False, False
+
+    def get_chatters(self, streamer):
+        return list(self.chatters)
+
+    def get_status(self, streamer):
+        return {
+                'error': False,
+                'exists': True,
+                'online': False,
+                'viewers': -1,
+                'game': None,
+                'title': None,
+                'created_at': None,
+                'followers': -1,
+                'views': -1,
+                'broadcast_id': None,
+                }
+
+    def get_follow_relationship(self, username, streamer):
+        return False
+
+    def get(self, endpoints, parameters={}, base=None):
+        return None
+
+    def set_game(self, streamer, game):
+        pass
+
+    def set_title(self, streamer, title):
+        pass
+
+
+class FakeConnectionManager:
+    """ Stand-in for ConnectionManager which records outgoing messages
+    instead of sending them to TMI. """
+
+    def __init__(self, streamer):
+        self.streamer = streamer
+        self.channel = '#' + streamer
+        self.sent = []
+
+    def start(self):
+        return True
+
+    def get_main_conn(self):
+        return None
+
+    def on_disconnect(self, chatconn):
+        pass
+
+    def privmsg(self, channel, message, increase_message=True):
+        self.sent.append((channel, message))
+
+
+class FakeWhisperManager:
+    """ Stand-in for WhisperConnectionManager which records whispers. """
+
+    def __init__(self):
+        self.whispers = []
+
+    def __contains__(self, connection):
+        return False
+
+    def whisper(self, target, message):
+        self.whispers.append((target, message))
+
+    def quit(self):
+        pass
+
+
+class DiscardingActionQueue:
+    """ Stand-in for an ActionQueue running on its own thread.
+    Actions are counted, but never run, since they are exactly the things
+    (HTTP requests etc) we don't want to measure in a replay. """
+
+    def __init__(self):
+        self.num_actions = 0
+
+    def start(self):
+        pass
+
+    def add(self, f, args=[], kwargs={}):
+        self.num_actions += 1
+
+    def _add(self, action):
+        self.num_actions += 1
+
+    def parse_action(self):
+        pass
@@ -0,0 +1,426 @@
+import collections
+import configparser
+import logging
+import math
+import random
+import time
+
+import irc.client
+import irc.message
+
+from pajbot.bot import Bot
+from pajbot.models.banphrase import Banphrase, BanphraseData
+from pajbot.models.command import Command, CommandData
+from pajbot.models.db import DBManager
+from pajbot.models.emote import Emote
+from pajbot.models.handler import HandlerManager
+from pajbot.models.handler import get_handler_name
+from pajbot.models.module import Module
+from pajbot.managers import RedisManager
+from pajbot.benchmark.fakes import init_sqlite_db
+from pajbot.benchmark.fakes import DiscardingActionQueue
+from pajbot.benchmark.fakes import FakeConnectionManager
+from pajbot.benchmark.fakes import FakeRedis
+from pajbot.benchmark.fakes import FakeTwitchAPI
+from pajbot.benchmark.fakes import FakeWhisperManager
+
+log = logging.getLogger('pajbot')
+
+
+def parse_chat_line(line):
+    """ Parse a raw IRC line (with IRCv3 tags) into an irc.client.Event.
+    Returns None for lines that are not PRIVMSG/ACTION lines.
+
+    Example line:
+    @color=#FF0000;display-name=PajladA;emotes=25:0-4;subscriber=0;user-type= :pajlada!pajlada@pajlada.tmi.twitch.tv PRIVMSG #pajlada :Kappa hello
+    """
+
+    line = line.rstrip('\r\n')
+    if len(line) == 0 or line[0] == '#':
+        return None
+
+    m = irc.client._rfc_1459_command_regexp.match(line)
+    if m is None or m.group('command') is None or m.group('command').upper() != 'PRIVMSG':
+        return None
+
+    source = irc.client.NickMask.from_group(m.group('prefix'))
+    tags = irc.message.Tag.from_group(m.group('tags')) or []
+    arguments = irc.message.Arguments.from_group(m.group('argument'))
+    if len(arguments) < 2:
+        return None
+
+    target, message = arguments[0], arguments[1]
+    event_type = 'pubmsg'
+    if message.startswith('\x01ACTION ') and message.endswith('\x01'):
+        event_type = 'action'
+        message = message[8:-1]
+
+    return irc.client.Event(event_type, source, target, [message], tags)
+
+
+def load_chat_log(path):
+    """ Load all PRIVMSG events from a recorded chat log """
+    events = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            event = parse_chat_line(line)
+            if event is not None:
+                events.append(event)
+    return events
+
+
+def generate_chat_log(num_lines, streamer, twitch_emotes={}, custom_emotes=[], num_users=5000, seed=1):
+    """ Generates raw IRC lines that roughly look like a busy twitch chat.
+
+    twitch_emotes is a dict of emote code => twitch emote id
+    custom_emotes is a list of BTTV/custom emote codes
+    """
+
+    rng = random.Random(seed)
+    words = ['hello', 'chat', 'lol', 'what', 'is', 'this', 'game', 'OMEGALUL',
+             'pog', 'gg', 'ez', 'nice', 'play', 'streamer', 'why', 'no', 'yes',
+             'KKona', 'haHAA', 'deck', 'rigged', 'xD', 'LUL', 'sub', 'hype']
+    twitch_codes = list(twitch_emotes.keys())
+    links = ['pajlada.se', 'https://www.youtube.com/watch?v=dQw4w9WgXcQ', 'imgur.com/a/abc123', 'twitch.tv/pajlada']
+    commands = ['!points', '!nl', '!ping', '!quest', '!tokens', '!roulette 100', '!help']
+
+    lines = []
+    for i in range(0, num_lines):
+        username = 'user{}'.format(rng.randint(0, num_users - 1))
+        parts = []
+        kind = rng.random()
+        if kind < 0.05:
+            parts.append(rng.choice(commands))
+        else:
+            for j in range(0, rng.randint(1, 12)):
+                r = rng.random()
+                if r < 0.15 and len(twitch_codes) > 0:
+                    parts.append(rng.choice(twitch_codes))
+                elif r < 0.25 and len(custom_emotes) > 0:
+                    parts.append(rng.choice(custom_emotes))
+                elif r < 0.26:
+                    parts.append(rng.choice(links))
+                else:
+                    parts.append(rng.choice(words))
+        message = ' '.join(parts)
+
+        emote_indices = collections.OrderedDict()
+        index = 0
+        for part in parts:
+            if part in twitch_emotes:
+                emote_indices.setdefault(twitch_emotes[part], []).append('{}-{}'.format(index, index + len(part) - 1))
+            index += len(part) + 1
+        emotes_tag = '/'.join('{}:{}'.format(emote_id, ','.join(indices)) for emote_id, indices in emote_indices.items())
+
+        tags = 'color=;display-name={username};emotes={emotes};subscriber={sub};turbo=0;user-type='.format(
+                username=username,
+                emotes=emotes_tag,
+                sub=1 if rng.random() < 0.2 else 0)
+        lines.append('@{tags} :{username}!{username}@{username}.tmi.twitch.tv PRIVMSG #{streamer} :{message}'.format(
+            tags=tags,
+            username=username,
+            streamer=streamer,
+            message=message))
+
+    return lines
+
+
+class TimedHandler:
+    """ Wraps a handler registered in the HandlerManager and records
+    how much time is spent in it. Compares equal to the wrapped method,
+    so HandlerManager.remove_handler keeps working. """
+
+    def __init__(self, handler, stats, name):
+        self.handler = handler
+        self.stats = stats
+        self.name = name
+
+    def __call__(self, *args):
+        time1 = time.perf_counter()
+        try:
+            return self.handler(*args)
+        finally:
+            self.stats.add(self.name, time.perf_counter() - time1)
+
+    def __eq__(self, other):
+        if isinstance(other, TimedHandler):
+            other = other.handler
+        return self.handler == other
+
+    def __hash__(self):
+        return hash(self.handler)
+
+
+class SectionStats:
+    def __init__(self):
+        self.calls = collections.Counter()
+        self.total = collections.Counter()
+
+    def add(self, name, duration):
+        self.calls[name] += 1
+        self.total[name] += duration
+
+
+def percentile(sorted_values, p):
+    """ Nearest-rank percentile of an already sorted list """
+    if len(sorted_values) == 0:
+        return 0.0
+    rank = max(1, int(math.ceil(p / 100.0 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+class ReplayResult:
+    def __init__(self, latencies, wall_time, sections, bot):
+        self.latencies = latencies
+        self.wall_time = wall_time
+        self.sections = sections
+        self.num_messages_sent = len(bot.connection_manager.sent)
+        self.num_whispers_sent = len(bot.whisper_manager.whispers)
+        self.num_redis_calls = RedisManager.get().num_calls
+        # Newer versions of irc keep the delayed commands in a scheduler
+        scheduler = getattr(bot.reactor, 'scheduler', None)
+        delayed_commands = scheduler.queue if scheduler is not None else bot.reactor.delayed_commands
+        self.num_delayed_commands = len(delayed_commands)
+
+    @property
+    def num_messages(self):
+        return len(self.latencies)
+
+    @property
+    def msgs_per_sec(self):
+        if self.wall_time <= 0:
+            return 0.0
+        return self.num_messages / self.wall_time
+
+    def format_report(self, top=20):
+        sorted_latencies = sorted(self.latencies)
+        total_time = sum(self.latencies)
+        lines = []
+        lines.append('Replayed {0} messages in {1:.3f}s ({2:,.0f} msgs/sec)'.format(
+            self.num_messages, self.wall_time, self.msgs_per_sec))
+        lines.append('Latency per message: p50 {0:.1f}us, p99 {1:.1f}us, max {2:.1f}us'.format(
+            percentile(sorted_latencies, 50) * 1e6,
+            percentile(sorted_latencies, 99) * 1e6,
+            (sorted_latencies[-1] if sorted_latencies else 0.0) * 1e6))
+        lines.append('Side effects: {0} messages, {1} whispers, {2} redis round trips, {3} pending delayed commands'.format(
+            self.num_messages_sent, self.num_whispers_sent, self.num_redis_calls, self.num_delayed_commands))
+        lines.append('')
+        lines.append('{0:<60} {1:>9} {2:>11} {3:>9} {4:>7}'.format('Section', 'Calls', 'Total (ms)', 'Avg (us)', '%'))
+
+        rows = sorted(self.sections.total.items(), key=lambda row: row[1], reverse=True)
+        for name, section_total in rows[:top]:
+            calls = self.sections.calls[name]
+            lines.append('{0:<60} {1:>9} {2:>11.1f} {3:>9.1f} {4:>6.1f}%'.format(
+                name[:60],
+                calls,
+                section_total * 1000.0,
+                section_total / calls * 1e6 if calls > 0 else 0.0,
+                section_total / total_time * 100.0 if total_time > 0 else 0.0))
+
+        return '\n'.join(lines)
+
+
+class BenchmarkBot(Bot):
+    """ A Bot with every network-facing part replaced by a local stand-in.
+
+    MySQL is replaced by an in-memory SQLite database, Redis by FakeRedis,
+    IRC/whisper connections by recording stand-ins, and the Twitch API by
+    FakeTwitchAPI. Everything on the chat hot path (HandlerManager, modules,
+    managers, commands, the user counter writer) is the real thing.
+
+    Only the factory hooks of Bot (init_db, init_connections etc) are
+    overridden, so the bot is set up exactly like a real one.
+    """
+
+    def __init__(self, config, modules=None, seed_data=None):
+        self.enabled_module_ids = modules
+        self.seed_data = seed_data
+
+        super().__init__(config)
+
+        # Modules with their own action queue threads would do HTTP requests from them
+        for module in self.module_manager.all_modules:
+            if hasattr(module, 'action_queue'):
+                module.action_queue = DiscardingActionQueue()
+
+    def init_db(self):
+        init_sqlite_db()
+        RedisManager.redis = FakeRedis()
+
+        self.db_session = DBManager.create_session()
+
+        if self.seed_data is not None:
+            self.seed_data(self)
+        if self.enabled_module_ids is not None:
+            self.set_enabled_modules(self.enabled_module_ids)
+
+    def init_action_queues(self):
+        self.action_queue = DiscardingActionQueue()
+        self.mainthread_queue = DiscardingActionQueue()
+
+    def init_connections(self):
+        self.connection_manager = FakeConnectionManager(self.streamer)
+        self.control_hub = None
+        self.whisper_manager = FakeWhisperManager()
+
+    def init_api_clients(self):
+        self.twitchapi = FakeTwitchAPI()
+
+    def schedule_tasks(self):
+        # The reactor is never processed while replaying, so none of the
+        # periodic tasks would run anyway
+        pass
+
+    def set_enabled_modules(self, module_ids):
+        from pajbot.modules import available_modules
+
+        with DBManager.create_session_scope() as db_session:
+            for module_class in available_modules:
+                db_module = db_session.query(Module).filter_by(id=module_class.ID).one_or_none()
+                if db_module is None:
+                    db_module = Module(module_class.ID)
+                    db_session.add(db_module)
+                db_module.enabled = module_class.ID in module_ids
+
+    def instrument_handlers(self, sections, events=('on_pubmsg', 'on_message')):
+        for event in events:
+            HandlerManager.handlers[event] = [
+                    (TimedHandler(handler, sections, '{} {}'.format(event, get_handler_name(handler))), priority)
+                    for handler, priority in HandlerManager.handlers[event]]
+
+    def replay(self, events, warmup=0):
+        """ Replay the given events through on_pubmsg and measure how long each one takes.
+        The first `warmup` events are replayed, but not measured. """
+
+        chatconn = None
+
+        for event in events[:warmup]:
+            self.replay_event(chatconn, event)
+
+        sections = SectionStats()
+        self.instrument_handlers(sections)
+
+        original_command_run = Command.run
+        command_depth = [0]
+
+        def timed_command_run(command, bot, source, message, event={}, args={}, whisper=False):
+            trigger = args.get('trigger', None)
+            command_depth[0] += 1
+            time1 = time.perf_counter()
+            try:
+                return original_command_run(command, bot, source, message, event=event, args=args, whisper=whisper)
+            finally:
+                command_depth[0] -= 1
+                if command_depth[0] == 0:
+                    sections.add('command !{}'.format(trigger), time.perf_counter() - time1)
+
+        Command.run = timed_command_run
+
+        latencies = []
+        try:
+            wall_time1 = time.perf_counter()
+            for event in events[warmup:]:
+                time1 = time.perf_counter()
+                self.replay_event(chatconn, event)
+                latencies.append(time.perf_counter() - time1)
+            wall_time = time.perf_counter() - wall_time1
+        finally:
+            Command.run = original_command_run
+
+        total_sections = sum(sections.total.values())
+        sections.add('Bot.parse_message (excluding handlers/commands)', max(0.0, sum(latencies) - total_sections))
+        sections.calls['Bot.parse_message (excluding handlers/commands)'] = len(latencies)
+
+        return ReplayResult(latencies, wall_time, sections, self)
+
+    def replay_event(self, chatconn, event):
+        if event.type == 'action':
+            self.on_action(chatconn, event)
+        else:
+            self.on_pubmsg(chatconn, event)
+
+
+def create_benchmark_config(streamer='pajlada', nickname='pajbot'):
+    config = configparser.ConfigParser()
+    config['main'] = {
+            'nickname': nickname,
+            'password': 'oauth:benchmark',
+            'streamer': streamer,
+            'db': 'sqlite://',
+            'timezone': 'UTC',
+            'trusted_mods': '0',
+            }
+    config['flags'] = {
+            'silent': '0',
+            'dev': '0',
+            }
+    config['phrases'] = {
+            'welcome': '',
+            'quit': '',
+            'nl_0': '{username} has not typed any messages in this channel BibleThump',
+            'nl_pos': '{username} is rank {nl_pos} line-farmer in this channel!',
+            'point_pos': '{username_w_verb} rank {point_pos} point-hoarder in this channel with {points} points.',
+            }
+    return config
+
+
+def seed_benchmark_data(num_banphrases=0, num_custom_emotes=0, num_commands=0, twitch_emotes={}):
+    """ Returns a callable which fills the benchmark database with synthetic
+    banphrases, custom (BTTV) emotes and commands. """
+
+    def seed(bot):
+        with DBManager.create_session_scope() as db_session:
+            for i in range(0, num_banphrases):
+                operator = ('contains', 'startswith', 'endswith')[i % 3]
+                banphrase = Banphrase(phrase='banned phrase {}'.format(i),
+                        name='Banphrase {}'.format(i),
+                        case_sensitive=i % 4 == 0,
+                        operator=operator)
+                banphrase.sub_immunity = False
+                db_session.add(banphrase)
+                db_session.flush()
+                db_session.add(BanphraseData(banphrase.id))
+
+            for code, emote_id in twitch_emotes.items():
+                db_session.add(Emote(None, emote_id=emote_id, code=code))
+
+            for i, code in enumerate(get_custom_emote_codes(num_custom_emotes)):
+                db_session.add(Emote(None, emote_hash='{:024x}'.format(i), code=code))
+
+            for i in range(0, num_commands):
+                command = Command(command='cmd{0}|alias{0}'.format(i),
+                        action={'type': 'say', 'message': '$(source:username) has $(source:points) points, {}'.format(i)})
+                db_session.add(command)
+                db_session.flush()
+                db_session.add(CommandData(command.id, last_date_used=None))
+
+            for trigger, action in (('ping', {'type': 'say', 'message': 'pong'}),
+                                    ('points', {'type': 'func', 'cb': 'point_pos'}),
+                                    ('nl', {'type': 'func', 'cb': 'nl_pos'})):
+                command = Command(command=trigger, action=action)
+                db_session.add(command)
+                db_session.flush()
+                db_session.add(CommandData(command.id, last_date_used=None))
+
+    return seed
+
+
+def get_custom_emote_codes(num_custom_emotes):
+    base_codes = ['FeelsBadMan', 'FeelsGoodMan', 'OMEGALUL', 'KKona', 'haHAA', 'LUL',
+                  'monkaS', 'PepeHands', 'gachiGASM', 'forsenE', 'NaM', 'ZULUL']
+    codes = base_codes[:num_custom_emotes]
+    for i in range(len(codes), num_custom_emotes):
+        codes.append('CustomEmote{}'.format(i))
+    return codes
+
+
+DEFAULT_TWITCH_EMOTES = {
+        'Kappa': 25,
+        'PogChamp': 88,
+        'Kreygasm': 41,
+        'BibleThump': 86,
+        'DansGame': 33,
+        'SeemsGood': 64138,
+        'SMOrc': 52,
+        '4Head': 354,
+        }
@@ -4,18 +4,19 @@ import sys
 import logging
 import subprocess
 import re
+import json
 
 import datetime
 import urllib
 
 from .models.sock import SocketManager
-from .models.user import UserManager
+from .models.user import UserManager, UserCounterWriter, ActiveChatters
 from .models.emote import EmoteManager
 from .models.connection import ConnectionManager
 from .models.whisperconnection import WhisperConnectionManager
 from .models.websocket import WebSocketManager
 from .models.twitter import TwitterManager
-from .models.db import DBManager
+from .models.db import DBManager, DBWriter
 from .models.filter import FilterManager
 from .models.command import CommandManager
 from .models.kvi import KVIManager
@@ -31,6 +32,7 @@ from pajbot.models.banphrase import BanphraseManager
 from pajbot.models.module import ModuleManager
 from pajbot.models.handler import HandlerManager
 from pajbot.managers.redis import RedisManager
+from pajbot.managers.leaderboard import LeaderboardManager
 from pajbot.modules import PredictModule
 from pajbot.streamhelper import StreamHelper
 from .apiwrappers import TwitchAPI
@@ -48,6 +50,7 @@ log = logging.getLogger('pajbot')
 
 class TMI:
     message_limit = 90
+    message_limit_interval = 31  # in seconds, Twitch uses 30 but we leave a second of margin
     whispers_message_limit = 20
     whispers_limit_interval = 5  # in seconds
 
@@ -64,8 +67,9 @@ class Bot:
     url_regex_str = r'\(?(?:(http|https):\/\/)?(?:((?:[^\W\s]|\.|-|[:]{1})+)@{1})?((?:www.)?(?:[^\W\s]|\.|-)+[\.][^\W\s]{2,4}|localhost(?=\/)|\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})(?::(\d*))?([\/]?[^\s\?]*[\/]{1})*(?:\/?([^\s\n\?\[\]\{\}\#]*(?:(?=\.)){1}|[^\s\n\?\[\]\{\}\.\#]*)?([\.]{1}[^\s\?\#]*)?)?(?:\?{1}([^\s\n\#\[\]]*))?([\#][^\s\n]*)?\)?'
     
     max_active_chatters = 250
-    active_chatters = []
-    active_chatter_names = {}
+    user_cache_size = 50000
+    user_cache_max_idle = 60 * 60
+    user_counters_flush_interval = 5
 
     def parse_args():
         parser = argparse.ArgumentParser()
@@ -109,6 +113,11 @@ class Bot:
 
         self.timezone = config['main'].get('timezone', 'UTC')
 
+        self.max_active_chatters = int(config['main'].get('max_active_chatters', self.max_active_chatters))
+        self.user_cache_size = int(config['main'].get('user_cache_size', self.user_cache_size))
+        self.user_cache_max_idle = int(config['main'].get('user_cache_max_idle', self.user_cache_max_idle))
+        self.user_counters_flush_interval = int(config['main'].get('user_counters_flush_interval', self.user_counters_flush_interval))
+
         self.trusted_mods = config.getboolean('main', 'trusted_mods')
 
         TimeManager.init_timezone(self.timezone)
@@ -130,10 +139,12 @@ class Bot:
 
         self.silent = False
         self.dev = False
+        self.handler_stats = False
 
         if 'flags' in config:
             self.silent = True if 'silent' in config['flags'] and config['flags']['silent'] == '1' else self.silent
             self.dev = True if 'dev' in config['flags'] and config['flags']['dev'] == '1' else self.dev
+            self.handler_stats = True if 'handler_stats' in config['flags'] and config['flags']['handler_stats'] == '1' else self.handler_stats
 
         DBManager.init(self.config['main']['db'])
 
@@ -151,48 +162,38 @@ class Bot:
 
         self.load_default_phrases()
 
-        self.db_session = DBManager.create_session()
+        self.init_db()
 
-        try:
-            subprocess.check_call(['alembic', 'upgrade', 'head'] + ['--tag="{0}"'.format(' '.join(sys.argv[1:]))])
-        except subprocess.CalledProcessError:
-            log.exception('aaaa')
-            log.error('Unable to call `alembic upgrade head`, this means the database could be out of date. Quitting.')
-            sys.exit(1)
-        except PermissionError:
-            log.error('No permission to run `alembic upgrade head`. This means your user probably doesn\'t have execution rights on the `alembic` binary.')
-            log.error('The error can also occur if it can\'t find `alembic` in your PATH, and instead tries to execute the alembic folder.')
-            sys.exit(1)
-        except FileNotFoundError:
-            log.error('Could not found an installation of alembic. Please install alembic to continue.')
-            sys.exit(1)
-        except:
-            log.exception('Unhandled exception when calling db update')
-            sys.exit(1)
+        self.init_action_queues()
 
-        # Actions in this queue are run in a separate thread.
-        # This means actions should NOT access any database-related stuff.
-        self.action_queue = ActionQueue()
-        self.action_queue.start()
+        # Commits the changes of our managers without blocking the main thread. See commit_all
+        self.db_writer = DBWriter()
 
         self.reactor = irc.client.Reactor()
         self.start_time = datetime.datetime.now()
         ActionParser.bot = self
 
         HandlerManager.init_handlers()
+        if self.handler_stats is True:
+            HandlerManager.enable_stats()
 
         self.socket_manager = SocketManager(self)
+        self.socket_manager.add_handler('handlers.stats', self.on_handler_stats)
         self.stream_manager = StreamManager(self)
 
         StreamHelper.init_bot(self, self.stream_manager)
 
-        self.users = UserManager()
+        self.users = UserManager(capacity=self.user_cache_size, max_idle=self.user_cache_max_idle,
+                counter_writer=UserCounterWriter())
+        self.active_chatters = ActiveChatters(capacity=self.max_active_chatters)
+        self.users.pin_sources.append(self.active_chatters)
         self.decks = DeckManager().reload()
         self.module_manager = ModuleManager(self.socket_manager, bot=self).load()
         self.commands = CommandManager(
                 socket_manager=self.socket_manager,
                 module_manager=self.module_manager,
                 bot=self).load()
+        self.commands.restore_cooldowns()
         self.filters = FilterManager().reload()
         self.banphrase_manager = BanphraseManager(self).load()
         self.timer_manager = TimerManager(self).load()
@@ -224,9 +225,6 @@ class Bot:
                 'banphrases': self.banphrase_manager,
                 }
 
-        self.execute_every(10 * 60, self.commit_all)
-        self.execute_every(30, lambda: self.connection_manager.get_main_conn().ping('tmi.twitch.tv'))
-
         try:
             self.admin = self.config['main']['admin']
         except KeyError:
@@ -236,26 +234,8 @@ class Bot:
 
         self.parse_version()
 
-        self.connection_manager = ConnectionManager(self.reactor, self, TMI.message_limit, streamer=self.streamer)
-        chub = self.config['main'].get('control_hub', None)
-        if chub is not None:
-            self.control_hub = ConnectionManager(self.reactor, self, TMI.message_limit, streamer=chub, backup_conns=1)
-            log.info('start pls')
-        else:
-            self.control_hub = None
-
-        twitch_client_id = None
-        twitch_oauth = None
-        if 'twitchapi' in self.config:
-            twitch_client_id = self.config['twitchapi'].get('client_id', None)
-            twitch_oauth = self.config['twitchapi'].get('oauth', None)
-
-        self.twitchapi = TwitchAPI(twitch_client_id, twitch_oauth)
-
-        self.reactor.add_global_handler('all_events', self._dispatcher, -10)
-
-        self.whisper_manager = WhisperConnectionManager(self.reactor, self, self.streamer, TMI.whispers_message_limit, TMI.whispers_limit_interval)
-        self.whisper_manager.start(accounts=[{'username': self.nickname, 'oauth': self.password, 'can_send_whispers': self.config.getboolean('main', 'add_self_as_whisper_account')}])
+        self.init_connections()
+        self.init_api_clients()
 
         self.ascii_timeout_duration = 120
         self.msg_length_timeout_duration = 120
@@ -270,21 +250,96 @@ class Bot:
         self.data_cb['stream_status'] = self.c_stream_status
         self.data_cb['bot_uptime'] = self.c_uptime
 
-        self.silent = True if args.silent else self.silent
+        if args is not None and args.silent:
+            self.silent = True
 
         if self.silent:
             log.info('Silent mode enabled')
 
         self.reconnection_interval = 5
 
+        self.websocket_manager = WebSocketManager(self)
+
+        # The chatters and subscribers we got in our last update.
+        # Only the differences are applied on the next update
+        self.chatters = None
+        self.subscribers = None
+        # The subscribers we've got so far in the current subscribers update
+        self.fetched_subscribers = set()
+
+        self.schedule_tasks()
+
+        # XXX: TEMPORARY UGLY CODE
+        HandlerManager.add_handler('on_user_gain_tokens', self.on_user_gain_tokens)
+
+    def init_db(self):
+        """ Makes sure the database is up to date, and creates our db session """
+        self.db_session = DBManager.create_session()
+
+        try:
+            subprocess.check_call(['alembic', 'upgrade', 'head'] + ['--tag="{0}"'.format(' '.join(sys.argv[1:]))])
+        except subprocess.CalledProcessError:
+            log.exception('aaaa')
+            log.error('Unable to call `alembic upgrade head`, this means the database could be out of date. Quitting.')
+            sys.exit(1)
+        except PermissionError:
+            log.error('No permission to run `alembic upgrade head`. This means your user probably doesn\'t have execution rights on the `alembic` binary.')
+            log.error('The error can also occur if it can\'t find `alembic` in your PATH, and instead tries to execute the alembic folder.')
+            sys.exit(1)
+        except FileNotFoundError:
+            log.error('Could not found an installation of alembic. Please install alembic to continue.')
+            sys.exit(1)
+        except:
+            log.exception('Unhandled exception when calling db update')
+            sys.exit(1)
+
+    def init_action_queues(self):
+        # Actions in this queue are run in a separate thread.
+        # This means actions should NOT access any database-related stuff.
+        self.action_queue = ActionQueue()
+        self.action_queue.start()
+
         """
         For actions that need to access the main thread,
         we can use the mainthread_queue.
         """
         self.mainthread_queue = ActionQueue()
-        self.execute_every(1, self.mainthread_queue.parse_action)
 
-        self.websocket_manager = WebSocketManager(self)
+    def init_connections(self):
+        """ Creates the chat and whisper connections """
+        self.connection_manager = ConnectionManager(self.reactor, self, TMI.message_limit, streamer=self.streamer, time_interval=TMI.message_limit_interval)
+        chub = self.config['main'].get('control_hub', None)
+        if chub is not None:
+            self.control_hub = ConnectionManager(self.reactor, self, TMI.message_limit, streamer=chub, backup_conns=1, time_interval=TMI.message_limit_interval)
+            log.info('start pls')
+        else:
+            self.control_hub = None
+
+        self.reactor.add_global_handler('all_events', self._dispatcher, -10)
+
+        self.whisper_manager = WhisperConnectionManager(self.reactor, self, self.streamer, TMI.whispers_message_limit, TMI.whispers_limit_interval)
+        self.whisper_manager.start(accounts=[{'username': self.nickname, 'oauth': self.password, 'can_send_whispers': self.config.getboolean('main', 'add_self_as_whisper_account')}])
+
+    def init_api_clients(self):
+        twitch_client_id = None
+        twitch_oauth = None
+        if 'twitchapi' in self.config:
+            twitch_client_id = self.config['twitchapi'].get('client_id', None)
+            twitch_oauth = self.config['twitchapi'].get('oauth', None)
+
+        self.twitchapi = TwitchAPI(twitch_client_id, twitch_oauth)
+
+    def schedule_tasks(self):
+        """ Schedules everything the bot does periodically """
+        if not LeaderboardManager.exists():
+            self.db_writer.action_queue.add(self.rebuild_leaderboards)
+
+        self.execute_every(10 * 60, self.commit_all)
+        self.execute_every(60, self.users.evict)
+        self.execute_every(self.user_counters_flush_interval, self.users.flush_counters)
+        self.execute_every(30, lambda: self.connection_manager.get_main_conn().ping('tmi.twitch.tv'))
+
+        self.execute_every(1, self.mainthread_queue.parse_action)
 
         """
         Update chatters every `update_chatters_interval' minutes.
@@ -302,76 +357,85 @@ class Bot:
         except:
             pass
 
-        # XXX: TEMPORARY UGLY CODE
-        HandlerManager.add_handler('on_user_gain_tokens', self.on_user_gain_tokens)
-
     def on_user_gain_tokens(self, user, tokens_gained):
         self.whisper(user.username, 'You finished todays quest! You have been awarded with {} tokens.'.format(tokens_gained))
 
+    def on_handler_stats(self, data, conn):
+        """ Dump the event handler latency stats back through the socket.
+        data can contain an `action` (enable, disable or reset) and an `event`
+        to only dump the stats for a single event. """
+        action = data.get('action', None)
+        if action == 'enable':
+            HandlerManager.enable_stats()
+        elif action == 'disable':
+            HandlerManager.disable_stats()
+        elif action == 'reset':
+            HandlerManager.reset_stats()
+
+        payload = {
+                'enabled': HandlerManager.stats_enabled,
+                'stats': HandlerManager.jsonify_stats(data.get('event', None)),
+                }
+
+        log.info('Handler stats: {}'.format(json.dumps(payload)))
+
+        try:
+            conn.sendall(json.dumps(payload).encode('utf-8'))
+        except OSError:
+            log.exception('Unable to send handler stats through the socket')
+
     def update_subscribers_stage1(self):
-        limit = 100
-        offset = 0
-        subscribers = []
         log.info('Starting stage1 subscribers update')
 
+        def on_subscribers(subscribers, first, last):
+            log.debug('Pushing {0} subscribers to stage 2'.format(len(subscribers)))
+            self.mainthread_queue.add(self.update_subscribers_stage2,
+                                      args=[subscribers],
+                                      kwargs={'first': first, 'last': last})
+
+        twitchapi_config = self.config['twitchapi']
         try:
-            retry_same = 0
-            while True:
-                log.debug('Beginning sub request {0} {1}'.format(limit, offset))
-                subs, retry_same, error = self.twitchapi.get_subscribers(self.streamer, limit, offset, 0 if retry_same is False else retry_same)
-                log.debug('got em!')
-
-                if error is True:
-                    log.error('Too many attempts, aborting')
-                    return False
-
-                if retry_same is False:
-                    offset += limit
-                    if len(subs) == 0:
-                        # We don't need to retry, and the last query finished propery
-                        # Break out of the loop and start fiddling with the subs!
-                        log.debug('Done!')
-                        break
-                    else:
-                        log.debug('Fetched {0} subs'.format(len(subs)))
-                        subscribers.extend(subs)
-
-                if retry_same is not False:
-                    # In case the next attempt is a retry, wait for 3 seconds
-                    log.debug('waiting for 3 seconds...')
-                    time.sleep(3)
-                    log.debug('waited enough!')
-            log.debug('Finished with the while True loop!')
+            if self.twitchapi.get_all_subscribers(self.streamer, on_subscribers,
+                    concurrency=int(twitchapi_config.get('subscribers_concurrency', 4)),
+                    requests_per_second=float(twitchapi_config.get('subscribers_requests_per_second', 5))) is False:
+                log.error('Unable to fetch all subscribers')
+                return
         except:
             log.exception('Caught an exception while trying to get subscribers')
             return
 
         log.info('Ended stage1 subscribers update')
-        if len(subscribers) > 0:
-            log.info('Got some subscribers, so we are pushing them to stage 2!')
-            self.mainthread_queue.add(self.update_subscribers_stage2,
-                                      args=[subscribers])
-            log.info('Pushed them now.')
 
-    def update_subscribers_stage2(self, subscribers):
+    def update_subscribers_stage2(self, subscribers, first=True, last=True):
+        """
+        Applies a chunk of the subscribers from stage 1.
+        New subscribers are marked as subscribers right away, and once we've
+        got the last chunk, users who are no longer subscribed are unmarked.
+        """
+
         log.debug('begiunning stage 2 of update subs')
-        self.kvi['active_subs'].set(len(subscribers) - 1)
 
-        log.debug('Bulk loading subs...')
-        loaded_subscribers = self.users.bulk_load(subscribers)
-        log.debug('ok!')
+        if self.subscribers is None:
+            # First update since we started, compare against the subscribers in the database
+            self.subscribers = self.users.get_subscriber_usernames()
+        if first:
+            self.fetched_subscribers = set()
 
-        log.debug('settings all loaded users as non-subs')
-        self.users.reset_subs()
-        """
-        for username, user in self.users.items():
-            if user.subscriber:
-                user.subscriber = False
-                """
+        subscribers = set(subscribers)
+        self.fetched_subscribers.update(subscribers)
+
+        new_subscribers = subscribers - self.subscribers
+        old_subscribers = set()
+        if last:
+            self.kvi['active_subs'].set(len(self.fetched_subscribers) - 1)
+            old_subscribers = self.subscribers - self.fetched_subscribers
+        log.debug('{0} new subscribers, {1} subscribers are gone'.format(len(new_subscribers), len(old_subscribers)))
 
-        log.debug('ok!, setting loaded subs as subs')
-        for user in loaded_subscribers:
-            user.subscriber = True
+        self.users.update_subscribers(new_subscribers, old_subscribers)
+        self.subscribers.update(new_subscribers)
+        if last:
+            self.subscribers = self.fetched_subscribers
+            self.fetched_subscribers = set()
 
         log.debug('end of stage 2 of update subs')
 
@@ -385,19 +449,23 @@ class Bot:
 
         log.debug('Updating {0} chatters'.format(len(chatters)))
 
-        u_chatters = self.users.bulk_load(chatters)
+        tag_multipliers = {}
+        if self.streamer == 'forsenlol':
+            tag_multipliers['trump_sub'] = 0.5
 
-        for user in u_chatters:
-            # if self.is_online:
-            #     user.minutes_in_chat_online += self.update_chatters_interval
-            # else:
-            user.minutes_in_chat_offline += self.update_chatters_interval
-            num_points = points
-            if user.subscriber:
-                num_points *= 5
-            if self.streamer == 'forsenlol' and 'trump_sub' in user.tags:
-                num_points *= 0.5
-            user.touch(num_points)
+        # if self.is_online:
+        #     minutes_in_chat_online = self.update_chatters_interval
+        # Users that were in chat during our last update already exist
+        chatters = set(chatters)
+        if self.chatters is not None:
+            log.debug('{0} chatters joined, {1} chatters left'.format(len(chatters - self.chatters), len(self.chatters - chatters)))
+
+        self.users.award_chatters(chatters, points,
+                minutes_in_chat_offline=self.update_chatters_interval,
+                subscriber_multiplier=5,
+                tag_multipliers=tag_multipliers,
+                known_usernames=self.chatters if self.chatters is not None else frozenset())
+        self.chatters = chatters
 
     def _dispatcher(self, connection, event):
         if connection == self.connection_manager.get_main_conn() or connection in self.whisper_manager or (self.control_hub is not None and connection == self.control_hub.get_main_conn()):
@@ -593,6 +661,34 @@ class Bot:
             return (duration, punishment)
         return (0, punishment)
 
+    def timeout_warn_many(self, offenders):
+        """ Like timeout_warn, for a list of (user, duration) tuples.
+        The warnings of all offenders are read and recorded in one Redis round trip.
+        Returns a list of (duration, punishment) tuples in the same order. """
+
+        if len(offenders) == 0:
+            return []
+
+        warning_module = self.module_manager['warning']
+        if warning_module is None:
+            punishments = [user.timeout(duration) for user, duration in offenders]
+        else:
+            pipeline = RedisManager.get().pipeline(transaction=False)
+            for user, duration in offenders:
+                user.warn(warning_module, redis=pipeline)
+            punishments = [user.get_punishment(duration, chances_used, warning_module)
+                           for (user, duration), chances_used in zip(offenders, pipeline.execute())]
+
+        ret = []
+        for (user, _), (duration, punishment) in zip(offenders, punishments):
+            if not user.ban_immune:
+                self.timeout(user.username, duration)
+                ret.append((duration, punishment))
+            else:
+                ret.append((0, punishment))
+
+        return ret
+
     def timeout_user(self, user, duration):
         if not user.ban_immune:
             self._timeout(user.username, duration)
@@ -742,7 +838,7 @@ class Bot:
                             if emote.code not in self.emotes:
                                 self.emotes[emote.code] = emote
 
-                        emote.add(emote_count, self.reactor)
+                        emote.add(emote_count)
                     except:
                         log.exception('Exception caught while splitting emote data')
                         log.error('Emote data: {}'.format(emote_data))
@@ -755,18 +851,15 @@ class Bot:
             elif tag['key'] == 'user-type':
                 source.moderator = tag['value'] == 'mod' or source.username == self.streamer
 
-        for emote in self.emotes.custom_data:
-            num = 0
-            for match in emote.regex.finditer(msg_raw):
-                num += 1
+        for emote, spans in self.emotes.match_custom_emotes(msg_raw):
+            for start, end in spans:
                 message_emotes.append({
                     'code': emote.code,
                     'bttv_hash': emote.emote_hash,
-                    'start': match.span()[0],
-                    'end': match.span()[1] - 1,  # don't ask me
+                    'start': start,
+                    'end': end,
                     })
-            if num > 0:
-                emote.add(num, self.reactor)
+            emote.add(len(spans))
 
         urls = self.find_unique_urls(msg_raw)
 
@@ -780,16 +873,8 @@ class Bot:
 
         source.last_seen = datetime.datetime.now()
         source.last_active = datetime.datetime.now()
-        
-        uname = source.username.lower()
-        if uname not in self.active_chatter_names:
-            if len(self.active_chatters) >= self.max_active_chatters:
-                oldest_user = self.active_chatters.pop()
-                oldest_name = oldest_user.username.lower()
-                if oldest_name in self.active_chatter_names:
-                    del self.active_chatter_names[oldest_name]
-            self.active_chatters.insert(0, source)
-            self.active_chatter_names[uname] = True
+
+        self.active_chatters.touch(source)
 
         if source.ignored:
             return False
@@ -856,14 +941,27 @@ class Bot:
     @time_method
     def commit_all(self):
         log.info('Commiting all...')
+        # Counters are written by the counter writer, which keeps the leaderboards up to date as well.
+        # The counters of flushed users are written with the commit, but their leaderboards are still updated by the counter writer.
+        self.users.flush_counters()
+        self.users.update_flushed_leaderboards()
         for key, manager in self.commitable.items():
             log.info('Commiting {0}'.format(key))
-            manager.commit()
-            log.info('Done with {0}'.format(key))
+            num_rows = self.db_writer.commit(key, manager.db_session)
+            log.info('Done with {0}, {1} changed rows are written in the background'.format(key, num_rows))
+        # Snapshot the command cooldowns so they survive a restart
+        num_cooldowns = self.commands.snapshot_cooldowns()
+        log.info('Saved {0} user cooldowns'.format(num_cooldowns))
         log.info('ok!')
 
         HandlerManager.trigger('on_commit', stop_on_false=False)
 
+    def rebuild_leaderboards(self):
+        try:
+            LeaderboardManager.rebuild()
+        except:
+            log.exception('Unhandled exception while rebuilding the leaderboards')
+
     def quit(self, message, event, **options):
         quit_chub = self.config['main'].get('control_hub', None)
         quit_delay = 1
@@ -882,6 +980,9 @@ class Bot:
 
     def quit_bot(self, **options):
         self.commit_all()
+        # Make sure everything has been written before we exit
+        self.users.counter_writer.wait()
+        self.db_writer.wait()
         if self.phrases['quit']:
             phrase_data = {
                     'nickname': self.nickname,
@@ -901,20 +1002,15 @@ class Bot:
 
         sys.exit(0)
 
+    def get_filter(self, name):
+        """ Returns the filter function with the given name, or None if there is no such filter.
+        A filter function takes the value to filter and a list of filter arguments. """
+        return AVAILABLE_FILTERS.get(name, None)
+
     def apply_filter(self, resp, filter):
-        available_filters = {
-                'strftime': lambda var, args: var.strftime(args[0]),
-                'lower': lambda var, args: var.lower(),
-                'upper': lambda var, args: var.upper(),
-                'time_since_minutes': lambda var, args: 'no time' if var == 0 else time_since(var * 60, 0, format='long'),
-                'time_since': lambda var, args: 'no time' if var == 0 else time_since(var, 0, format='long'),
-                'time_since_dt': _filter_time_since_dt,
-                'urlencode': lambda var, args: urllib.parse.urlencode(var),
-                'join': _filter_join,
-                'number_format': _filter_number_format,
-                }
-        if filter.name in available_filters:
-            return available_filters[filter.name](resp, filter.arguments)
+        filter_func = self.get_filter(filter.name)
+        if filter_func is not None:
+            return filter_func(resp, filter.arguments)
         return resp
 
     def find_unique_urls(self, message):
@@ -945,3 +1041,15 @@ def _filter_number_format(var, args):
     except:
         log.exception('asdasd')
     return var
+
+AVAILABLE_FILTERS = {
+        'strftime': lambda var, args: var.strftime(args[0]),
+        'lower': lambda var, args: var.lower(),
+        'upper': lambda var, args: var.upper(),
+        'time_since_minutes': lambda var, args: 'no time' if var == 0 else time_since(var * 60, 0, format='long'),
+        'time_since': lambda var, args: 'no time' if var == 0 else time_since(var, 0, format='long'),
+        'time_since_dt': _filter_time_since_dt,
+        'urlencode': lambda var, args: urllib.parse.urlencode(var),
+        'join': _filter_join,
+        'number_format': _filter_number_format,
+        }
@@ -9,6 +9,7 @@ from pajbot.models.user import User
 from pajbot.models.filter import Filter
 from pajbot.models.db import DBManager
 from pajbot.models.handler import HandlerManager
+from pajbot.managers.leaderboard import LeaderboardManager
 from pajbot.tbutil import time_limit, TimeoutException, time_since
 from pajbot.apiwrappers import APIBase
 
@@ -52,8 +53,11 @@ class Dispatch:
             phrase_data['username_w_verb'] = '{0} is'.format(user.username_raw)
 
         if user.points > 0:
-            query_data = bot.users.db_session.query(func.count(User.id)).filter(User.points > user.points).one()
-            phrase_data['point_pos'] = int(query_data[0]) + 1
+            point_pos = LeaderboardManager.get_rank('points', user.username, user.points)
+            if point_pos is None:
+                query_data = bot.users.db_session.query(func.count(User.id)).filter(User.points > user.points).one()
+                point_pos = int(query_data[0]) + 1
+            phrase_data['point_pos'] = point_pos
             bot.whisper(source.username, bot.phrases['point_pos'].format(**phrase_data))
 
     def nl_pos(bot, source, message, event, args):
@@ -67,6 +71,7 @@ class Dispatch:
                 username = tmp_username
                 num_lines = 0
         else:
+            user = source
             username = source.username_raw
             num_lines = source.num_lines
 
@@ -78,8 +83,11 @@ class Dispatch:
         if num_lines <= 0:
             bot.say(bot.phrases['nl_0'].format(**phrase_data))
         else:
-            query_data = bot.users.db_session.query(func.count(User.id)).filter(User.num_lines > num_lines).one()
-            phrase_data['nl_pos'] = int(query_data[0]) + 1
+            nl_pos = LeaderboardManager.get_rank('num_lines', user.username, num_lines)
+            if nl_pos is None:
+                query_data = bot.users.db_session.query(func.count(User.id)).filter(User.num_lines > num_lines).one()
+                nl_pos = int(query_data[0]) + 1
+            phrase_data['nl_pos'] = nl_pos
             bot.say(bot.phrases['nl_pos'].format(**phrase_data))
 
     def query(bot, source, message, event, args):
@@ -521,6 +529,48 @@ class Dispatch:
         else:
             bot.whisper(source.username, 'Usage: !debug user USERNAME')
 
+    def rebuild_leaderboards(bot, source, message, event, args):
+        """ Rebuilds the leaderboards from the database in the background """
+        bot.db_writer.action_queue.add(bot.rebuild_leaderboards)
+        bot.whisper(source.username, 'Rebuilding the leaderboards.')
+
+    def handler_stats(bot, source, message, event, args):
+        """ Whispers the event handlers that have taken the most time.
+        Usage: !handlerstats [on|off|reset|EVENT] """
+        event_name = None
+        if message:
+            argument = message.split(' ')[0].strip().lower()
+            if argument == 'on':
+                HandlerManager.enable_stats()
+                bot.whisper(source.username, 'Handler stats are now enabled.')
+                return True
+            elif argument == 'off':
+                HandlerManager.disable_stats()
+                bot.whisper(source.username, 'Handler stats are now disabled.')
+                return True
+            elif argument == 'reset':
+                HandlerManager.reset_stats()
+                bot.whisper(source.username, 'Handler stats have been reset.')
+                return True
+            event_name = argument
+
+        if HandlerManager.stats_enabled is False:
+            bot.whisper(source.username, 'Handler stats are disabled. Enable them with !handlerstats on')
+            return False
+
+        stats = HandlerManager.get_stats(event_name)[:5]
+        if len(stats) == 0:
+            bot.whisper(source.username, 'No handler stats have been recorded yet.')
+            return False
+
+        bot.whisper(source.username, ' | '.join(['{0} {1.name}: {1.num_calls} calls, avg {1.avg_time:.2f}ms, max {1.max_time:.2f}ms'.format(stats_event, handler_stats) for stats_event, handler_stats in stats]))
+
+    def queue_stats(bot, source, message, event, args):
+        """ Whispers statistics about the outgoing message queue.
+        Usage: !queuestats """
+        stats = bot.connection_manager.get_stats()
+        bot.whisper(source.username, 'Queued: {queue_depth} (max {max_queue_depth}) | Sent: {num_sent} | Wait: avg {avg_wait_time:.2f}ms, max {max_wait_time:.2f}ms'.format(**stats))
+
     def level(bot, source, message, event, args):
         if message:
             msg_args = message.split(' ')
@@ -559,8 +609,14 @@ class Dispatch:
     def top3(bot, source, message, event, args):
         """Prints out the top 3 chatters"""
         users = []
-        for user in bot.users.db_session.query(User).order_by(desc(User.num_lines))[:3]:
-            users.append('{user.username_raw} ({user.num_lines})'.format(user=user))
+        top_users = LeaderboardManager.get_top('num_lines', 3)
+        if top_users is None:
+            for user in bot.users.db_session.query(User).order_by(desc(User.num_lines))[:3]:
+                users.append('{user.username_raw} ({user.num_lines})'.format(user=user))
+        else:
+            for username, num_lines in top_users:
+                user = bot.users.find(username)
+                users.append('{0} ({1})'.format(user.username_raw if user else username, num_lines))
 
         bot.say('Top 3: {0}'.format(', '.join(users)))
 
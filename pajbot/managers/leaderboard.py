@@ -0,0 +1,210 @@
+import logging
+
+from pajbot.managers.redis import RedisManager
+from pajbot.streamhelper import StreamHelper
+
+log = logging.getLogger('pajbot')
+
+# Replaces the leaderboards with the rebuilt ones, after applying the updates
+# that were made while they were rebuilt. See LeaderboardManager.rebuild
+# KEYS are (rebuilt leaderboard, updates, leaderboard) triples.
+REPLACE_LEADERBOARDS_SCRIPT = """
+for i = 1, #KEYS, 3 do
+    local new_key, updates_key, key = KEYS[i], KEYS[i + 1], KEYS[i + 2]
+    local updates = redis.call('ZRANGE', updates_key, 0, -1, 'WITHSCORES')
+    for j = 1, #updates, 2 do
+        redis.call('ZADD', new_key, updates[j + 1], updates[j])
+    end
+    if redis.call('EXISTS', new_key) == 1 then
+        redis.call('RENAME', new_key, key)
+    else
+        redis.call('DEL', key)
+    end
+    redis.call('DEL', updates_key)
+end
+return 0
+"""
+
+RedisManager.register_script('replace_leaderboards', REPLACE_LEADERBOARDS_SCRIPT)
+
+
+class LeaderboardManager:
+    """
+    Keeps leaderboards of all users in Redis sorted sets (username -> score),
+    so ranks and top lists can be looked up in O(log n) by both the bot and
+    the web app.
+
+    The bot keeps the leaderboards up to date as it writes user counters
+    (see UserCounterWriter), and they can be rebuilt from the database with
+    rebuild().
+    """
+
+    LEADERBOARDS = ('points', 'num_lines', 'minutes_in_chat')
+
+    # True while rebuild() is running, updates are then recorded for the rebuilt leaderboards as well
+    rebuilding = False
+
+    def get_key(leaderboard):
+        return '{streamer}:leaderboard:{leaderboard}'.format(
+                streamer=StreamHelper.get_streamer(), leaderboard=leaderboard)
+
+    def get_rebuild_key(leaderboard):
+        return LeaderboardManager.get_key(leaderboard) + ':rebuild'
+
+    def get_updates_key(leaderboard):
+        return LeaderboardManager.get_key(leaderboard) + ':rebuild:updates'
+
+    def get_user_scores(user):
+        """ Returns a dict of leaderboard -> score for the given User """
+        return {
+                'points': user.points,
+                'num_lines': user.num_lines,
+                'minutes_in_chat': user.minutes_in_chat_online + user.minutes_in_chat_offline,
+                }
+
+    def select_scores():
+        """ Returns a select of the username and the scores in each leaderboard of all users """
+        from pajbot.models.user import User
+        from sqlalchemy import select
+
+        table = User.__table__
+        return select([
+            table.c.username,
+            table.c.points,
+            table.c.num_lines,
+            (table.c.minutes_in_chat_online + table.c.minutes_in_chat_offline).label('minutes_in_chat'),
+            ])
+
+    def get_row_scores(row):
+        """ Returns a dict of leaderboard -> score for a row from select_scores() """
+        return {leaderboard: row[leaderboard] for leaderboard in LeaderboardManager.LEADERBOARDS}
+
+    def exists(redis=None):
+        if redis is None:
+            redis = RedisManager.get()
+
+        return redis.exists(*[LeaderboardManager.get_key(leaderboard) for leaderboard in LeaderboardManager.LEADERBOARDS]) == len(LeaderboardManager.LEADERBOARDS)
+
+    def update(scores, redis=None):
+        """
+        Updates the scores of the given users.
+        scores is a dict of username -> dict of leaderboard -> score.
+        """
+
+        if len(scores) == 0:
+            return
+
+        if redis is None:
+            redis = RedisManager.get()
+
+        mappings = {}
+        for username, user_scores in scores.items():
+            for leaderboard, score in user_scores.items():
+                mappings.setdefault(leaderboard, {})[username] = score
+
+        pipeline = redis.pipeline(transaction=False)
+        for leaderboard, mapping in mappings.items():
+            pipeline.zadd(LeaderboardManager.get_key(leaderboard), mapping)
+            if LeaderboardManager.rebuilding:
+                pipeline.zadd(LeaderboardManager.get_updates_key(leaderboard), mapping)
+        pipeline.execute()
+
+    def get_rank(leaderboard, username, score, redis=None):
+        """
+        Returns the rank of the given user with the given score, that is 1 +
+        the number of users with a higher score.
+        The given score is used instead of the one in the leaderboard,
+        since the leaderboard might not be up to date with it yet.
+
+        Returns None if the leaderboard doesn't exist. See rebuild()
+        """
+
+        if redis is None:
+            redis = RedisManager.get()
+
+        key = LeaderboardManager.get_key(leaderboard)
+
+        pipeline = redis.pipeline(transaction=False)
+        pipeline.exists(key)
+        pipeline.zcount(key, '({0}'.format(score), '+inf')
+        pipeline.zscore(key, username)
+        exists, num_higher, old_score = pipeline.execute()
+
+        if not exists:
+            return None
+
+        if old_score is not None and float(old_score) > score:
+            # Don't count the user's own old score
+            num_higher -= 1
+
+        return num_higher + 1
+
+    def get_top(leaderboard, num_users, redis=None):
+        """
+        Returns a list of (username, score) tuples of the `num_users` users
+        with the highest scores, highest score first.
+        Returns None if the leaderboard doesn't exist. See rebuild()
+        """
+
+        if redis is None:
+            redis = RedisManager.get()
+
+        key = LeaderboardManager.get_key(leaderboard)
+        if not redis.exists(key):
+            return None
+
+        return redis.zrevrange(key, 0, num_users - 1, withscores=True, score_cast_func=int)
+
+    def rebuild(redis=None, chunk_size=5000):
+        """
+        Rebuilds all leaderboards from the database.
+        The new leaderboards replace the old ones once they're complete.
+
+        Updates made while the leaderboards are rebuilt might be missing
+        from (or older than) the rows we read, so they're recorded
+        separately and applied to the new leaderboards before they replace
+        the old ones. Only updates made from this process are recorded.
+
+        Returns the number of users in the leaderboards.
+        """
+
+        from pajbot.models.db import DBManager
+
+        if redis is None:
+            redis = RedisManager.get()
+
+        log.info('Rebuilding leaderboards...')
+
+        keys = {leaderboard: LeaderboardManager.get_key(leaderboard) for leaderboard in LeaderboardManager.LEADERBOARDS}
+        new_keys = {leaderboard: LeaderboardManager.get_rebuild_key(leaderboard) for leaderboard in LeaderboardManager.LEADERBOARDS}
+        updates_keys = {leaderboard: LeaderboardManager.get_updates_key(leaderboard) for leaderboard in LeaderboardManager.LEADERBOARDS}
+        redis.delete(*(list(new_keys.values()) + list(updates_keys.values())))
+
+        LeaderboardManager.rebuilding = True
+        try:
+            num_users = 0
+            result = DBManager.engine.execution_options(stream_results=True).execute(LeaderboardManager.select_scores())
+            try:
+                while True:
+                    rows = result.fetchmany(chunk_size)
+                    if len(rows) == 0:
+                        break
+
+                    pipeline = redis.pipeline(transaction=False)
+                    for leaderboard in LeaderboardManager.LEADERBOARDS:
+                        pipeline.zadd(new_keys[leaderboard], {row['username']: row[leaderboard] for row in rows})
+                    pipeline.execute()
+                    num_users += len(rows)
+            finally:
+                result.close()
+
+            script_keys = []
+            for leaderboard in LeaderboardManager.LEADERBOARDS:
+                script_keys += [new_keys[leaderboard], updates_keys[leaderboard], keys[leaderboard]]
+            RedisManager.run_script('replace_leaderboards', keys=script_keys, redis=redis)
+        finally:
+            LeaderboardManager.rebuilding = False
+
+        log.info('Rebuilt leaderboards with {0} users'.format(num_users))
+
+        return num_users
@@ -9,12 +9,42 @@ class RedisManager:
 
     redis = None
 
+    # name -> Lua source of the scripts registered with register_script
+    script_sources = {}
+    # name -> Script objects of the registered scripts, for the current redis instance
+    scripts = {}
+
     def init(**options):
         default_options = {
                 'decode_responses': True,
                 }
         default_options.update(options)
         RedisManager.redis = redis.Redis(**default_options)
+        RedisManager.scripts = {}
 
     def get():
         return RedisManager.redis
+
+    def register_script(name, script):
+        """
+        Registers the given Lua script under the given name, so it can be run
+        with run_script. The script is only sent to Redis once, after that
+        it's run by its SHA1 hash.
+        """
+
+        RedisManager.script_sources[name] = script
+        RedisManager.scripts.pop(name, None)
+
+    def run_script(name, keys=[], args=[], redis=None):
+        """
+        Runs the registered script with the given name in a single round trip.
+        redis can be a pipeline, in which case the script is run when the
+        pipeline is executed.
+        """
+
+        script = RedisManager.scripts.get(name, None)
+        if script is None or script.registered_client is not RedisManager.redis:
+            script = RedisManager.redis.register_script(RedisManager.script_sources[name])
+            RedisManager.scripts[name] = script
+
+        return script(keys=keys, args=args, client=redis)
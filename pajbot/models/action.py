@@ -11,19 +11,60 @@ log = logging.getLogger('pajbot')
 class ActionParser:
     bot = None
 
+    # raw action JSON -> parsed action, for the actions that can be shared
+    cache = {}
+    # The bot the cached actions were parsed for
+    cache_bot = None
+
+    dispatch = None
+
+    def get_dispatch():
+        """ Returns the class whose methods func actions call, which is UserDispatch if it exists """
+        if ActionParser.dispatch is None:
+            try:
+                from pajbot.userdispatch import UserDispatch
+                ActionParser.dispatch = UserDispatch
+            except ImportError:
+                from pajbot.dispatch import Dispatch
+                ActionParser.dispatch = Dispatch
+            except:
+                from pajbot.dispatch import Dispatch
+                ActionParser.dispatch = Dispatch
+                log.exception('Something went wrong while attemting to import UserDispatch')
+
+        return ActionParser.dispatch
+
     def parse(raw_data=None, data=None):
+        """ Parses an action from its JSON, or from the already decoded data.
+        Actions parsed from JSON are cached by the JSON, except multi actions
+        since those keep their own commands. """
+
+        if data:
+            return ActionParser.parse_data(data)
+
+        if ActionParser.cache_bot is not ActionParser.bot:
+            # Message actions are compiled with the bot's methods
+            ActionParser.cache = {}
+            ActionParser.cache_bot = ActionParser.bot
+
         try:
-            from pajbot.userdispatch import UserDispatch
-            Dispatch = UserDispatch
-        except ImportError:
-            from pajbot.dispatch import Dispatch
-        except:
-            from pajbot.dispatch import Dispatch
-            log.exception('Something went wrong while attemting to import UserDispatch')
+            return ActionParser.cache[raw_data]
+        except KeyError:
+            pass
+
+        data = json.loads(raw_data)
+        action = ActionParser.parse_data(data)
+        if action is None or action.type == 'multi':
+            return action
 
-        if not data:
-            data = json.loads(raw_data)
+        if action.type == 'message' and ActionParser.bot is not None and Substitution.method_mapping_bot is not ActionParser.bot:
+            # The bot wasn't fully loaded yet, so the action might be missing some substitutions
+            return action
 
+        ActionParser.cache[raw_data] = action
+        return action
+
+    def parse_data(data):
         if data['type'] == 'say':
             action = SayAction(data['message'], ActionParser.bot)
         elif data['type'] == 'me':
@@ -34,7 +75,7 @@ class ActionParser:
             action = ReplyAction(data['message'], ActionParser.bot)
         elif data['type'] == 'func':
             try:
-                action = FuncAction(getattr(Dispatch, data['cb']))
+                action = FuncAction(getattr(ActionParser.get_dispatch(), data['cb']))
             except AttributeError as e:
                 log.error('AttributeError caught when parsing action: {0}'.format(e))
                 return None
@@ -46,29 +87,130 @@ class ActionParser:
         return action
 
 
-def apply_substitutions(text, substitutions, bot, extra):
-    for needle, sub in substitutions.items():
-        if sub.key and sub.argument:
-            param = sub.key
-            extra['argument'] = MessageAction.get_argument_value(extra['message'], sub.argument - 1)
-        elif sub.key:
-            param = sub.key
-        elif sub.argument:
-            param = MessageAction.get_argument_value(extra['message'], sub.argument - 1)
-        else:
-            log.error('Unknown param for response.')
-            continue
-        value = sub.cb(param, extra)
-        try:
+class ResponseTemplate:
+    """
+    A response compiled into a list of segments, which are either literal
+    strings or slots for the value of a substitution or a message argument.
+    A needle that occurs more than once becomes one slot per occurrence,
+    but its substitution is only evaluated once per response.
+
+    Responses used to be built by replacing one needle at a time, so a
+    needle could also be replaced inside the value of an earlier one (e.g.
+    a chatter typing "$(2)" as the first argument). Every needle starts
+    with "$(", so if the response or any of the values could form one,
+    the response is built that way instead. See render_sequentially.
+    """
+
+    LITERAL = 0
+    SUBSTITUTION = 1
+    ARGUMENT = 2
+
+    def __init__(self, response, subs, argument_subs, bot):
+        self.response = response
+        self.needles = list(subs)
+        self.subs = list(subs.values())
+        self.argument_needles = [(sub.needle, sub.argument - 1) for sub in argument_subs]
+
+        # Look up the filter functions once, instead of on every substitution
+        self.filters = []
+        for sub in self.subs:
             if sub.filter is not None:
-                value = bot.apply_filter(value, sub.filter)
-        except:
-            log.exception('Exception caught in filter application')
-        if value is None:
-            return None
-        text = text.replace(needle, str(value))
+                self.filters.append((bot.get_filter(sub.filter.name), sub.filter.arguments))
+            else:
+                self.filters.append((None, None))
+
+        # The substitutions claim their needles first and then the arguments,
+        # in the same order they used to be replaced in the response
+        slots = [(needle, (ResponseTemplate.SUBSTITUTION, index)) for index, needle in enumerate(subs)]
+        slots += [(sub.needle, (ResponseTemplate.ARGUMENT, sub.argument - 1)) for sub in argument_subs]
+
+        segments = [(ResponseTemplate.LITERAL, response)]
+        for needle, slot in slots:
+            new_segments = []
+            for segment in segments:
+                if segment[0] != ResponseTemplate.LITERAL:
+                    new_segments.append(segment)
+                    continue
+
+                parts = segment[1].split(needle)
+                new_segments.append((ResponseTemplate.LITERAL, parts[0]))
+                for part in parts[1:]:
+                    new_segments.append(slot)
+                    new_segments.append((ResponseTemplate.LITERAL, part))
+            segments = new_segments
+
+        self.segments = [segment for segment in segments if segment != (ResponseTemplate.LITERAL, '')]
+
+        # A needle that wasn't claimed, or the start of one next to a slot, could turn
+        # into a needle once the values are filled in
+        self.rescan = any('$(' in value or value.endswith('$') for segment_type, value in segments if segment_type == ResponseTemplate.LITERAL)
+
+    def render(self, extra):
+        """ Returns the response with all substitutions and arguments filled in,
+        or None if any of the substitutions had no value. """
+
+        msg_parts = None
+        values = []
+        for sub, (filter_func, filter_arguments) in zip(self.subs, self.filters):
+            if sub.argument:
+                if msg_parts is None:
+                    msg_parts = MessageAction.split_message(extra['message'])
+                argument = MessageAction.get_message_part(msg_parts, sub.argument - 1)
+
+            if sub.key and sub.argument:
+                param = sub.key
+                extra['argument'] = argument
+            elif sub.key:
+                param = sub.key
+            elif sub.argument:
+                param = argument
+            else:
+                log.error('Unknown param for response.')
+                # The needle is left as it is
+                values.append(sub.needle)
+                continue
+
+            value = sub.cb(param, extra)
+            try:
+                if filter_func is not None:
+                    value = filter_func(value, filter_arguments)
+            except:
+                log.exception('Exception caught in filter application')
+            if value is None:
+                return None
+            values.append(str(value))
+
+        if self.rescan or any('$' in value for value in values) or \
+                (len(self.argument_needles) > 0 and extra['message'] and '$' in extra['message']):
+            return self.render_sequentially(values, extra)
+
+        resp = []
+        for segment_type, value in self.segments:
+            if segment_type == ResponseTemplate.LITERAL:
+                resp.append(value)
+            elif segment_type == ResponseTemplate.SUBSTITUTION:
+                resp.append(values[value])
+            else:
+                if msg_parts is None:
+                    msg_parts = MessageAction.split_message(extra['message'])
+                resp.append(MessageAction.get_message_part(msg_parts, value))
+
+        return ''.join(resp)
 
-    return text
+    def render_sequentially(self, values, extra):
+        """ Replaces one needle at a time with its value, in the order of the
+        substitutions and then the arguments, the way responses used to be built """
+
+        resp = self.response
+        for needle, value in zip(self.needles, values):
+            resp = resp.replace(needle, value)
+
+        if len(self.argument_needles) > 0:
+            msg_parts = MessageAction.split_message(extra['message'])
+            for needle, index in self.argument_needles:
+                resp = resp.replace(needle, MessageAction.get_message_part(msg_parts, index))
+
+        return resp
 
 
 class IfSubstitution:
@@ -87,10 +229,10 @@ class IfSubstitution:
                 return self.get_false_response(extra)
 
     def get_true_response(self, extra):
-        return apply_substitutions(self.true_response, self.true_subs, self.bot, extra)
+        return self.true_template.render(extra)
 
     def get_false_response(self, extra):
-        return apply_substitutions(self.false_response, self.false_subs, self.bot, extra)
+        return self.false_template.render(extra)
 
     def __init__(self, key, arguments, bot):
         self.bot = bot
@@ -108,12 +250,20 @@ class IfSubstitution:
 
         self.true_subs = get_substitutions(self.true_response, bot)
         self.false_subs = get_substitutions(self.false_response, bot)
+        # Arguments in the responses are left to the message action, which
+        # replaces them after the if substitution has been replaced
+        self.true_template = ResponseTemplate(self.true_response, self.true_subs, [], bot)
+        self.false_template = ResponseTemplate(self.false_response, self.false_subs, [], bot)
 
 
 class Substitution:
     argument_substitution_regex = re.compile(r'\$\((\d+)\)')
     substitution_regex = re.compile(r'\$\(([a-z_]+)(\;[0-9]+)?(\:[\w\.\/ ]+|\:\$\([\w_:\._\/ ]+\))?(\|[\w]+(\([\w%:/ +-]+\))?)?(\,[\'"]{1}[\w $;_\-:()\.]+[\'"]{1}){0,2}\)')
 
+    # The method mapping of the last bot passed to get_method_mapping
+    method_mapping = {}
+    method_mapping_bot = None
+
     def __init__(self, cb, needle, key=None, argument=None, filter=None):
         self.cb = cb
         self.key = key
@@ -278,6 +428,42 @@ def get_substitution_arguments(sub_key):
     return sub_string, path, argument, key, filter, if_arguments
 
 
+def get_method_mapping(bot):
+    """
+    Returns a dictionary of substitution path -> method of the bot that returns its value.
+    The mapping is built once per bot, as soon as the bot has all of the managers it needs.
+    """
+
+    if Substitution.method_mapping_bot is bot:
+        return Substitution.method_mapping
+
+    method_mapping = {}
+    try:
+        method_mapping['kvi'] = bot.get_kvi_value
+        method_mapping['tb'] = bot.get_value
+        method_mapping['lasttweet'] = bot.get_last_tweet
+        method_mapping['etm'] = bot.get_emote_tm
+        method_mapping['ecount'] = bot.get_emote_count
+        method_mapping['etmrecord'] = bot.get_emote_tm_record
+        method_mapping['source'] = bot.get_source_value
+        method_mapping['user'] = bot.get_user_value
+        method_mapping['usersource'] = bot.get_usersource_value
+        method_mapping['time'] = bot.get_time_value
+        method_mapping['curdeck'] = bot.decks.action_get_curdeck
+        method_mapping['current_stream'] = bot.stream_manager.get_current_stream_value
+        method_mapping['last_stream'] = bot.stream_manager.get_last_stream_value
+        method_mapping['current_song'] = bot.get_current_song_value
+        method_mapping['args'] = bot.get_args_value
+        method_mapping['notify'] = bot.get_notify_value
+    except AttributeError:
+        # The bot isn't fully loaded yet, so we can't keep this mapping
+        return method_mapping
+
+    Substitution.method_mapping = method_mapping
+    Substitution.method_mapping_bot = bot
+    return method_mapping
+
+
 def get_substitutions(string, bot):
     """
     Returns a dictionary of `Substitution` objects thare are found in the passed `string`.
@@ -287,9 +473,10 @@ def get_substitutions(string, bot):
 
     substitutions = collections.OrderedDict()
 
-    for sub_key in Substitution.substitution_regex.finditer(string):
-        sub_string, path, argument, key, filter, if_arguments = get_substitution_arguments(sub_key)
+    sub_keys = [get_substitution_arguments(sub_key) for sub_key in Substitution.substitution_regex.finditer(string)]
 
+    # If substitutions go first, since their needles can contain other substitutions
+    for sub_string, path, argument, key, filter, if_arguments in sub_keys:
         if sub_string in substitutions:
             # We already matched this variable
             continue
@@ -305,30 +492,9 @@ def get_substitutions(string, bot):
         except:
             log.exception('BabyRage')
 
-    method_mapping = {}
-    try:
-        method_mapping['kvi'] = bot.get_kvi_value
-        method_mapping['tb'] = bot.get_value
-        method_mapping['lasttweet'] = bot.get_last_tweet
-        method_mapping['etm'] = bot.get_emote_tm
-        method_mapping['ecount'] = bot.get_emote_count
-        method_mapping['etmrecord'] = bot.get_emote_tm_record
-        method_mapping['source'] = bot.get_source_value
-        method_mapping['user'] = bot.get_user_value
-        method_mapping['usersource'] = bot.get_usersource_value
-        method_mapping['time'] = bot.get_time_value
-        method_mapping['curdeck'] = bot.decks.action_get_curdeck
-        method_mapping['current_stream'] = bot.stream_manager.get_current_stream_value
-        method_mapping['last_stream'] = bot.stream_manager.get_last_stream_value
-        method_mapping['current_song'] = bot.get_current_song_value
-        method_mapping['args'] = bot.get_args_value
-        method_mapping['notify'] = bot.get_notify_value
-    except AttributeError:
-        pass
-
-    for sub_key in Substitution.substitution_regex.finditer(string):
-        sub_string, path, argument, key, filter, if_arguments = get_substitution_arguments(sub_key)
+    method_mapping = get_method_mapping(bot)
 
+    for sub_string, path, argument, key, filter, if_arguments in sub_keys:
         if sub_string in substitutions:
             # We already matched this variable
             continue
@@ -351,32 +517,24 @@ class MessageAction(BaseAction):
         else:
             self.argument_subs = []
             self.subs = {}
+        self.template = ResponseTemplate(self.response, self.subs, self.argument_subs, bot)
 
-    def get_argument_value(message, index):
+    def split_message(message):
         if not message:
-            return ''
-        msg_parts = message.split(' ')
+            return []
+        return message.split(' ')
+
+    def get_message_part(msg_parts, index):
         try:
             return msg_parts[index]
-        except:
-            pass
-        return ''
-
-    def get_response(self, bot, extra):
-        resp = self.response
-
-        resp = apply_substitutions(resp, self.subs, bot, extra)
-
-        if resp is None:
-            return None
+        except IndexError:
+            return ''
 
-        for sub in self.argument_subs:
-            needle = sub.needle
-            value = str(MessageAction.get_argument_value(extra['message'], sub.argument - 1))
-            resp = resp.replace(needle, value)
-            log.debug('Replacing {0} with {1}'.format(needle, value))
+    def get_argument_value(message, index):
+        return MessageAction.get_message_part(MessageAction.split_message(message), index)
 
-        return resp
+    def get_response(self, bot, extra):
+        return self.template.render(extra)
 
     def get_extra_data(self, source, message, args):
         ret = {
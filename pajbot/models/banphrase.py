@@ -5,6 +5,7 @@ from collections import UserDict
 import argparse
 import datetime
 import re
+import collections
 
 from pajbot.tbutil import find
 from pajbot.models.db import DBManager, Base
@@ -163,11 +164,222 @@ class BanphraseData(Base):
         self.added_by = options.get('added_by', self.added_by)
         self.edited_by = options.get('edited_by', self.edited_by)
 
+class PhraseTrie:
+    """
+    A trie of phrases that can be searched either anchored at the start of
+    a string (search_prefix) or anywhere in the string (search), the latter
+    using the Aho-Corasick algorithm so the message is only scanned once.
+
+    Every phrase is stored together with a key, and searching returns the
+    set of keys whose phrase was found.
+    The failure links used by search are rebuilt lazily after the trie
+    has been modified.
+    """
+
+    def __init__(self):
+        self.goto = [{}]
+        self.outputs = [set()]
+        self.num_phrases = 0
+        self.fail = None
+        self.matches = None
+
+    def add(self, phrase, key):
+        node = 0
+        for char in phrase:
+            next_node = self.goto[node].get(char, None)
+            if next_node is None:
+                next_node = len(self.goto)
+                self.goto.append({})
+                self.outputs.append(set())
+                self.goto[node][char] = next_node
+            node = next_node
+
+        if key not in self.outputs[node]:
+            self.outputs[node].add(key)
+            self.num_phrases += 1
+        self.fail = None
+
+    def remove(self, phrase, key):
+        node = 0
+        for char in phrase:
+            node = self.goto[node].get(char, None)
+            if node is None:
+                return
+
+        if key in self.outputs[node]:
+            self.outputs[node].remove(key)
+            self.num_phrases -= 1
+        self.fail = None
+
+    def build(self):
+        """ Build the failure links and the merged output sets for search() """
+        fail = [0] * len(self.goto)
+        matches = [None] * len(self.goto)
+        matches[0] = frozenset(self.outputs[0])
+
+        queue = collections.deque()
+        for node in self.goto[0].values():
+            queue.append(node)
+
+        while queue:
+            node = queue.popleft()
+            matches[node] = frozenset(self.outputs[node] | matches[fail[node]])
+            for char, next_node in self.goto[node].items():
+                state = fail[node]
+                while state and char not in self.goto[state]:
+                    state = fail[state]
+                fail[next_node] = self.goto[state].get(char, 0)
+                queue.append(next_node)
+
+        self.fail = fail
+        self.matches = matches
+
+    def search(self, string):
+        """ Returns the keys of all phrases that occur anywhere in string """
+        if self.fail is None:
+            self.build()
+
+        goto = self.goto
+        fail = self.fail
+        matches = self.matches
+
+        found = set(matches[0])
+        state = 0
+        for char in string:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if matches[state]:
+                found.update(matches[state])
+
+        return found
+
+    def search_prefix(self, string):
+        """ Returns the keys of all phrases that string starts with """
+        goto = self.goto
+        outputs = self.outputs
+
+        found = set(outputs[0])
+        node = 0
+        for char in string:
+            node = goto[node].get(char, None)
+            if node is None:
+                break
+            if outputs[node]:
+                found.update(outputs[node])
+
+        return found
+
+
+class BanphraseMatcher:
+    """
+    Finds all banphrases that match a message in a single pass over the
+    message, instead of running every banphrase predicate one by one.
+
+    Banphrases are split up by operator and case-sensitiveness.
+    `contains` banphrases are searched for anywhere in the message,
+    `startswith` banphrases are matched anchored at the start of the message
+    and `endswith` banphrases are matched anchored at the end of the
+    (reversed) message.
+
+    Every banphrase is given a rank when it is added, so the matches can be
+    returned in the same order as the banphrases were added.
+    """
+
+    OPERATORS = ('contains', 'startswith', 'endswith')
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.tries = {}
+        for case_sensitive in (True, False):
+            for operator in self.OPERATORS:
+                self.tries[(case_sensitive, operator)] = PhraseTrie()
+
+        # banphrase -> (rank, trie, phrase as stored in the trie)
+        self.entries = {}
+        # rank -> banphrase
+        self.ranks = {}
+        self.next_rank = 0
+
+    def build(self, banphrases):
+        self.clear()
+        for banphrase in banphrases:
+            self.add(banphrase)
+
+    def add(self, banphrase, rank=None):
+        if banphrase in self.entries:
+            self.remove(banphrase)
+
+        if banphrase.operator not in self.OPERATORS:
+            log.warn('Unknown banphrase operator "{}" for banphrase {}'.format(banphrase.operator, banphrase.id))
+            return
+
+        if rank is None:
+            rank = self.next_rank
+            self.next_rank += 1
+
+        phrase = banphrase.phrase if banphrase.case_sensitive else banphrase.phrase.lower()
+        if banphrase.operator == 'endswith':
+            phrase = phrase[::-1]
+
+        trie = self.tries[(banphrase.case_sensitive is True, banphrase.operator)]
+        trie.add(phrase, rank)
+
+        self.entries[banphrase] = (rank, trie, phrase)
+        self.ranks[rank] = banphrase
+
+    def update(self, banphrase):
+        """ Refresh the banphrase after its phrase or options have changed,
+        keeping its position among the other banphrases. """
+        if banphrase not in self.entries:
+            self.add(banphrase)
+            return
+
+        rank = self.entries[banphrase][0]
+        self.remove(banphrase)
+        self.add(banphrase, rank=rank)
+
+    def remove(self, banphrase):
+        entry = self.entries.pop(banphrase, None)
+        if entry is None:
+            return
+
+        rank, trie, phrase = entry
+        trie.remove(phrase, rank)
+        del self.ranks[rank]
+
+    def match(self, message):
+        """ Returns a list of all banphrases that match the message,
+        in the order they were added. """
+        if len(self.entries) == 0:
+            return []
+
+        message_lower = message.lower()
+        found = set()
+
+        for (case_sensitive, operator), trie in self.tries.items():
+            if trie.num_phrases == 0:
+                continue
+
+            string = message if case_sensitive else message_lower
+            if operator == 'contains':
+                found |= trie.search(string)
+            elif operator == 'startswith':
+                found |= trie.search_prefix(string)
+            else:
+                found |= trie.search_prefix(reversed(string))
+
+        return [self.ranks[rank] for rank in sorted(found)]
+
+
 class BanphraseManager:
     def __init__(self, bot):
         self.bot = bot
         self.banphrases = []
         self.enabled_banphrases = []
+        self.matcher = BanphraseMatcher()
         self.db_session = DBManager.create_session(expire_on_commit=False)
 
         if self.bot:
@@ -197,12 +409,16 @@ class BanphraseManager:
         if updated_banphrase:
             if updated_banphrase not in self.banphrases:
                 self.banphrases.append(updated_banphrase)
-            if updated_banphrase.enabled is True and updated_banphrase not in self.enabled_banphrases:
-                self.enabled_banphrases.append(updated_banphrase)
-
-        for banphrase in self.enabled_banphrases:
-            if banphrase.enabled is False:
-                self.enabled_banphrases.remove(banphrase)
+            if updated_banphrase.enabled is True:
+                if updated_banphrase not in self.enabled_banphrases:
+                    self.enabled_banphrases.append(updated_banphrase)
+                    self.matcher.add(updated_banphrase)
+                else:
+                    self.matcher.update(updated_banphrase)
+
+        for banphrase in [banphrase for banphrase in self.enabled_banphrases if banphrase.enabled is False]:
+            self.enabled_banphrases.remove(banphrase)
+            self.matcher.remove(banphrase)
 
     def on_banphrase_remove(self, data, conn):
         try:
@@ -218,6 +434,7 @@ class BanphraseManager:
 
             if removed_banphrase in self.enabled_banphrases:
                 self.enabled_banphrases.remove(removed_banphrase)
+                self.matcher.remove(removed_banphrase)
 
             if removed_banphrase in self.banphrases:
                 self.banphrases.remove(removed_banphrase)
@@ -227,6 +444,7 @@ class BanphraseManager:
         for banphrase in self.banphrases:
             self.db_session.expunge(banphrase)
         self.enabled_banphrases = [banphrase for banphrase in self.banphrases if banphrase.enabled is True]
+        self.matcher.build(self.enabled_banphrases)
         return self
 
     def commit(self):
@@ -247,13 +465,31 @@ class BanphraseManager:
 
         self.banphrases.append(banphrase)
         self.enabled_banphrases.append(banphrase)
+        self.matcher.add(banphrase)
 
         return banphrase, True
 
+    def edit_banphrase(self, banphrase, **options):
+        banphrase.set(**options)
+        DBManager.session_add_expunge(banphrase)
+        self.commit()
+
+        # The phrase, operator or case sensitivity might have changed
+        if banphrase.enabled is True:
+            if banphrase not in self.enabled_banphrases:
+                self.enabled_banphrases.append(banphrase)
+                self.matcher.add(banphrase)
+            else:
+                self.matcher.update(banphrase)
+        elif banphrase in self.enabled_banphrases:
+            self.enabled_banphrases.remove(banphrase)
+            self.matcher.remove(banphrase)
+
     def remove_banphrase(self, banphrase):
         self.banphrases.remove(banphrase)
         if banphrase in self.enabled_banphrases:
             self.enabled_banphrases.remove(banphrase)
+            self.matcher.remove(banphrase)
 
         self.db_session.expunge(banphrase.data)
         self.db_session.delete(banphrase)
@@ -293,8 +529,11 @@ class BanphraseManager:
             self.bot.whisper(user.username, notification_msg)
 
     def check_message(self, message, user):
-        match = find(lambda banphrase: banphrase.match(message, user), self.enabled_banphrases)
-        return match or False
+        for banphrase in self.matcher.match(message):
+            if banphrase.sub_immunity is True and user.subscriber is True:
+                continue
+            return banphrase
+        return False
 
     def find_match(self, message, id=None):
         match = None
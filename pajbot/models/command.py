@@ -1,6 +1,8 @@
 import json
 import time
+import math
 import logging
+import collections
 from collections import UserDict
 import argparse
 import datetime
@@ -8,6 +10,8 @@ import re
 
 from pajbot.tbutil import find
 from pajbot.models.db import DBManager, Base
+from pajbot.managers import RedisManager
+from pajbot.streamhelper import StreamHelper
 from pajbot.models.action import ActionParser, RawFuncAction
 
 from sqlalchemy import orm
@@ -152,6 +156,54 @@ class CommandExample(Base):
         return self
 
 
+class UserCooldowns:
+    """
+    Keeps track of when each user last ran a command.
+    Runs are remembered in the order they happened, and forgotten lazily
+    once they're older than the user cooldown, so we only keep track of
+    the users who have run the command recently.
+    """
+
+    def __init__(self):
+        # username -> when the user last ran the command
+        self.last_run = {}
+        # (run time, username) tuples, oldest first
+        self.runs = collections.deque()
+
+    def __len__(self):
+        return len(self.last_run)
+
+    def get(self, username, default=0):
+        return self.last_run.get(username, default)
+
+    def set(self, username, run_time, ttl):
+        """ Records that the user ran the command at run_time, and
+        forgets any runs that are more than ttl seconds old. """
+        self.purge(ttl, run_time)
+        self.last_run[username] = run_time
+        self.runs.append((run_time, username))
+
+    def purge(self, ttl, now=None):
+        """ Forgets runs that are more than ttl seconds old """
+        if now is None:
+            now = time.time()
+
+        while len(self.runs) > 0 and self.runs[0][0] <= now - ttl:
+            run_time, username = self.runs.popleft()
+            if self.last_run.get(username, None) == run_time:
+                # The user hasn't run the command since then
+                del self.last_run[username]
+
+    def items(self):
+        return self.last_run.items()
+
+    def update(self, last_run, ttl):
+        """ Records the runs in the given dict of username -> run time, i.e. from a snapshot """
+        for username, run_time in sorted(last_run.items(), key=lambda run: run[1]):
+            if run_time > self.last_run.get(username, 0):
+                self.set(username, run_time, ttl)
+
+
 class Command(Base):
     __tablename__ = 'tb_command'
 
@@ -213,7 +265,7 @@ class Command(Base):
         self.command = None
 
         self.last_run = 0
-        self.last_run_by_user = {}
+        self.last_run_by_user = UserCooldowns()
 
         self.data = None
 
@@ -251,7 +303,7 @@ class Command(Base):
     @orm.reconstructor
     def init_on_load(self):
         self.last_run = 0
-        self.last_run_by_user = {}
+        self.last_run_by_user = UserCooldowns()
         self.extra_args = {'command': self}
         self.action = ActionParser.parse(self.action_json)
         if self.extra_extra_args:
@@ -353,13 +405,25 @@ class Command(Base):
             # User does not have enough points to use the command
             return False
 
-        if self.tokens_cost > 0 and not source.can_afford_with_tokens(self.tokens_cost):
-            # User does not have enough tokens to use the command
-            return False
+        spent_tokens = None
+        if self.tokens_cost > 0:
+            # Take the tokens up front in a single atomic step, and give them back if the action fails
+            spent_tokens = source.take_tokens(self.tokens_cost)
+            if spent_tokens is None:
+                # User does not have enough tokens to use the command
+                return False
 
         args.update(self.extra_args)
-        ret = self.action.run(bot, source, message, event, args)
-        if ret is not False:
+        try:
+            ret = self.action.run(bot, source, message, event, args)
+        except:
+            if spent_tokens is not None:
+                source.refund_tokens(spent_tokens)
+            raise
+        if ret is False:
+            if spent_tokens is not None:
+                source.refund_tokens(spent_tokens)
+        else:
             # Only spend points/tokens, and increment num_uses if the action succeded
             if self.data is not None:
                 self.data.num_uses += 1
@@ -368,14 +432,11 @@ class Command(Base):
                 if not source.spend(self.cost):
                     # The user does not have enough points to spend!
                     log.warning('{0} used points he does not have.'.format(source.username))
-                    return False
-            if self.tokens_cost > 0:
-                if not source.spend_tokens(self.tokens_cost):
-                    # The user does not have enough tokens to spend!
-                    log.warning('{0} used tokens he does not have.'.format(source.username))
+                    if spent_tokens is not None:
+                        source.refund_tokens(spent_tokens)
                     return False
             self.last_run = cur_time
-            self.last_run_by_user[source.username] = cur_time
+            self.last_run_by_user.set(source.username, cur_time, self.delay_user)
 
     def autogenerate_examples(self):
         if len(self.examples) == 0 and self.id is not None and self.action.type == 'message':
@@ -420,6 +481,9 @@ class CommandManager(UserDict):
         self.db_commands = {}
         self.module_commands = {}
 
+        # module ID -> set of aliases the module had at the last rebuild
+        self.module_aliases = {}
+
         self.bot = bot
         self.module_manager = module_manager
 
@@ -429,8 +493,23 @@ class CommandManager(UserDict):
             socket_manager.add_handler('command.remove', self.on_command_remove)
 
     def on_module_reload(self, data, conn):
-        log.debug('Rebuilding commands...')
-        self.rebuild()
+        module_id = data.get('id', None)
+        if module_id is None or self.module_manager is None:
+            log.debug('Rebuilding commands...')
+            self.rebuild()
+            log.debug('Done rebuilding commands')
+            return
+
+        # The ModuleManager has already enabled, disabled or reloaded the module,
+        # so we rebuild the aliases it had before along with the ones it has now.
+        aliases = self.module_aliases.pop(module_id, set())
+        module = self.module_manager[module_id]
+        if module is not None:
+            self.module_aliases[module_id] = set(module.commands)
+            aliases |= self.module_aliases[module_id]
+
+        log.debug('Rebuilding {} command aliases for module {}...'.format(len(aliases), module_id))
+        self.rebuild(aliases)
         log.debug('Done rebuilding commands')
 
     def on_command_update(self, data, conn):
@@ -440,15 +519,19 @@ class CommandManager(UserDict):
             log.warn('No command ID found in on_command_update')
             return False
 
+        aliases = set()
         command = find(lambda command: command.id == command_id, self.db_commands.values())
         if command is not None:
+            aliases.update(command.command.split('|'))
             self.remove_command_aliases(command)
 
-        self.load_by_id(command_id)
+        command = self.load_by_id(command_id)
+        if command is not None:
+            aliases.update(command.command.split('|'))
 
         log.debug('Reloaded command with id {}'.format(command_id))
 
-        self.rebuild()
+        self.rebuild(aliases)
 
     def on_command_remove(self, data, conn):
         try:
@@ -467,7 +550,7 @@ class CommandManager(UserDict):
 
         log.debug('Remove command with id {}'.format(command_id))
 
-        self.rebuild()
+        self.rebuild(command.command.split('|'))
 
     def __del__(self):
         self.db_session.close()
@@ -501,6 +584,18 @@ class CommandManager(UserDict):
             level=0,
             description='Help',
             )
+        self.internal_commands['handlerstats'] = Command.dispatch_command('handler_stats',
+            level=1000,
+            description='Show how long the event handlers take',
+            )
+        self.internal_commands['queuestats'] = Command.dispatch_command('queue_stats',
+            level=1000,
+            description='Show how many messages are waiting to be sent and how long they wait',
+            )
+        self.internal_commands['rebuildleaderboards'] = Command.dispatch_command('rebuild_leaderboards',
+            level=1000,
+            description='Rebuild the points, lines and minutes in chat leaderboards from the database',
+            )
 
 
         return self.internal_commands
@@ -523,7 +618,7 @@ class CommandManager(UserDict):
         self.db_session.add(command.data)
         self.commit()
 
-        self.rebuild()
+        self.rebuild(command.command.split('|'))
         return command, True, ''
 
     def edit_command(self, command_to_edit, **options):
@@ -548,7 +643,7 @@ class CommandManager(UserDict):
             db_session.delete(command.data)
             db_session.delete(command)
 
-        self.rebuild()
+        self.rebuild(command.command.split('|'))
 
     def add_db_command_aliases(self, command):
         aliases = command.command.split('|')
@@ -584,37 +679,92 @@ class CommandManager(UserDict):
 
         return self.db_commands
 
-    def rebuild(self):
-        """ Rebuild the internal commands list from all sources.
+    def get_sources(self):
+        """ Returns the command sources in the order they are merged.
+        Later sources take precedence over earlier ones, except that
+        multi commands with the same alias are merged together.
 
         """
 
-        def merge_commands(in_dict, out):
-            for alias, command in in_dict.items():
-                if command.action:
-                    # Resets any previous modifications to the action.
-                    # Right now, the only thing this resets is the MultiAction
-                    # command list.
-                    command.action.reset()
-
-                if alias in out:
-                    if (command.action and command.action.type == 'multi' and
-                            out[alias].action and out[alias].action.type == 'multi'):
-                        out[alias].action += command.action
-                    else:
-                        out[alias] = command
-                else:
-                    out[alias] = command
-
-        self.data = {}
-        db_commands = {alias: command for alias, command in self.db_commands.items() if command.enabled is True}
-
-        merge_commands(self.internal_commands, self.data)
-        merge_commands(db_commands, self.data)
-
+        sources = [self.internal_commands, self.db_commands]
         if self.module_manager is not None:
-            for enabled_module in self.module_manager.modules:
-                merge_commands(enabled_module.commands, self.data)
+            sources += [enabled_module.commands for enabled_module in self.module_manager.modules]
+        return sources
+
+    def get_source_command(self, source, alias):
+        command = source.get(alias, None)
+        if source is self.db_commands and command is not None and command.enabled is not True:
+            return None
+        return command
+
+    def get_source_aliases(self, source, command):
+        """ Returns all aliases the given command has in the given source """
+        if source is self.db_commands:
+            return [alias for alias in command.command.split('|') if self.db_commands.get(alias, None) is command]
+        return [alias for alias, source_command in source.items() if source_command is command]
+
+    def merge_command(self, alias, command):
+        if command.action:
+            # Resets any previous modifications to the action.
+            # Right now, the only thing this resets is the MultiAction
+            # command list.
+            command.action.reset()
+
+        if alias in self.data:
+            if (command.action and command.action.type == 'multi' and
+                    self.data[alias].action and self.data[alias].action.type == 'multi'):
+                self.data[alias].action += command.action
+            else:
+                self.data[alias] = command
+        else:
+            self.data[alias] = command
+
+    def rebuild(self, aliases=None):
+        """ Rebuild the internal commands list from all sources.
+
+        If aliases is given, only those aliases are rebuilt, along with any
+        other aliases of the multi commands found under them, since the
+        action of a multi command is shared between all its aliases.
+
+        """
+
+        sources = self.get_sources()
+
+        if aliases is None:
+            self.data = {}
+            for source in sources:
+                for alias, command in source.items():
+                    if source is self.db_commands and command.enabled is not True:
+                        continue
+                    self.merge_command(alias, command)
+
+            if self.module_manager is not None:
+                self.module_aliases = {enabled_module.ID: set(enabled_module.commands) for enabled_module in self.module_manager.modules}
+            return
+
+        affected = []
+        seen = set()
+        to_check = list(aliases)
+        while len(to_check) > 0:
+            alias = to_check.pop()
+            if alias in seen:
+                continue
+            seen.add(alias)
+            affected.append(alias)
+
+            for source in sources:
+                command = self.get_source_command(source, alias)
+                if command is not None and command.action and command.action.type == 'multi':
+                    to_check += self.get_source_aliases(source, command)
+
+        for alias in affected:
+            self.data.pop(alias, None)
+
+        for source in sources:
+            for alias in affected:
+                command = self.get_source_command(source, alias)
+                if command is not None:
+                    self.merge_command(alias, command)
 
     def load(self, **options):
         self.load_internal_commands(**options)
@@ -635,6 +785,68 @@ class CommandManager(UserDict):
                 command.data = CommandData(command.id)
             self.db_session.add(command.data)
 
+        return command
+
+    def get_cooldowns_key(self, alias):
+        return '{streamer}:cooldowns:{alias}'.format(streamer=StreamHelper.get_streamer(), alias=alias)
+
+    def get_cooldown_aliases(self):
+        """ Returns a dict of command -> the alias its user cooldowns are
+        stored under in redis, which is its first alias in alphabetical order """
+        aliases = {}
+        for alias in sorted(self.data):
+            aliases.setdefault(self.data[alias], alias)
+        return aliases
+
+    def snapshot_cooldowns(self, redis=None):
+        """ Writes the user cooldowns of all commands to redis in one round trip,
+        so they can be restored with restore_cooldowns after a restart.
+        Each snapshot expires once all of its cooldowns have run out.
+
+        Returns the number of user cooldowns written. """
+
+        if redis is None:
+            redis = RedisManager.get()
+
+        now = time.time()
+        num_cooldowns = 0
+        pipeline = redis.pipeline(transaction=False)
+        for command, alias in self.get_cooldown_aliases().items():
+            key = self.get_cooldowns_key(alias)
+            command.last_run_by_user.purge(command.delay_user, now)
+            pipeline.delete(key)
+            if len(command.last_run_by_user) > 0:
+                pipeline.hmset(key, dict(command.last_run_by_user.items()))
+                pipeline.expire(key, math.ceil(command.delay_user))
+                num_cooldowns += len(command.last_run_by_user)
+        pipeline.execute()
+
+        return num_cooldowns
+
+    def restore_cooldowns(self, redis=None):
+        """ Restores the user cooldowns written by snapshot_cooldowns in one round trip.
+        Returns the number of user cooldowns restored. """
+
+        if redis is None:
+            redis = RedisManager.get()
+
+        aliases = self.get_cooldown_aliases()
+        pipeline = redis.pipeline(transaction=False)
+        for alias in aliases.values():
+            pipeline.hgetall(self.get_cooldowns_key(alias))
+
+        num_cooldowns = 0
+        for command, last_run in zip(aliases, pipeline.execute()):
+            try:
+                last_run = {username: float(run_time) for username, run_time in last_run.items()}
+            except ValueError:
+                log.warning('Invalid user cooldowns in redis for {0}'.format(aliases[command]))
+                continue
+            command.last_run_by_user.update(last_run, command.delay_user)
+            num_cooldowns += len(last_run)
+
+        return num_cooldowns
+
     def parse_for_web(self):
         list = []
 
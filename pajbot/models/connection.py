@@ -1,8 +1,9 @@
 import urllib
 import random
 import logging
-
-import pajbot.tbutil
+import collections
+import threading
+import time
 
 import irc
 from irc.client import InvalidCharacters, MessageTooLong, ServerNotConnectedError
@@ -45,19 +46,55 @@ class CustomServerConnection(irc.client.ServerConnection):
 
 
 class Connection:
-    def __init__(self, conn):
+    def __init__(self, conn, time_interval=31):
         self.conn = conn
-        self.num_msgs_sent = 0
         self.in_channel = False
 
+        # Send times (time.monotonic()) of the messages sent in the last
+        # `time_interval` seconds, oldest first.
+        self.time_interval = time_interval
+        self.sent_times = collections.deque()
+
         return
 
-    def reduce_msgs_sent(self):
-        self.num_msgs_sent -= 1
+    def expire_sent_times(self, now=None):
+        if now is None:
+            now = time.monotonic()
+
+        while len(self.sent_times) > 0 and self.sent_times[0] + self.time_interval <= now:
+            self.sent_times.popleft()
+
+    @property
+    def num_msgs_sent(self):
+        self.expire_sent_times()
+        return len(self.sent_times)
+
+    def add_sent_message(self, now=None):
+        if now is None:
+            now = time.monotonic()
+
+        self.sent_times.append(now)
+
+    def get_send_delay(self, message_limit, now=None):
+        """ Returns how many seconds we have to wait until this connection
+        can send another message without going over message_limit messages
+        in the last `time_interval` seconds. """
+        if now is None:
+            now = time.monotonic()
+
+        self.expire_sent_times(now)
+        if len(self.sent_times) < message_limit:
+            return 0
+
+        # Wait for the message that frees up a slot to leave the window
+        return self.sent_times[len(self.sent_times) - message_limit] + self.time_interval - now
 
 
 class ConnectionManager:
-    def __init__(self, reactor, bot, message_limit, streamer, backup_conns=2):
+    # How long to wait before trying again if no connection is connected
+    RETRY_DELAY = 2
+
+    def __init__(self, reactor, bot, message_limit, streamer, backup_conns=2, time_interval=31):
         self.backup_conns_number = backup_conns
         self.streamer = streamer
         self.channel = '#' + self.streamer
@@ -65,11 +102,27 @@ class ConnectionManager:
         self.reactor = reactor
         self.bot = bot
         self.message_limit = message_limit
+        self.time_interval = time_interval
 
         self.connlist = []
 
         self.maintenance_lock = False
 
+        # Outgoing messages that haven't been sent yet, in the order they
+        # were sent with privmsg: (channel, message, increase_message, queue time)
+        self.queue = collections.deque()
+        # Messages that don't count towards the message limit (i.e. moderation
+        # commands) are queued separately so they never wait behind messages
+        # that are waiting for room in the rate limit window.
+        self.unlimited_queue = collections.deque()
+        self.queue_lock = threading.Lock()
+        self.flush_scheduled = False
+
+        self.num_sent = 0
+        self.max_queue_depth = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
     def start(self):
         log.debug("Starting connection manager")
         try:
@@ -173,7 +226,7 @@ class ConnectionManager:
             newconn.cap('REQ', 'twitch.tv/commands')
             newconn.cap('REQ', 'twitch.tv/tags')
 
-            connection = Connection(newconn)
+            connection = Connection(newconn, self.time_interval)
             return connection
         except irc.client.ServerConnectionError:
             return
@@ -187,20 +240,122 @@ class ConnectionManager:
         return
 
     def privmsg(self, channel, message, increase_message=True):
-        if increase_message:
-            conn = pajbot.tbutil.find(lambda c: c.conn.is_connected() and c.num_msgs_sent < self.message_limit, self.connlist)
-        else:
-            conn = pajbot.tbutil.find(lambda c: c.conn.is_connected(), self.connlist)
-
-        if conn is None:
-            log.error('No available connections to send messages from. Delaying message a few seconds.')
-            self.reactor.execute_delayed(2, self.privmsg, (channel, message, increase_message))
-            return False
-
-        conn.conn.privmsg(channel, message)
-        if increase_message:
-            conn.num_msgs_sent += 1
-            self.reactor.execute_delayed(31, conn.reduce_msgs_sent)
-
-            if conn.num_msgs_sent >= self.message_limit:
-                self.run_maintenance()
+        """ Queues a message to be sent as soon as a connection is allowed
+        to send it. Messages that count towards the message limit are always
+        sent in the order they were queued, messages that don't are sent as
+        soon as any connection is available. """
+        with self.queue_lock:
+            queue = self.queue if increase_message else self.unlimited_queue
+            queue.append((channel, message, increase_message, time.monotonic()))
+            queue_depth = len(self.queue) + len(self.unlimited_queue)
+            if queue_depth > self.max_queue_depth:
+                self.max_queue_depth = queue_depth
+
+        return self.flush_queue()
+
+    def get_send_connection(self, increase_message, now):
+        """ Returns a tuple of the connection to send the next message from,
+        or None, and how many seconds to wait until one can send it. """
+        connections = [connection for connection in self.connlist if connection.conn.is_connected()]
+        if len(connections) == 0:
+            log.error('No available connections to send messages from. Delaying messages a few seconds.')
+            return None, self.RETRY_DELAY
+
+        if not increase_message:
+            return connections[0], 0
+
+        delays = [(connection.get_send_delay(self.message_limit, now), connection) for connection in connections]
+        delay, connection = min(delays, key=lambda d: d[0])
+        if delay > 0:
+            return None, delay
+
+        return connection, 0
+
+    def flush_queue(self):
+        """ Sends as many queued messages as the connections allow right now,
+        and schedules another flush for when the next one can be sent.
+        Returns True if the queue is empty afterwards. """
+        need_maintenance = False
+        flush_delay = None
+
+        with self.queue_lock:
+            for queue in (self.unlimited_queue, self.queue):
+                delay, queue_maintenance = self.send_queued(queue)
+                need_maintenance = need_maintenance or queue_maintenance
+                if delay is not None and not self.flush_scheduled:
+                    if flush_delay is None or delay < flush_delay:
+                        flush_delay = delay
+
+            if flush_delay is not None:
+                log.debug('Delaying {} messages for {:.2f} seconds'.format(len(self.queue) + len(self.unlimited_queue), flush_delay))
+                self.flush_scheduled = True
+
+            queue_empty = len(self.queue) == 0 and len(self.unlimited_queue) == 0
+
+        # The reactor holds its mutex while it runs handlers and delayed
+        # commands, and execute_delayed takes the same mutex, so it must not
+        # be called while we're holding the queue lock.
+        if flush_delay is not None:
+            self.reactor.execute_delayed(flush_delay, self.run_scheduled_flush)
+
+        if need_maintenance:
+            self.run_maintenance()
+
+        return queue_empty
+
+    def send_queued(self, queue):
+        """ Sends messages from the front of the given queue until it's empty
+        or the next message can't be sent yet. Must be called with the queue
+        lock held. Returns a tuple of how many seconds to wait until the next
+        message can be sent (or None if the queue was emptied) and whether the
+        connections need maintenance. """
+        need_maintenance = False
+
+        while len(queue) > 0:
+            channel, message, increase_message, queue_time = queue[0]
+            now = time.monotonic()
+            conn, delay = self.get_send_connection(increase_message, now)
+            if conn is None:
+                return delay, need_maintenance
+
+            queue.popleft()
+            try:
+                conn.conn.privmsg(channel, message)
+            except ServerNotConnectedError:
+                # Put the message back and try again once the maintenance has replaced the connection
+                log.warning('Connection lost while sending a message. Retrying in {} seconds.'.format(self.RETRY_DELAY))
+                queue.appendleft((channel, message, increase_message, queue_time))
+                return self.RETRY_DELAY, True
+            except (InvalidCharacters, MessageTooLong):
+                log.exception('Dropping message that could not be sent to {}: {}'.format(channel, message))
+                continue
+
+            wait_time = (now - queue_time) * 1000
+            self.num_sent += 1
+            self.total_wait_time += wait_time
+            if wait_time > self.max_wait_time:
+                self.max_wait_time = wait_time
+
+            if increase_message:
+                conn.add_sent_message(now)
+                if len(conn.sent_times) >= self.message_limit:
+                    need_maintenance = True
+
+        return None, need_maintenance
+
+    def run_scheduled_flush(self):
+        with self.queue_lock:
+            self.flush_scheduled = False
+
+        self.flush_queue()
+
+    def get_stats(self):
+        """ Returns a dict of statistics about the outgoing message queue.
+        All times are in milliseconds. """
+        return {
+                'queue_depth': len(self.queue) + len(self.unlimited_queue),
+                'max_queue_depth': self.max_queue_depth,
+                'num_sent': self.num_sent,
+                'avg_wait_time': self.total_wait_time / self.num_sent if self.num_sent > 0 else 0.0,
+                'max_wait_time': self.max_wait_time,
+                }
@@ -1,12 +1,19 @@
+import collections
 import logging
+import threading
+import time
 from contextlib import contextmanager
 
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm import scoped_session
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy import event
 from sqlalchemy import inspect
 
+from pajbot.actions import ActionQueue
+
 Base = declarative_base()
 
 log = logging.getLogger('pajbot')
@@ -102,3 +109,215 @@ class DBManager:
             log.debug('Detached:   {0.detached}'.format(inspected_object))
         except:
             log.exception('Uncaught exception in DBManager.debug')
+
+
+class DBWriter:
+    """
+    Commits the changes in our long-lived sessions without blocking the
+    thread they belong to.
+
+    commit() snapshots the changed columns of the modified objects in the
+    session, and writes them with bulk UPDATEs from our own thread, in a
+    session of its own. Only new and deleted objects are still flushed by
+    the session itself.
+
+    If writing a snapshot fails, its changes are written again along with
+    the next snapshot of the same session.
+
+    Sessions that have been committed through us can still be flushed and
+    committed directly (e.g. by UserManager.commit). Before such a flush
+    writes a row we haven't written yet, we wait for our thread to write
+    it, so an older snapshot never overwrites the newer value. See
+    on_before_flush.
+    """
+
+    def __init__(self):
+        # A single thread, so the snapshots are written in the order they were taken
+        self.action_queue = ActionQueue()
+        self.action_queue.start()
+
+        # Protects pending and failed_mappings
+        self.lock = threading.Lock()
+
+        # (mapper, identity) -> number of mappings of that row that haven't been written yet
+        self.pending = collections.Counter()
+
+        # name -> dict of mapper -> list of mappings that couldn't be written
+        self.failed_mappings = {}
+
+        self.watched_sessions = set()
+
+    @staticmethod
+    def get_identity(mapper, mapping):
+        return tuple(mapping[mapper.get_property_by_column(column).key] for column in mapper.primary_key)
+
+    @staticmethod
+    def snapshot(session):
+        """
+        Returns the changed columns of the modified (persistent) objects in
+        the session as a dict of mapper -> list of mappings, suitable for
+        Session.bulk_update_mappings.
+        The objects are marked as unchanged afterwards. Objects with other
+        changes (e.g. to a relationship) are left to the session.
+        """
+
+        mappings = {}
+        column_keys = {}
+        primary_key_keys = {}
+
+        for obj in session.dirty:
+            state = inspect(obj)
+            changed_keys = state.committed_state.keys()
+            if state.key is None or len(changed_keys) == 0:
+                continue
+
+            mapper = state.mapper
+            if mapper not in column_keys:
+                column_keys[mapper] = set(column_property.key for column_property in mapper.column_attrs)
+                primary_key_keys[mapper] = [mapper.get_property_by_column(column).key for column in mapper.primary_key]
+
+            if not column_keys[mapper].issuperset(changed_keys) or not state.dict.keys() >= changed_keys:
+                continue
+
+            mapping = {key: state.dict[key] for key in changed_keys}
+            mapping.update(zip(primary_key_keys[mapper], state.identity))
+            mappings.setdefault(mapper, []).append(mapping)
+
+            # Mark the columns as unchanged, so the session doesn't write them
+            for key in list(changed_keys):
+                set_committed_value(obj, key, state.dict[key])
+
+        return mappings
+
+    def watch(self, session):
+        """ Make sure direct flushes of the given session don't race with our thread """
+        if session in self.watched_sessions:
+            return
+
+        self.watched_sessions.add(session)
+        event.listen(session, 'before_flush', self.on_before_flush)
+
+    def on_before_flush(self, session, flush_context, instances):
+        """
+        Waits for our thread if the flush is about to write a row we
+        haven't written yet. The flush holds the locks of the rows it writes
+        until the session is committed, so this has to be done before the
+        flush, and not before the commit.
+
+        Changes that we failed to write are discarded for the columns the
+        flush writes, since the flush writes newer values.
+        """
+
+        # (mapper, identity) -> the columns the flush writes, or None if the row is deleted
+        flushed_columns = {}
+        for obj in session.dirty:
+            state = inspect(obj)
+            if state.key is not None and len(state.committed_state) > 0:
+                flushed_columns[(state.mapper, state.identity)] = set(state.committed_state)
+        for obj in session.deleted:
+            state = inspect(obj)
+            if state.key is not None:
+                flushed_columns[(state.mapper, state.identity)] = None
+
+        with self.lock:
+            is_pending = any(key in self.pending for key in flushed_columns)
+
+        if not is_pending:
+            return
+
+        self.wait()
+
+        with self.lock:
+            for name, mappings in list(self.failed_mappings.items()):
+                for mapper, mapper_mappings in list(mappings.items()):
+                    for mapping in list(mapper_mappings):
+                        key = (mapper, self.get_identity(mapper, mapping))
+                        if key not in flushed_columns:
+                            continue
+
+                        columns = flushed_columns[key]
+                        if columns is not None:
+                            for column in columns:
+                                mapping.pop(column, None)
+                        if columns is None or len(mapping) <= len(mapper.primary_key):
+                            mapper_mappings.remove(mapping)
+                            self.unmark_pending([key])
+
+                    if len(mapper_mappings) == 0:
+                        del mappings[mapper]
+                if len(mappings) == 0:
+                    del self.failed_mappings[name]
+
+    def unmark_pending(self, keys):
+        # Must be called with our lock held
+        self.pending.subtract(keys)
+        for key in set(keys):
+            if self.pending[key] <= 0:
+                del self.pending[key]
+
+    def commit(self, name, session):
+        """
+        Commits the given session. The changes to existing objects are
+        written by our thread, see snapshot().
+
+        The session is committed without expiring its objects, since they
+        would otherwise be reloaded from rows we might not have written yet.
+
+        Returns the number of objects whose changes will be written by our thread.
+        """
+
+        self.watch(session)
+
+        mappings = self.snapshot(session)
+
+        expire_on_commit = session.expire_on_commit
+        session.expire_on_commit = False
+        try:
+            session.commit()
+        finally:
+            session.expire_on_commit = expire_on_commit
+
+        with self.lock:
+            self.pending.update((mapper, self.get_identity(mapper, mapping))
+                    for mapper, mapper_mappings in mappings.items()
+                    for mapping in mapper_mappings)
+            has_failed_mappings = name in self.failed_mappings
+
+        num_rows = sum(len(mapper_mappings) for mapper_mappings in mappings.values())
+        if num_rows > 0 or has_failed_mappings:
+            self.action_queue.add(self.write, args=[name, mappings])
+
+        return num_rows
+
+    def write(self, name, mappings):
+        with self.lock:
+            failed_mappings = self.failed_mappings.pop(name, {})
+        if len(failed_mappings) > 0:
+            # The failed changes are older, so they're written first
+            for mapper, mapper_mappings in mappings.items():
+                failed_mappings.setdefault(mapper, []).extend(mapper_mappings)
+            mappings = failed_mappings
+
+        num_rows = sum(len(mapper_mappings) for mapper_mappings in mappings.values())
+        start_time = time.perf_counter()
+        try:
+            with DBManager.create_session_scope() as db_session:
+                for mapper, mapper_mappings in mappings.items():
+                    db_session.bulk_update_mappings(mapper, mapper_mappings)
+            log.debug('Wrote {0} changed rows for {1} in {2:.3f} ms'.format(num_rows, name, (time.perf_counter() - start_time) * 1000))
+        except:
+            log.exception('Unhandled exception while writing {0} changed rows for {1}, retrying with the next commit'.format(num_rows, name))
+            with self.lock:
+                self.failed_mappings[name] = mappings
+            return
+
+        with self.lock:
+            self.unmark_pending([(mapper, self.get_identity(mapper, mapping))
+                    for mapper, mapper_mappings in mappings.items()
+                    for mapping in mapper_mappings])
+
+    def wait(self, timeout=None):
+        """ Blocks until every snapshot taken so far has been written """
+        done = threading.Event()
+        self.action_queue.add(done.set)
+        return done.wait(timeout)
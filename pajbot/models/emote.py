@@ -6,6 +6,7 @@ import json
 
 from pajbot.models.db import DBManager, Base
 from pajbot.apiwrappers import APIBase
+from pajbot.tbutil import SlidingWindowCounter
 
 from sqlalchemy import orm
 from sqlalchemy import Column, Integer, String, DateTime, ForeignKey
@@ -55,14 +56,11 @@ class Emote(Base):
     def tm_record(self):
         return self.stats.tm_record if self.stats is not None else 0
 
-    def add(self, count, reactor):
+    def add(self, count):
         if self.stats is None:
-            self.stats = self.manager.db_session.query(EmoteStats).filter_by(emote_code=self.code).one_or_none()
-            if self.stats is None:
-                self.stats = EmoteStats(self.code)
-                self.manager.db_session.add(self.stats)
+            self.manager.create_stats(self)
 
-        self.stats.add(count, reactor)
+        self.stats.add(count)
 
 
 class EmoteStats(Base):
@@ -79,24 +77,24 @@ class EmoteStats(Base):
         self.tm_record_date = None
         self.count = 0
 
-        self.tm = 0
+        self.tm_counter = SlidingWindowCounter(window=60, num_buckets=60)
 
     @orm.reconstructor
     def init_on_load(self):
-        self.tm = 0
+        self.tm_counter = SlidingWindowCounter(window=60, num_buckets=60)
 
-    def add(self, count, reactor):
+    @property
+    def tm(self):
+        """ Number of times the emote has been used in the last minute """
+        return self.tm_counter.get()
+
+    def add(self, count):
         self.count += count
-        self.tm += count
-        if self.tm > self.tm_record:
-            self.tm_record = self.tm
+        tm = self.tm_counter.add(count)
+        if tm > self.tm_record:
+            self.tm_record = tm
             self.tm_record_date = datetime.datetime.now()
 
-        reactor.execute_delayed(60, self.reduce, (count, ))
-
-    def reduce(self, count):
-        self.tm -= count
-
 
 class BTTVEmoteManager:
     def __init__(self, emote_manager):
@@ -124,6 +122,7 @@ class BTTVEmoteManager:
                 self.emote_manager.data[key].emote_hash = emote['emote_hash']
             else:
                 self.emote_manager.add_emote(**emote)
+        self.emote_manager.rebuild_custom_index()
         log.debug('Added {} emotes'.format(len(emotes)))
 
 
@@ -134,8 +133,13 @@ class EmoteManager(UserDict):
         self.streamer = bot.streamer
         self.db_session = DBManager.create_session()
         self.custom_data = []
+        self.custom_index = {}
+        self.custom_fallback = []
         self.bttv_emote_manager = BTTVEmoteManager(self)
 
+        # emote code -> EmoteStats, loaded in one query on reload
+        self.stats = {}
+
         self.bot.execute_delayed(5, self.bot.action_queue.add, (self.bttv_emote_manager.update_emotes, ))
         self.bot.execute_every(60 * 60 * 2, self.bot.action_queue.add, (self.bttv_emote_manager.update_emotes, ))
 
@@ -149,15 +153,84 @@ class EmoteManager(UserDict):
         self.data = {}
         self.custom_data = []
 
+        self.stats = {stats.emote_code: stats for stats in self.db_session.query(EmoteStats)}
+
         num_emotes = 0
         for emote in self.db_session.query(Emote):
             emote.manager = self
+            # Attach the stats we've already loaded, so the relationship isn't lazily loaded with one query per emote
+            orm.attributes.set_committed_value(emote, 'stats', self.stats.get(emote.code, None))
             num_emotes += 1
             self.add_to_data(emote)
 
+        self.rebuild_custom_index()
+
         log.info('Loaded {0} emotes'.format(num_emotes))
         return self
 
+    def create_stats(self, emote):
+        """ Attaches stats to an emote that had none.
+        New stats rows are inserted in one batch on the next commit,
+        instead of while we're parsing a message. """
+        stats = self.stats.get(emote.code, None)
+        if stats is None:
+            stats = EmoteStats(emote.code)
+            self.stats[emote.code] = stats
+            self.db_session.add(stats)
+
+        orm.attributes.set_committed_value(emote, 'stats', stats)
+
+    def rebuild_custom_index(self):
+        """ Rebuild the code -> custom emotes index used by match_custom_emotes.
+        Emotes whose code contains a space can never be a single token,
+        so those are still matched with their regex.
+
+        The new index is built on the side and swapped in at the end, since
+        match_custom_emotes might be using the old one from another thread. """
+        custom_index = {}
+        custom_fallback = []
+
+        for position, emote in enumerate(self.custom_data):
+            if not emote.code or ' ' in emote.code:
+                custom_fallback.append((position, emote))
+            else:
+                custom_index.setdefault(emote.code, []).append((position, emote))
+
+        self.custom_index = custom_index
+        self.custom_fallback = custom_fallback
+
+    def match_custom_emotes(self, message):
+        """
+        Finds all custom (BTTV) emotes in the message.
+        An emote is only matched if it's surrounded by spaces or the
+        start/end of the message.
+
+        Returns a list of (emote, spans) tuples, in the same order as the
+        emotes are in custom_data.
+        Each span is a (start, end) tuple where end is the index of the
+        last character of the emote.
+        """
+        found = {}
+        custom_index = self.custom_index
+        custom_fallback = self.custom_fallback
+
+        index = 0
+        for token in message.split(' '):
+            emotes = custom_index.get(token, None)
+            if emotes is not None:
+                for position, emote in emotes:
+                    if position not in found:
+                        found[position] = (emote, [])
+                    found[position][1].append((index, index + len(token) - 1))
+            index += len(token) + 1
+
+        for position, emote in custom_fallback:
+            spans = [(match.start(), match.end() - 1) for match in emote.regex.finditer(message)]
+            if len(spans) > 0:
+                found[position] = (emote, spans)
+
+        return [found[position] for position in sorted(found)]
+
     def add_emote(self, emote_id=None, emote_hash=None, code=None):
         emote = Emote(self, emote_id=emote_id, emote_hash=emote_hash, code=code)
         self.add_to_data(emote)
@@ -83,9 +83,9 @@ class Filter(Base):
         if not self.source or self.source == source:
             return self.regex.match(message)
 
-    def search(self, source, message):
+    def search(self, source, message, pos=0):
         if not self.source or self.source == source.username:
-            return self.regex.search(message)
+            return self.regex.search(message, pos)
 
         return None
 
@@ -96,9 +96,17 @@ class Filter(Base):
 
 
 class FilterManager(UserList):
+    # Patterns using backreferences or inline flags can't safely be put in
+    # the combined regex, since their meaning would change.
+    uncombinable_regex = re.compile(r'\\[1-9]|\\g|\(\?P=|\(\?(?!P<)[a-zA-Z]')
+
     def __init__(self):
         UserList.__init__(self)
         self.db_session = DBManager.create_session()
+        self.combined_regex = None
+        self.combined_filters = set()
+        # group name -> filter
+        self.combined_groups = {}
 
     def commit(self):
         self.db_session.commit()
@@ -110,9 +118,85 @@ class FilterManager(UserList):
             num_filters += 1
             self.data.append(filter)
 
+        self.build_combined_regex()
+
         log.info('Loaded {0} filters'.format(num_filters))
         return self
 
+    def build_combined_regex(self):
+        """
+        Combine all regex filters into one alternation, with one named group
+        per filter, so messages that match none of them are only scanned once.
+        If the combined regex matches, the group tells us which filter matched
+        first. See check_message.
+        """
+        import regex
+
+        self.combined_regex = None
+        self.combined_filters = set()
+        self.combined_groups = {}
+
+        patterns = []
+        for filter in self.data:
+            if filter.type != 'regex' or filter.regex is None or filter.id is None:
+                continue
+            if self.uncombinable_regex.search(filter.regex.pattern):
+                continue
+
+            group = 'filter_{}'.format(filter.id)
+            patterns.append('(?P<{}>{})'.format(group, filter.regex.pattern))
+            self.combined_filters.add(filter)
+            self.combined_groups[group] = filter
+
+        if len(patterns) == 0:
+            return
+
+        try:
+            self.combined_regex = regex.compile('|'.join(patterns))
+        except Exception:
+            log.exception('Unable to combine regex filters, falling back to checking them one by one')
+            self.combined_filters = set()
+            self.combined_groups = {}
+
+    def check_message(self, source, message):
+        """
+        Returns a (filter, match) tuple for the first filter that matches the
+        given (lowercased) message, or (None, None) if no filter matches.
+        `match` is None for banphrase filters.
+        """
+        combined_match = None
+        matched_filter = None
+        if self.combined_regex is not None:
+            combined_match = self.combined_regex.search(message)
+            if combined_match is not None:
+                matched_filter = self.combined_groups.get(combined_match.lastgroup, None)
+
+        passed_matched_filter = matched_filter is None
+        for filter in self.data:
+            if filter.type == 'regex':
+                if filter in self.combined_filters:
+                    if combined_match is None:
+                        # None of the combined filters can match the message
+                        continue
+
+                    # No combined filter matches before the combined match, and
+                    # since the alternatives are tried in order, the ones before
+                    # matched_filter don't match at its start either.
+                    if filter is matched_filter:
+                        passed_matched_filter = True
+                    pos = combined_match.start() if passed_matched_filter else combined_match.start() + 1
+                    match = filter.search(source, message, pos)
+                else:
+                    match = filter.search(source, message)
+
+                if match:
+                    return filter, match
+            elif filter.type == 'banphrase':
+                if filter.filter in message:
+                    return filter, None
+
+        return None, None
+
     def get(self, id=None, phrase=None):
         if id is not None:
             for filter in self.data:
@@ -152,6 +236,7 @@ class FilterManager(UserList):
     def remove_filter(self, filter):
         self.db_session.delete(filter)
         self.data.remove(filter)
+        self.build_combined_regex()
 
     def parse_banphrase_arguments(self, message):
         parser = argparse.ArgumentParser()
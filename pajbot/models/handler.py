@@ -1,14 +1,83 @@
 import operator
 import logging
+import collections
+import time
 
 from pajbot.tbutil import find
 
 log = logging.getLogger('pajbot')
 
 
+def get_handler_name(handler):
+    if hasattr(handler, '__self__'):
+        return '{0}.{1}'.format(type(handler.__self__).__name__, handler.__name__)
+
+    return getattr(handler, '__qualname__', str(handler))
+
+
+class HandlerStats:
+    """ Latency statistics for a single event handler.
+    All times are in milliseconds. """
+
+    # Upper bounds (in milliseconds) of the histogram buckets
+    HISTOGRAM_BUCKETS = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000)
+
+    def __init__(self, name, num_samples=1000):
+        self.name = name
+        self.num_calls = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+        # Latencies of the most recent calls, used for the rolling histogram
+        self.samples = collections.deque(maxlen=num_samples)
+
+    def add(self, duration):
+        self.num_calls += 1
+        self.total_time += duration
+        if duration > self.max_time:
+            self.max_time = duration
+        self.samples.append(duration)
+
+    @property
+    def avg_time(self):
+        return self.total_time / self.num_calls if self.num_calls > 0 else 0.0
+
+    def histogram(self):
+        """ Returns an OrderedDict of bucket label -> number of recent calls """
+        counts = [0] * (len(self.HISTOGRAM_BUCKETS) + 1)
+        for duration in list(self.samples):
+            for index, limit in enumerate(self.HISTOGRAM_BUCKETS):
+                if duration <= limit:
+                    counts[index] += 1
+                    break
+            else:
+                counts[-1] += 1
+
+        histogram = collections.OrderedDict()
+        for limit, count in zip(self.HISTOGRAM_BUCKETS, counts):
+            histogram['<={}ms'.format(limit)] = count
+        histogram['>{}ms'.format(self.HISTOGRAM_BUCKETS[-1])] = counts[-1]
+        return histogram
+
+    def jsonify(self):
+        return {
+                'handler': self.name,
+                'calls': self.num_calls,
+                'total_ms': round(self.total_time, 3),
+                'avg_ms': round(self.avg_time, 3),
+                'max_ms': round(self.max_time, 3),
+                'histogram': self.histogram(),
+                }
+
+
 class HandlerManager:
     handlers = {}
 
+    # event -> {handler: HandlerStats}, only filled in while stats are enabled
+    stats = {}
+    stats_enabled = False
+    stats_num_samples = 1000
+
     @staticmethod
     def init_handlers():
         HandlerManager.handlers = {}
@@ -80,11 +149,66 @@ class HandlerManager:
             # No handlers for this event found
             log.error('remove_handler No handler for {} found.'.format(event))
 
+    def enable_stats(num_samples=1000):
+        """ Start measuring how long every handler takes """
+        HandlerManager.stats_num_samples = num_samples
+        HandlerManager.stats_enabled = True
+
+    def disable_stats():
+        HandlerManager.stats_enabled = False
+
+    def reset_stats():
+        HandlerManager.stats = {}
+
+    def get_stats(event=None):
+        """ Returns a list of (event, HandlerStats) tuples,
+        sorted by the total time spent in the handler. """
+        stats = []
+        for stats_event, event_stats in list(HandlerManager.stats.items()):
+            if event is not None and stats_event != event:
+                continue
+            for handler_stats in list(event_stats.values()):
+                stats.append((stats_event, handler_stats))
+
+        return sorted(stats, key=lambda s: s[1].total_time, reverse=True)
+
+    def jsonify_stats(event=None):
+        data = {}
+        for stats_event, handler_stats in HandlerManager.get_stats(event):
+            data.setdefault(stats_event, []).append(handler_stats.jsonify())
+        return data
+
+    def trigger_timed(event, *arguments, stop_on_false=True):
+        event_stats = HandlerManager.stats.get(event, None)
+        if event_stats is None:
+            event_stats = HandlerManager.stats[event] = {}
+
+        for handler, priority in HandlerManager.handlers[event]:
+            res = None
+            start_time = time.perf_counter()
+            try:
+                res = handler(*arguments)
+            except:
+                log.exception('Unhandled exception from {} in {}'.format(handler, event))
+            duration = (time.perf_counter() - start_time) * 1000
+
+            handler_stats = event_stats.get(handler, None)
+            if handler_stats is None:
+                handler_stats = event_stats[handler] = HandlerStats(get_handler_name(handler), HandlerManager.stats_num_samples)
+            handler_stats.add(duration)
+
+            if res is False and stop_on_false is True:
+                # Abort if handler returns false and stop_on_false is enabled
+                return False
+
     def trigger(event, *arguments, stop_on_false=True):
         if event not in HandlerManager.handlers:
             log.error('No handler set for event {}'.format(event))
             return False
 
+        if HandlerManager.stats_enabled is True:
+            return HandlerManager.trigger_timed(event, *arguments, stop_on_false=stop_on_false)
+
         for handler, priority in HandlerManager.handlers[event]:
             res = None
             try:
@@ -1,15 +1,25 @@
 import logging
+import collections
 from collections import UserDict
 import datetime
+import time
+import threading
 
+from pajbot.actions import ActionQueue
 from pajbot.models.db import DBManager, Base
 from pajbot.models.time import TimeManager
 from pajbot.models.handler import HandlerManager
 from pajbot.managers import RedisManager
+from pajbot.managers.leaderboard import LeaderboardManager
 from pajbot.streamhelper import StreamHelper
 
 from sqlalchemy import Column, Integer, String, Boolean, DateTime
 from sqlalchemy import orm
+from sqlalchemy import event
+from sqlalchemy import inspect
+from sqlalchemy import bindparam
+from sqlalchemy import select
+from sqlalchemy import case
 
 log = logging.getLogger('pajbot')
 
@@ -72,38 +82,44 @@ class User(Base):
         self.quest_progress = {}
         self.debts = []
 
+    def get_tokens_key(self):
+        return '{streamer}:{username}:tokens'.format(
+                streamer=StreamHelper.get_streamer(), username=self.username)
+
     def can_afford_with_tokens(self, cost):
         num_tokens = self.get_tokens()
         return num_tokens >= cost
 
-    def spend_tokens(self, tokens_to_spend, redis=None):
-        if redis is None:
-            redis = RedisManager.get()
-
-        user_token_key = '{streamer}:{username}:tokens'.format(
-                streamer=StreamHelper.get_streamer(), username=self.username)
-
-        token_dict = redis.hgetall(user_token_key)
+    def take_tokens(self, tokens_to_spend, redis=None):
+        """ Spends the given amount of tokens if the user can afford it.
+        Returns a dict of stream ID -> number of tokens taken from it,
+        which can be given back with refund_tokens.
+        Returns None if the user can't afford it.
+        """
 
-        for stream_id in token_dict:
-            try:
-                num_tokens = int(token_dict[stream_id])
-            except (TypeError, ValueError):
-                continue
+        spent = RedisManager.run_script('spend_tokens', keys=[self.get_tokens_key()], args=[tokens_to_spend], redis=redis)
+        if spent is None:
+            return None
 
-            if num_tokens == 0:
-                continue
+        return {spent[i]: int(spent[i + 1]) for i in range(0, len(spent), 2)}
 
-            decrease_by = min(tokens_to_spend, num_tokens)
-            tokens_to_spend -= decrease_by
-            num_tokens -= decrease_by
+    def refund_tokens(self, spent, redis=None):
+        """ Gives back tokens taken with take_tokens """
+        if len(spent) == 0:
+            return
 
-            redis.hset(user_token_key, stream_id, num_tokens)
+        if redis is None:
+            redis = RedisManager.get()
 
-            if tokens_to_spend == 0:
-                return True
+        key = self.get_tokens_key()
+        pipeline = redis.pipeline(transaction=False)
+        for stream_id, num_tokens in spent.items():
+            pipeline.hincrby(key, stream_id, num_tokens)
+        pipeline.execute()
 
-        return False
+    def spend_tokens(self, tokens_to_spend, redis=None):
+        """ Returns True if the user could afford it and the tokens were spent. """
+        return self.take_tokens(tokens_to_spend, redis=redis) is not None
 
     def award_tokens(self, tokens, redis=None):
         """ Returns True if tokens were awarded properly.
@@ -111,39 +127,18 @@ class User(Base):
         Tokens can only be rewarded once per stream ID.
         """
 
-        streamer = StreamHelper.get_streamer()
         stream_id = StreamHelper.get_current_stream_id()
 
         if stream_id is False:
             return False
 
-        if redis is None:
-            redis = RedisManager.get()
-
-        key = '{streamer}:{username}:tokens'.format(
-                streamer=streamer, username=self.username)
-
-        res = True if redis.hsetnx(key, stream_id, tokens) == 1 else False
+        res = RedisManager.run_script('award_tokens', keys=[self.get_tokens_key()], args=[stream_id, tokens], redis=redis) is not None
         if res is True:
             HandlerManager.trigger('on_user_gain_tokens', self, tokens)
         return res
 
     def get_tokens(self, redis=None):
-        streamer = StreamHelper.get_streamer()
-        if redis is None:
-            redis = RedisManager.get()
-
-        tokens = redis.hgetall('{streamer}:{username}:tokens'.format(
-            streamer=streamer, username=self.username))
-
-        num_tokens = 0
-        for token_value in tokens.values():
-            try:
-                num_tokens += int(token_value)
-            except (TypeError, ValueError):
-                log.warn('Invalid value for tokens, user {}'.format(self.username))
-
-        return num_tokens
+        return RedisManager.run_script('get_tokens', keys=[self.get_tokens_key()], redis=redis)
 
     def tag_as(self, tag):
         if tag not in self.tags:
@@ -230,32 +225,26 @@ class User(Base):
         Example: ['pajlada_warning1', 'pajlada_warning2'] """
         return [self.WARNING_SYNTAX.format(prefix=prefix, username=self.username, id=id) for id in range(0, total_chances)]
 
-    def get_warnings(self, redis, warning_keys):
-        """ Pass through a list of warning keys.
-        Example of warning_keys syntax: ['_pajlada_warning1', '_pajlada_warning2']
-        Returns a list of values for the warning keys list above.
-        Example: [b'1', None]
-        Each instance of None in the list means one more Chance
-        before a full timeout is in order. """
-
-        return redis.mget(warning_keys)
+    def warn(self, warning_module, redis=None):
+        """ Records a new warning for the user, unless he has used up all of his chances.
+        Returns how many chances the user had used before this warning.
+        This is a single atomic round trip, and if redis is a pipeline the
+        result is returned when the pipeline is executed. """
 
-    def get_chances_used(self, warnings):
-        """ Returns a number between 0 and n where n is the amount of
-            chances a user has before he should face the full timeout length. """
+        warning_keys = self.get_warning_keys(warning_module.settings['total_chances'], warning_module.settings['redis_prefix'])
+        return RedisManager.run_script('warn_user', keys=warning_keys, args=[warning_module.settings['length']], redis=redis)
 
-        return len(warnings) - warnings.count(None)
+    def get_punishment(self, timeout_length, chances_used, warning_module):
+        """ Returns a tuple with how long to timeout the user for and the punishment
+        string, given how many chances the user had used. See warn """
 
-    def add_warning(self, redis, timeout, warning_keys, warnings):
-        """ Returns a number between 0 and n where n is the amount of
-            chances a user has before he should face the full timeout length. """
+        if chances_used < warning_module.settings['total_chances']:
+            """ The user used up one of his warnings.
+            Calculate for how long we should time him out. """
+            timeout_length = warning_module.settings['base_timeout'] * (chances_used + 1)
+            return (timeout_length, 'timed out for {} seconds (warning)'.format(timeout_length))
 
-        for id in range(0, len(warning_keys)):
-            if warnings[id] is None:
-                redis.setex(warning_keys[id], time=timeout, value=1)
-                return True
-
-        return False
+        return (timeout_length, 'timed out for {} seconds'.format(timeout_length))
 
     def timeout(self, timeout_length, warning_module=None, use_warnings=True):
         """ Returns a tuple with the follow data:
@@ -264,46 +253,457 @@ class User(Base):
         The punishment string is used to clarify whether this was a warning or the real deal.
         """
 
-        punishment = 'timed out for {} seconds'.format(timeout_length)
-
         if use_warnings and warning_module is not None:
-            redis = RedisManager.get()
+            chances_used = self.warn(warning_module)
+            return self.get_punishment(timeout_length, chances_used, warning_module)
+
+        return (timeout_length, 'timed out for {} seconds'.format(timeout_length))
+
+
+# KEYS are the warning keys of a user, see User.get_warning_keys
+# ARGV[1] is for how many seconds a warning lasts.
+# Returns how many of the warning keys were set, and sets the first one that
+# wasn't set to record a new warning.
+WARN_USER_SCRIPT = """
+local chances_used = 0
+local free_key = nil
+for _, key in ipairs(KEYS) do
+    if redis.call('EXISTS', key) == 1 then
+        chances_used = chances_used + 1
+    elseif free_key == nil then
+        free_key = key
+    end
+end
+if free_key ~= nil then
+    redis.call('SETEX', free_key, ARGV[1], 1)
+end
+return chances_used
+"""
+
+RedisManager.register_script('warn_user', WARN_USER_SCRIPT)
+
+
+# The tokens of a user are stored in a hash of stream ID -> number of tokens.
+# KEYS[1] is the key of the hash.
+
+# Returns the total number of tokens
+TOKENS_BALANCE_SCRIPT = """
+local num_tokens = 0
+for _, value in ipairs(redis.call('HVALS', KEYS[1])) do
+    num_tokens = num_tokens + (tonumber(value) or 0)
+end
+return num_tokens
+"""
+
+# ARGV[1] is the number of tokens to spend.
+# Returns nil if the user can't afford it, otherwise the tokens are spent
+# and a flat list of stream ID, number of tokens spent from it is returned.
+TOKENS_SPEND_SCRIPT = """
+local cost = tonumber(ARGV[1])
+local tokens = redis.call('HGETALL', KEYS[1])
+local num_tokens = 0
+for i = 2, #tokens, 2 do
+    num_tokens = num_tokens + (tonumber(tokens[i]) or 0)
+end
+if num_tokens < cost then
+    return nil
+end
+local spent = {}
+for i = 1, #tokens, 2 do
+    if cost <= 0 then
+        break
+    end
+    local value = tonumber(tokens[i + 1])
+    if value ~= nil and value > 0 then
+        local decrease_by = math.min(cost, value)
+        redis.call('HINCRBY', KEYS[1], tokens[i], -decrease_by)
+        cost = cost - decrease_by
+        spent[#spent + 1] = tokens[i]
+        spent[#spent + 1] = decrease_by
+    end
+end
+return spent
+"""
+
+# ARGV[1] is the stream ID and ARGV[2] the number of tokens to award.
+# Returns nil if tokens were already awarded for that stream ID,
+# otherwise the new total number of tokens.
+TOKENS_AWARD_SCRIPT = """
+if redis.call('HSETNX', KEYS[1], ARGV[1], ARGV[2]) == 0 then
+    return nil
+end
+local num_tokens = 0
+for _, value in ipairs(redis.call('HVALS', KEYS[1])) do
+    num_tokens = num_tokens + (tonumber(value) or 0)
+end
+return num_tokens
+"""
+
+RedisManager.register_script('get_tokens', TOKENS_BALANCE_SCRIPT)
+RedisManager.register_script('spend_tokens', TOKENS_SPEND_SCRIPT)
+RedisManager.register_script('award_tokens', TOKENS_AWARD_SCRIPT)
+
+
+class ActiveChatters:
+    """
+    Keeps track of the most recently active chatters, with the most
+    recently active chatter first.
+    Seeing a chatter moves them to the front, and once we reach our capacity
+    the chatter who has been inactive the longest is forgotten.
+    All operations are O(1).
+    """
 
-            """ How many chances the user has before receiving a full timeout. """
-            total_chances = warning_module.settings['total_chances']
+    def __init__(self, capacity=250):
+        self.capacity = capacity
+        self.chatters = collections.OrderedDict()
 
-            warning_keys = self.get_warning_keys(total_chances, warning_module.settings['redis_prefix'])
-            warnings = self.get_warnings(redis, warning_keys)
+    def touch(self, user):
+        """ Mark the given user as the most recently active chatter """
+        username = user.username.lower()
+        if username in self.chatters:
+            self.chatters[username] = user
+        else:
+            if len(self.chatters) >= self.capacity:
+                self.chatters.popitem(last=True)
+            self.chatters[username] = user
+        self.chatters.move_to_end(username, last=False)
 
-            chances_used = self.get_chances_used(warnings)
+    def remove(self, username):
+        self.chatters.pop(username.lower(), None)
 
-            if chances_used < total_chances:
-                """ The user used up one of his warnings.
-                Calculate for how long we should time him out. """
-                timeout_length = warning_module.settings['base_timeout'] * (chances_used + 1)
-                punishment = 'timed out for {} seconds (warning)'.format(timeout_length)
+    def __contains__(self, username):
+        return username.lower() in self.chatters
 
-                self.add_warning(redis, warning_module.settings['length'], warning_keys, warnings)
+    def __iter__(self):
+        return iter(list(self.chatters.values()))
 
-        return (timeout_length, punishment)
+    def __len__(self):
+        return len(self.chatters)
+
+
+class UserCounterWriter:
+    """
+    Writes the User columns that change on (almost) every message in the
+    background, with batched UPDATEs.
+
+    UserManager.flush_counters collects the changed columns on the main
+    thread and hands them to us, so the periodic commit of the UserManager
+    session doesn't have to write them.
+    """
+
+    COLUMNS = ('points', 'num_lines', 'last_seen', 'last_active', 'minutes_in_chat_online', 'minutes_in_chat_offline')
+
+    def __init__(self, batch_size=500):
+        self.batch_size = batch_size
+
+        # User ID -> number of queued rows that haven't been written yet
+        self.pending = collections.Counter()
+        self.pending_lock = threading.Lock()
+
+        # A single thread, so the writes are done in the order they were added
+        self.action_queue = ActionQueue()
+        self.action_queue.start()
+
+    def add(self, rows, scores={}):
+        """
+        Queue the given rows for writing.
+        Each row is a dict with the user ID in `b_id`, and the new value of
+        each changed column in `b_<column>`.
+
+        The leaderboards are updated with the given scores once the rows
+        have been written. See LeaderboardManager.update
+        """
+
+        with self.pending_lock:
+            self.pending.update(row['b_id'] for row in rows)
+
+        rows_by_columns = collections.defaultdict(list)
+        for row in rows:
+            columns = tuple(column for column in self.COLUMNS if 'b_' + column in row)
+            rows_by_columns[columns].append(row)
+
+        for columns, rows in rows_by_columns.items():
+            self.action_queue.add(self.write, args=[columns, rows])
+
+        if len(scores) > 0:
+            self.action_queue.add(self.update_leaderboards, args=[scores])
+
+    def write(self, columns, rows):
+        table = User.__table__
+        query = table.update().where(table.c.id == bindparam('b_id')).values({column: bindparam('b_' + column) for column in columns})
+
+        for i in range(0, len(rows), self.batch_size):
+            batch = rows[i:i + self.batch_size]
+            try:
+                with DBManager.engine.begin() as connection:
+                    connection.execute(query, batch)
+            except:
+                log.exception('Unhandled exception while writing {0} user counters'.format(len(batch)))
+            finally:
+                with self.pending_lock:
+                    self.pending.subtract(row['b_id'] for row in batch)
+                    for row in batch:
+                        if self.pending[row['b_id']] <= 0:
+                            del self.pending[row['b_id']]
+
+    def is_pending(self, user_ids):
+        """ Returns True if any of the given users has rows that haven't been written yet """
+        with self.pending_lock:
+            return any(user_id in self.pending for user_id in user_ids)
+
+    def update_leaderboards(self, scores):
+        try:
+            LeaderboardManager.update(scores)
+        except:
+            log.exception('Unhandled exception while updating the leaderboards of {0} users'.format(len(scores)))
+
+    def wait(self, timeout=None):
+        """ Blocks until everything that has been added so far has been written """
+        done = threading.Event()
+        self.action_queue.add(done.set)
+        return done.wait(timeout)
 
 
 class UserManager(UserDict):
-    def __init__(self):
+    """
+    Caches User objects by their (lowercase) username.
+
+    The cache is bounded. Users that haven't been used in a while are evicted
+    when there are more than `capacity` cached users, or when they've been
+    idle for more than `max_idle` seconds. See evict().
+    """
+
+    def __init__(self, capacity=None, max_idle=None, counter_writer=None):
         UserDict.__init__(self)
         self.db_session = DBManager.create_session()
 
+        # username -> User, the least recently used user first
+        self.data = collections.OrderedDict()
+        self.last_used = {}
+
+        self.capacity = capacity
+        self.max_idle = max_idle
+
+        # Users that are referenced from elsewhere, and must therefore not be evicted
+        self.pins = collections.Counter()
+        # Containers of usernames (e.g. ActiveChatters) whose users must not be evicted
+        self.pin_sources = []
+
+        # Writes points, num_lines, last_seen and last_active in the background. See flush_counters()
+        self.counter_writer = counter_writer
+        # Users whose rows are locked by the current transaction of our db session
+        self.flushed_usernames = set()
+        if self.counter_writer is not None:
+            # UserDict isn't hashable, so our bound methods can't be used as listeners directly
+            event.listen(self.db_session, 'before_flush', lambda *args: self.on_before_flush(*args))
+            event.listen(self.db_session, 'after_flush', lambda *args: self.on_after_flush(*args))
+            event.listen(self.db_session, 'after_commit', lambda *args: self.on_transaction_end(*args))
+            event.listen(self.db_session, 'after_rollback', lambda *args: self.on_transaction_end(*args))
+
     @classmethod
     def init_for_tests(cls):
-        users = cls(None)
+        users = cls()
 
         users['pajlada'] = User.test_user('PajladA')
 
         return users
 
     def commit(self):
+        if self.counter_writer is not None:
+            self.flush_counters()
+            self.update_flushed_leaderboards()
+            # Committing expires all our users, so the counters must be written before they're reloaded
+            self.counter_writer.wait()
+
         self.db_session.commit()
 
+    def flush_counters(self):
+        """
+        Hand the changed counters (see UserCounterWriter.COLUMNS) of all
+        modified users to the counter writer, and mark them as unchanged
+        in our db session.
+
+        Users whose rows have already been flushed in the current transaction
+        are skipped, their counters are written when we commit instead.
+        This is also done right before every flush of our db session, so
+        the flush only writes (and locks) the rows of users with other
+        changes.
+
+        The leaderboards of the users whose counters were handed off are
+        updated by the counter writer as well. See update_flushed_leaderboards
+        for the skipped users.
+
+        Returns the number of users whose counters were handed off.
+        """
+
+        if self.counter_writer is None:
+            return 0
+
+        rows = []
+        scores = {}
+        for user in self.db_session.dirty:
+            if not isinstance(user, User) or user.username in self.flushed_usernames:
+                continue
+
+            state = inspect(user)
+            row = {}
+            for column in UserCounterWriter.COLUMNS:
+                if column in state.committed_state:
+                    row['b_' + column] = state.dict[column]
+                    orm.attributes.set_committed_value(user, column, state.dict[column])
+
+            if len(row) > 0:
+                row['b_id'] = state.identity[0]
+                rows.append(row)
+                scores[user.username] = LeaderboardManager.get_user_scores(user)
+
+        if len(rows) > 0:
+            self.counter_writer.add(rows, scores)
+
+        return len(rows)
+
+    def update_flushed_leaderboards(self):
+        """
+        Has the counter writer update the leaderboards of the users whose
+        rows have been flushed in the current transaction. Their counters
+        are written when we commit instead of by the counter writer, so
+        this should be done right before committing.
+
+        Returns the number of users whose leaderboards will be updated.
+        """
+
+        if self.counter_writer is None:
+            return 0
+
+        scores = {}
+        for user in list(self.db_session.identity_map.values()):
+            if isinstance(user, User) and user.username in self.flushed_usernames:
+                scores[user.username] = LeaderboardManager.get_user_scores(user)
+
+        if len(scores) > 0:
+            self.counter_writer.add([], scores)
+
+        return len(scores)
+
+    def on_before_flush(self, session, flush_context, instances):
+        self.flush_counters()
+
+        # The flush locks the rows of the users with other changes until we commit.
+        # Make sure the counter writer isn't about to write to any of them.
+        user_ids = [inspect(user).identity[0] for user in session.dirty if isinstance(user, User) and len(inspect(user).committed_state) > 0]
+        if self.counter_writer.is_pending(user_ids):
+            self.counter_writer.wait()
+
+    def on_after_flush(self, session, flush_context):
+        # Users whose only changes were their counters have been handed off
+        # in on_before_flush, so the flush hasn't written their rows.
+        for user in session.new:
+            if isinstance(user, User):
+                self.flushed_usernames.add(user.username)
+        for user in session.dirty:
+            if isinstance(user, User) and len(inspect(user).committed_state) > 0:
+                self.flushed_usernames.add(user.username)
+
+    def on_transaction_end(self, session):
+        self.flushed_usernames = set()
+
+    def __setitem__(self, username, user):
+        self.data[username] = user
+        self.touch(username)
+
+    def __delitem__(self, username):
+        del self.data[username]
+        self.last_used.pop(username, None)
+
+    def touch(self, username):
+        """ Mark the cached user as the most recently used one """
+        self.data.move_to_end(username)
+        self.last_used[username] = time.monotonic()
+
+    def pin(self, user):
+        """ Make sure the given user is not evicted from the cache until unpin is called """
+        self.pins[user.username] += 1
+
+    def unpin(self, user):
+        if self.pins[user.username] <= 1:
+            del self.pins[user.username]
+        else:
+            self.pins[user.username] -= 1
+
+    def is_pinned(self, username, user):
+        if username in self.pins:
+            return True
+
+        # Users with outstanding debts or duel requests are referenced by
+        # bets and by other users
+        if len(getattr(user, 'debts', [])) > 0:
+            return True
+        if getattr(user, 'duel_request', False) is not False or getattr(user, 'duel_target', False) is not False:
+            return True
+
+        for pin_source in self.pin_sources:
+            if username in pin_source:
+                return True
+
+        return False
+
+    def evict(self):
+        """
+        Evict users that are over our capacity or have been idle for too long,
+        least recently used first. Pinned users are never evicted.
+
+        Changes to evicted users are committed before they are expunged from
+        our db session. Only flushing them would keep their rows locked until
+        our next commit, while award_chatters and update_subscribers update
+        them in sessions of their own, since they're no longer cached.
+
+        Returns the number of evicted users.
+        """
+
+        now = time.monotonic()
+        num_over_capacity = len(self.data) - self.capacity if self.capacity is not None else 0
+
+        evicted_users = []
+        for username, user in self.data.items():
+            over_capacity = num_over_capacity > len(evicted_users)
+            idle = self.max_idle is not None and now - self.last_used.get(username, now) > self.max_idle
+            if not over_capacity and not idle:
+                # Every user after this one has been used more recently
+                break
+
+            if self.is_pinned(username, user):
+                continue
+
+            evicted_users.append((username, user))
+
+        if len(evicted_users) == 0:
+            return 0
+
+        # Counters are written by the counter writer, so they don't need to be flushed
+        self.flush_counters()
+
+        new_users = self.db_session.new
+        dirty_users = [user for username, user in evicted_users if user in new_users or self.db_session.is_modified(user)]
+        if len(dirty_users) > 0:
+            # The counters of flushed users are written with the commit, see update_flushed_leaderboards
+            self.update_flushed_leaderboards()
+            # Our users don't need to be reloaded, they're as up to date as the rows we commit
+            expire_on_commit = self.db_session.expire_on_commit
+            self.db_session.expire_on_commit = False
+            try:
+                self.db_session.commit()
+            finally:
+                self.db_session.expire_on_commit = expire_on_commit
+
+        for username, user in evicted_users:
+            del self[username]
+            if user in self.db_session:
+                self.db_session.expunge(user)
+
+        log.debug('Evicted {0} users from the user cache, {1} users left'.format(len(evicted_users), len(self.data)))
+
+        return len(evicted_users)
+
     def find(self, username):
         """
         Attempts to find the user with the given username.
@@ -332,6 +732,7 @@ class UserManager(UserDict):
 
         # Check if the user is already cached
         if username_lower in self.data:
+            self.touch(username_lower)
             return self.data[username_lower]
 
         # Check for the username in the database
@@ -350,19 +751,208 @@ class UserManager(UserDict):
                 usernames.remove(user.username)
             except:
                 log.exception('Exception caught while removing {0} from the usernames list'.format(user.username))
-            self.data[user.username] = user
+            self[user.username] = user
             users.append(user)
 
         for username in usernames:
             # New user!
             user = User(username=username)
             self.db_session.add(user)
-            self.data[username] = user
+            self[username] = user
             users.append(user)
         self.db_session.flush()
 
         return users
 
+    def award_chatters(self, usernames, points, minutes_in_chat_offline=0, subscriber_multiplier=1, tag_multipliers={}, known_usernames=frozenset(), chunk_size=1000):
+        """
+        Gives every user in the list of usernames `points` points, and adds
+        `minutes_in_chat_offline` to their minutes in chat.
+        Subscribers get `subscriber_multiplier` times as many points, and so
+        do users with a tag in `tag_multipliers` (tag -> multiplier).
+
+        Users loaded in our db session are updated in memory, and all other
+        users with update_uncached_users. See get_session_users.
+        Users that don't exist yet are inserted, unless they're in
+        `known_usernames`.
+        Only cached users can have tags, since tags are never stored.
+
+        Returns the number of inserted users.
+        """
+
+        now = datetime.datetime.now()
+        table = User.__table__
+
+        usernames = set(usernames)
+        session_users = self.get_session_users(usernames)
+
+        uncached_usernames = []
+        for username in usernames:
+            user = session_users.get(username, None)
+            if user is None:
+                uncached_usernames.append(username)
+                continue
+
+            num_points = points
+            if user.subscriber:
+                num_points *= subscriber_multiplier
+            for tag in user.tags:
+                num_points *= tag_multipliers.get(tag, 1)
+            user.minutes_in_chat_offline += minutes_in_chat_offline
+            user.touch(num_points)
+
+        num_inserted = self.update_uncached_users(uncached_usernames, {
+                'points': table.c.points + case([(table.c.subscriber, points * subscriber_multiplier)], else_=points),
+                'minutes_in_chat_offline': table.c.minutes_in_chat_offline + minutes_in_chat_offline,
+                'last_seen': now,
+            }, new_user_values={
+                'points': points,
+                'minutes_in_chat_offline': minutes_in_chat_offline,
+                'last_seen': now,
+            }, known_usernames=known_usernames, chunk_size=chunk_size)
+
+        self.update_uncached_leaderboards(uncached_usernames, chunk_size=chunk_size)
+
+        return num_inserted
+
+    def update_subscribers(self, subscribers, unsubscribers, chunk_size=1000):
+        """
+        Marks the given users as subscribers, and the given unsubscribers as
+        non-subscribers. Subscribers that don't exist yet are inserted.
+
+        Users loaded in our db session are updated in memory, and all other
+        users with update_uncached_users. See get_session_users.
+
+        Returns the number of inserted users.
+        """
+
+        session_users = self.get_session_users(set(subscribers) | set(unsubscribers))
+
+        uncached_subscribers = []
+        uncached_unsubscribers = []
+        for usernames, subscriber, uncached_usernames in [(subscribers, True, uncached_subscribers), (unsubscribers, False, uncached_unsubscribers)]:
+            for username in usernames:
+                user = session_users.get(username, None)
+                if user is None:
+                    uncached_usernames.append(username)
+                else:
+                    user.subscriber = subscriber
+
+        self.update_uncached_users(uncached_unsubscribers, {'subscriber': False}, chunk_size=chunk_size)
+        return self.update_uncached_users(uncached_subscribers, {'subscriber': True},
+                new_user_values={'subscriber': True}, chunk_size=chunk_size)
+
+    def get_session_users(self, usernames):
+        """
+        Returns the users with the given usernames that are loaded in our db
+        session as a dict of username -> User. Besides the cached users, this
+        includes users that were loaded without being cached, e.g. by find().
+
+        When our db session is flushed, it writes the absolute values of
+        their changed columns, which would overwrite a relative UPDATE done
+        by update_uncached_users. Users that have been expired since they
+        were loaded will be reloaded first, so they're safe to update with
+        update_uncached_users.
+        """
+
+        session_users = {username: self.data[username] for username in usernames if username in self.data}
+        if len(session_users) == len(usernames):
+            return session_users
+
+        for user in list(self.db_session.identity_map.values()) + list(self.db_session.new):
+            if not isinstance(user, User):
+                continue
+
+            # Don't use user.username, which would reload expired users
+            username = inspect(user).dict.get('username', None)
+            if username in usernames and username not in session_users:
+                session_users[username] = user
+
+        return session_users
+
+    def update_uncached_users(self, usernames, values, new_user_values=None, known_usernames=frozenset(), chunk_size=1000):
+        """
+        Updates the users with the given usernames with set-based UPDATEs,
+        in chunks of `chunk_size` users, without loading them.
+        `values` are the values for the UPDATE, as passed to Update.values.
+
+        If `new_user_values` is given, users that don't exist yet are
+        inserted in batches with those values. Users in `known_usernames`
+        are known to exist, so we don't need to check for them.
+
+        Each chunk is written and committed in a short session of its own,
+        so the rows aren't kept locked until our db session is committed.
+
+        Returns the number of inserted users.
+        """
+
+        table = User.__table__
+        usernames = list(usernames)
+
+        if self.counter_writer is not None and len(usernames) > 0:
+            # Evicted users can still have counters queued in the counter writer,
+            # whose absolute values would overwrite our relative UPDATEs
+            self.counter_writer.wait()
+
+        num_inserted = 0
+        for i in range(0, len(usernames), chunk_size):
+            chunk = usernames[i:i + chunk_size]
+
+            with DBManager.create_session_scope() as db_session:
+                if new_user_values is None:
+                    existing_usernames = chunk
+                else:
+                    unknown_usernames = [username for username in chunk if username not in known_usernames]
+                    existing_usernames = set(chunk) - set(unknown_usernames)
+                    if len(unknown_usernames) > 0:
+                        existing_usernames.update(row[0] for row in db_session.execute(
+                            select([table.c.username]).where(table.c.username.in_(unknown_usernames))))
+
+                if len(existing_usernames) > 0:
+                    db_session.execute(table.update().where(table.c.username.in_(existing_usernames)).values(values))
+
+                if new_user_values is not None:
+                    new_users = []
+                    for username in chunk:
+                        if username not in existing_usernames:
+                            new_user = {'username': username, 'username_raw': username}
+                            new_user.update(new_user_values)
+                            new_users.append(new_user)
+
+                    if len(new_users) > 0:
+                        db_session.execute(table.insert(), new_users)
+                        num_inserted += len(new_users)
+
+        return num_inserted
+
+    def update_uncached_leaderboards(self, usernames, chunk_size=1000):
+        """
+        Reads the scores of the given users from the database, without
+        loading them, and has the counter writer update their leaderboards.
+        """
+
+        if self.counter_writer is None:
+            return
+
+        table = User.__table__
+        usernames = list(usernames)
+        for i in range(0, len(usernames), chunk_size):
+            query = LeaderboardManager.select_scores().where(table.c.username.in_(usernames[i:i + chunk_size]))
+            with DBManager.create_session_scope() as db_session:
+                scores = {row['username']: LeaderboardManager.get_row_scores(row) for row in db_session.execute(query)}
+            self.counter_writer.add([], scores)
+
+    def get_subscriber_usernames(self):
+        """ Returns a set of the usernames of all users that are marked as subscribers """
+        table = User.__table__
+        usernames = set(row[0] for row in self.db_session.execute(select([table.c.username]).where(table.c.subscriber)))
+        for username, user in self.data.items():
+            if user.subscriber:
+                usernames.add(username)
+            else:
+                usernames.discard(username)
+        return usernames
+
     def __getitem__(self, username):
         """
         Returns the user with the given username.
@@ -381,6 +971,7 @@ class UserManager(UserDict):
 
         # Check if the user is already cached
         if username_lower in self.data:
+            self.touch(username_lower)
             return self.data[username_lower]
 
         # Check for the username in the database
@@ -393,14 +984,14 @@ class UserManager(UserDict):
             self.db_session.flush()
 
         # Add the user object to the cache
-        self.data[username_lower] = user
+        self[username_lower] = user
 
         return self.data[username_lower]
 
     def reset_subs(self):
         for user in self.db_session.query(User).filter_by(subscriber=True):
             if user.username not in self.data:
-                self.data[user.username] = user
+                self[user.username] = user
 
             user.subscriber = False
 
@@ -35,18 +35,15 @@ class BanphraseModule(BaseModule):
             self.bot.banphrase_manager.punish(source, res)
             return True
 
-        for f in self.bot.filters:
+        f, m = self.bot.filters.check_message(source, msg_lower)
+        if f is not None:
             if f.type == 'regex':
-                m = f.search(source, msg_lower)
-                if m:
-                    log.debug('Matched regex filter \'{0}\''.format(f.name))
-                    f.run(self.bot, source, msg_raw, event, {'match': m})
-                    return True
-            elif f.type == 'banphrase':
-                if f.filter in msg_lower:
-                    log.debug('Matched banphrase filter \'{0}\''.format(f.name))
-                    f.run(self.bot, source, msg_raw, event)
-                    return True
+                log.debug('Matched regex filter \'{0}\''.format(f.name))
+                f.run(self.bot, source, msg_raw, event, {'match': m})
+            else:
+                log.debug('Matched banphrase filter \'{0}\''.format(f.name))
+                f.run(self.bot, source, msg_raw, event)
+            return True
 
         return False  # message was ok
 
@@ -97,10 +94,8 @@ class BanphraseModule(BaseModule):
                 bot.whisper(source.username, 'Added your banphrase (ID: {banphrase.id})'.format(banphrase=banphrase))
                 return True
 
-            banphrase.set(**options)
             banphrase.data.set(edited_by=options['edited_by'])
-            DBManager.session_add_expunge(banphrase)
-            bot.banphrase_manager.commit()
+            bot.banphrase_manager.edit_banphrase(banphrase, **options)
             bot.whisper(source.username, 'Updated your banphrase (ID: {banphrase.id}) with ({what})'.format(banphrase=banphrase, what=', '.join([key for key in options if key != 'added_by'])))
 
     def remove_banphrase(self, **options):
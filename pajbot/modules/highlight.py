@@ -38,18 +38,15 @@ class HighlightModule(BaseModule):
             self.bot.banphrase_manager.punish(source, res)
             return True
 
-        for f in self.bot.filters:
+        f, m = self.bot.filters.check_message(source, msg_lower)
+        if f is not None:
             if f.type == 'regex':
-                m = f.search(source, msg_lower)
-                if m:
-                    log.debug('Matched regex filter \'{0}\''.format(f.name))
-                    f.run(self.bot, source, msg_raw, event, {'match': m})
-                    return True
-            elif f.type == 'banphrase':
-                if f.filter in msg_lower:
-                    log.debug('Matched banphrase filter \'{0}\''.format(f.name))
-                    f.run(self.bot, source, msg_raw, event)
-                    return True
+                log.debug('Matched regex filter \'{0}\''.format(f.name))
+                f.run(self.bot, source, msg_raw, event, {'match': m})
+            else:
+                log.debug('Matched banphrase filter \'{0}\''.format(f.name))
+                f.run(self.bot, source, msg_raw, event)
+            return True
 
         return False  # message was ok
 
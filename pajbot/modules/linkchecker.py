@@ -53,18 +53,64 @@ def is_same_url(x, y):
     return parsed_x.netloc == parsed_y.netloc and parsed_x.path.strip('/') == parsed_y.path.strip('/') and parsed_x.query == parsed_y.query
 
 
+# Every URL the url regex can match contains either a dot followed by a word
+# character (domain names and IPs) or "localhost/".
+url_candidate_regex = re.compile(r'\.\w|localhost/', re.IGNORECASE)
+word_regex = re.compile(r'\S+')
+
+
+def find_url_candidates(message):
+    """
+    Splits the message up into the parts that the url regex has to look at.
+
+    A URL match never contains whitespace, except for the single character
+    matched by the "www." part of the url regex, so words are only joined
+    together if a word ending with "www" is followed by a single whitespace
+    character.
+    Parts that can't contain a URL are skipped.
+    """
+    start = None
+    end = None
+    for match in word_regex.finditer(message):
+        if start is not None:
+            if match.start() == end + 1 and message[max(start, end - 3):end].lower() == 'www':
+                end = match.end()
+                continue
+
+            part = message[start:end]
+            if url_candidate_regex.search(part) is not None:
+                yield part
+
+        start, end = match.span()
+
+    if start is not None:
+        part = message[start:end]
+        if url_candidate_regex.search(part) is not None:
+            yield part
+
+
 def find_unique_urls(regex, message):
-    _urls = regex.finditer(message)
-    urls = []
-    for i in _urls:
-        url = i.group(0)
-        if not (url.startswith('http://') or url.startswith('https://')):
-            url = 'http://' + url
-        if not(url[-1].isalpha() or url[-1].isnumeric() or url[-1] == '/'):
-            url = url[:-1]
-        urls.append(url)
+    """
+    Returns a set of all URLs found in the message.
+
+    The url regex is slow, so messages that can't contain a URL are skipped
+    entirely, and the regex is only run on the words that could be a URL.
+    """
+    urls = set()
+
+    if url_candidate_regex.search(message) is None:
+        return urls
+
+    for part in find_url_candidates(message):
+        for match in regex.finditer(part):
+            url = match.group(0)
+            if not (url.startswith('http://') or url.startswith('https://')):
+                url = 'http://' + url
+            if not(url[-1].isalpha() or url[-1].isnumeric() or url[-1] == '/'):
+                url = url[:-1]
+            urls.add(url)
 
-    return set(urls)
+    return urls
 
 
 class Url:
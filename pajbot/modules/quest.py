@@ -1,7 +1,9 @@
+import itertools
 import logging
 import random
+import time
 
-from pajbot.modules import BaseModule
+from pajbot.modules import BaseModule, ModuleSetting
 from pajbot.models.command import Command
 from pajbot.models.handler import HandlerManager
 from pajbot.managers import RedisManager
@@ -16,11 +18,26 @@ class QuestModule(BaseModule):
     NAME = 'Quest system'
     DESCRIPTION = 'Give users a single quest at the start of each day'
     CATEGORY = 'Game'
-    SETTINGS = []
+    SETTINGS = [
+            ModuleSetting(
+                key='progress_flush_interval',
+                label='How often quest progress is written to redis (in milliseconds). Changes apply after a restart',
+                type='number',
+                required=True,
+                placeholder='',
+                default=500,
+                constraints={
+                    'min_value': 100,
+                    'max_value': 10000,
+                    }),
+            ]
 
     def __init__(self):
         super().__init__()
         self.current_quest = None
+        self.flush_scheduled = False
+        # The flush timer can't be cancelled, so it checks this instead
+        self.enabled = False
 
     def my_progress(self, **options):
         bot = options['bot']
@@ -100,6 +117,8 @@ class QuestModule(BaseModule):
             log.info('No quest active on stream stop.')
             return False
 
+        # The progress is deleted when the quest is stopped, so there's no point in writing it
+        self.current_quest.pending_progress = {}
         self.current_quest.stop_quest()
         self.current_quest = None
         self.bot.say('Stream ended, quest has been reset.')
@@ -115,20 +134,63 @@ class QuestModule(BaseModule):
             # No last stream ID found. why?
             return False
 
-        # XXX: Should we use a pipeline for any of this?
         # Go through user tokens and remove any from more than 2 streams ago
-        for key in redis.keys('{streamer}:*:tokens'.format(streamer=StreamHelper.get_streamer())):
-            all_tokens = redis.hgetall(key)
-            for stream_id_str in all_tokens:
-                try:
-                    stream_id = int(stream_id_str)
-                except (TypeError, ValueError):
-                    log.error('Invalid stream id in tokens by {}'.format(key))
+        self.bot.action_queue.add(self.expire_tokens, args=[last_stream_id])
+
+    def expire_tokens(self, last_stream_id, batch_size=500):
+        """ Removes the tokens users got from streams before the stream
+        before the last stream.
+        The token keys are found with SCAN instead of KEYS so we don't block
+        Redis for the web app, and each batch of keys is read and pruned with
+        one pipeline each. """
+
+        try:
+            redis = RedisManager.get()
+            start = time.time()
+            num_keys = 0
+            num_pruned_keys = 0
+            num_pruned_fields = 0
+
+            pattern = '{streamer}:*:tokens'.format(streamer=StreamHelper.get_streamer())
+            keys = redis.scan_iter(match=pattern, count=batch_size)
+            while True:
+                batch = list(itertools.islice(keys, batch_size))
+                if len(batch) == 0:
+                    break
+                num_keys += len(batch)
+
+                pipeline = redis.pipeline(transaction=False)
+                for key in batch:
+                    pipeline.hkeys(key)
+
+                expired_fields = {}
+                for key, stream_ids in zip(batch, pipeline.execute()):
+                    for stream_id_str in stream_ids:
+                        try:
+                            stream_id = int(stream_id_str)
+                        except (TypeError, ValueError):
+                            log.error('Invalid stream id in tokens by {}'.format(key))
+                            continue
+
+                        if last_stream_id - stream_id > 1:
+                            expired_fields.setdefault(key, []).append(stream_id_str)
+
+                if len(expired_fields) == 0:
                     continue
 
-                if last_stream_id - stream_id > 1:
-                    log.info('Removing tokens for stream {}'.format(stream_id))
-                    redis.hdel(key, stream_id)
+                pipeline = redis.pipeline(transaction=False)
+                for key, stream_ids in expired_fields.items():
+                    pipeline.hdel(key, *stream_ids)
+                pipeline.execute()
+
+                num_pruned_keys += len(expired_fields)
+                num_pruned_fields += sum(len(stream_ids) for stream_ids in expired_fields.values())
+
+            log.info('Removed tokens from {0} streams in {1} of {2} token keys in {3:.2f}ms'.format(
+                num_pruned_fields, num_pruned_keys, num_keys, (time.time() - start) * 1000))
+            return (num_pruned_keys, num_pruned_fields)
+        except:
+            log.exception('Unhandled exception while expiring tokens')
 
     def on_loaded(self):
         if self.bot:
@@ -153,14 +215,36 @@ class QuestModule(BaseModule):
                 else:
                     log.info('No quest with id {} found in submodules ({})'.format(current_quest_id, self.submodules))
 
+    def flush_progress(self):
+        if self.current_quest is not None:
+            self.current_quest.flush_progress()
+
+    def on_flush_timer(self):
+        if self.enabled:
+            self.flush_progress()
+
     def enable(self, bot):
         HandlerManager.add_handler('on_stream_start', self.on_stream_start)
         HandlerManager.add_handler('on_stream_stop', self.on_stream_stop)
         HandlerManager.add_handler('on_managers_loaded', self.on_managers_loaded)
+        # Pending quest progress is flushed on commit, which includes shutting down
+        HandlerManager.add_handler('on_commit', self.flush_progress)
 
         self.bot = bot
+        self.enabled = True
+
+        if bot and not self.flush_scheduled:
+            # The module might not have loaded its settings yet if it's enabled through the web interface
+            flush_interval = self.settings.get('progress_flush_interval', self.default_settings['progress_flush_interval'])
+            bot.execute_every(flush_interval / 1000, self.on_flush_timer)
+            self.flush_scheduled = True
 
     def disable(self, bot):
         HandlerManager.remove_handler('on_stream_start', self.on_stream_start)
         HandlerManager.remove_handler('on_stream_stop', self.on_stream_stop)
         HandlerManager.remove_handler('on_managers_loaded', self.on_managers_loaded)
+        HandlerManager.remove_handler('on_commit', self.flush_progress)
+
+        # The progress is kept in case the module is enabled again
+        self.flush_progress()
+        self.enabled = False
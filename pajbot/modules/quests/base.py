@@ -12,6 +12,7 @@ class BaseQuest(BaseModule):
     def __init__(self):
         super().__init__()
         self.progress = {}
+        self.pending_progress = {}
         self.progress_key = '{streamer}:current_quest_progress'.format(streamer=StreamHelper.get_streamer())
 
     def start_quest(self):
@@ -26,16 +27,27 @@ class BaseQuest(BaseModule):
     def get_user_progress(self, username, default=False):
         return self.progress.get(username, default)
 
-    def set_user_progress(self, username, new_progress, redis=None):
+    def set_user_progress(self, username, new_progress):
+        """ Progress is kept in memory, and written to redis in batches by flush_progress """
+        self.progress[username] = new_progress
+        self.pending_progress[username] = new_progress
+
+    def flush_progress(self, redis=None):
+        """ Writes all progress that has been set since the last flush in one round trip """
+        if len(self.pending_progress) == 0:
+            return
+
         if redis is None:
             redis = RedisManager.get()
-        redis.hset(self.progress_key, username, new_progress)
-        self.progress[username] = new_progress
+        pending_progress = self.pending_progress
+        self.pending_progress = {}
+        redis.hmset(self.progress_key, pending_progress)
 
     def load_progress(self, redis=None):
         if redis is None:
             redis = RedisManager.get()
         self.progress = {}
+        self.pending_progress = {}
         old_progress = redis.hgetall(self.progress_key)
         for user, progress in old_progress.items():
             try:
@@ -53,6 +65,7 @@ class BaseQuest(BaseModule):
     def reset_progress(self, redis=None):
         if redis is None:
             redis = RedisManager.get()
+        self.pending_progress = {}
         redis.delete(self.progress_key)
 
     def get_objective(self):
@@ -41,7 +41,7 @@ class TypeEmoteQuestModule(BaseQuest):
                 if user_progress == self.LIMIT:
                     source.award_tokens(self.REWARD, redis=redis)
 
-                self.set_user_progress(source.username, user_progress, redis=redis)
+                self.set_user_progress(source.username, user_progress)
                 return
 
     def start_quest(self):
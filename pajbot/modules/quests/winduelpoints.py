@@ -77,7 +77,7 @@ class WinDuelPointsQuestModule(BaseQuest):
             winner.award_tokens(self.REWARD, redis=redis)
 
         # Save the users "points won" progress
-        self.set_user_progress(winner.username, total_points_won, redis=redis)
+        self.set_user_progress(winner.username, total_points_won)
 
     def start_quest(self):
         HandlerManager.add_handler('on_duel_complete', self.on_duel_complete)
@@ -33,7 +33,7 @@ class WinRaffleQuestModule(BaseQuest):
 
         winner.award_tokens(self.REWARD, redis=redis)
 
-        self.set_user_progress(winner.username, user_progress, redis=redis)
+        self.set_user_progress(winner.username, user_progress)
 
     def on_raffle_win(self, winner, points):
         self.winraffle_progress_quest(winner)
@@ -104,7 +104,7 @@ class RaffleModule(BaseModule):
             bot.say('{0}, a raffle is already running OMGScoots'.format(source.username_raw))
             return False
 
-        self.raffle_users = []
+        self.reset_raffle_users()
         self.raffle_running = True
         self.raffle_points = 100
         self.raffle_length = 60
@@ -153,6 +153,14 @@ class RaffleModule(BaseModule):
 
         # Added user to the raffle
         self.raffle_users.append(source)
+        self.bot.users.pin(source)
+
+    def reset_raffle_users(self):
+        """ Clear the list of raffle participants, and let the user manager
+        evict them again """
+        for user in self.raffle_users:
+            self.bot.users.unpin(user)
+        self.raffle_users = []
 
     def end_raffle(self):
         if not self.raffle_running:
@@ -166,7 +174,7 @@ class RaffleModule(BaseModule):
 
         winner = random.choice(self.raffle_users)
 
-        self.raffle_users = []
+        self.reset_raffle_users()
 
         self.bot.websocket_manager.emit('notification', {'message': '{} won {} points in the raffle!'.format(winner.username_raw, self.raffle_points)})
         self.bot.me('The raffle has finished! {0} won {1} points! PogChamp'.format(winner.username_raw, self.raffle_points))
@@ -254,7 +262,7 @@ class MultiRaffleModule(BaseModule):
             bot.say('{0}, a raffle is already running OMGScoots'.format(source.username_raw))
             return False
 
-        self.parent_module.raffle_users = []
+        self.parent_module.reset_raffle_users()
         self.parent_module.raffle_running = True
         self.parent_module.raffle_points = 100
         self.parent_module.raffle_length = 60
@@ -336,7 +344,7 @@ class MultiRaffleModule(BaseModule):
 
         log.info('k done. got {} winners'.format(num_winners))
         winners = self.parent_module.raffle_users[:num_winners]
-        self.parent_module.raffle_users = []
+        self.parent_module.reset_raffle_users()
 
         if negative:
             points_per_user *= -1
@@ -115,6 +115,79 @@ class SyncValue:
         self.synced = False
 
 
+class SlidingWindowCounter:
+    """
+    Counts how many things happened in the last `window` seconds.
+
+    The window is split into `num_buckets` buckets stored in a ring buffer,
+    so memory usage is constant and nothing has to be scheduled to
+    decrement the counter again. Buckets that fall out of the window are
+    cleared lazily whenever the counter is touched.
+    """
+
+    def __init__(self, window=60, num_buckets=60):
+        self.bucket_size = window / num_buckets
+        self.buckets = [0] * num_buckets
+        self.current_bucket = None
+        self.total = 0
+
+    def advance(self, now=None):
+        if now is None:
+            now = time.monotonic()
+
+        bucket = int(now // self.bucket_size)
+        if self.current_bucket is None:
+            self.current_bucket = bucket
+            return
+
+        elapsed = bucket - self.current_bucket
+        if elapsed <= 0:
+            return
+
+        num_buckets = len(self.buckets)
+        if elapsed >= num_buckets:
+            self.buckets = [0] * num_buckets
+            self.total = 0
+        else:
+            for i in range(self.current_bucket + 1, bucket + 1):
+                index = i % num_buckets
+                self.total -= self.buckets[index]
+                self.buckets[index] = 0
+
+        self.current_bucket = bucket
+
+    def add(self, count=1, now=None):
+        self.advance(now)
+        self.buckets[self.current_bucket % len(self.buckets)] += count
+        self.total += count
+        return self.total
+
+    def get(self, now=None):
+        self.advance(now)
+        return self.total
+
+
+class RateLimiter:
+    """
+    Spaces out calls to wait() so they return at most `rate` times per
+    second, no matter how many threads are calling it.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_time)
+            self.next_time = slot + self.interval
+
+        if slot > now:
+            time.sleep(slot - now)
+
+
 def time_since(t1, t2, format='long'):
     time_diff = t1 - t2
     if format == 'long':
@@ -19,6 +19,7 @@ from pajbot.models.stream import Stream
 from pajbot.models.db import DBManager
 from pajbot.models.sock import SocketClientManager
 from pajbot.managers.redis import RedisManager
+from pajbot.managers.leaderboard import LeaderboardManager
 from pajbot.streamhelper import StreamHelper
 
 import requests
@@ -65,8 +66,10 @@ def get_user(username):
     if user is None:
         return make_response(jsonify({'error': 'Not found'}), 404)
 
-    rank = session.query(func.Count(User.id)).filter(User.points > user.points).one()
-    rank = rank[0] + 1
+    rank = LeaderboardManager.get_rank('points', user.username, user.points)
+    if rank is None:
+        rank = session.query(func.Count(User.id)).filter(User.points > user.points).one()
+        rank = rank[0] + 1
     session.close()
     if user:
         accessible_data = {
@@ -55,6 +55,1608 @@ class TestURLMethods(unittest2.TestCase):
         # TODO: The protocol of a URL is entirely thrown away, this behaviour should probably be changed.
         self.assertEqual(find_unique_urls(regex, 'https://pajlada.se/ https://pajlada.se'), {'https://pajlada.se/', 'https://pajlada.se'})
 
+    def test_find_unique_urls_candidates(self):
+        from pajbot.modules.linkchecker import find_unique_urls
+        from pajbot.bot import Bot
+        import re
+
+        regex = re.compile(Bot.url_regex_str, re.IGNORECASE)
+
+        messages = ['', 'Kappa 123', 'hello... world', 'localhost/foo', 'LOCALHOST/bar localhost', '(pajlada.se)',
+                '127.0.0.1:8080/foo?bar=1#baz', 'user:pw@pajlada.se/a/b.html?c=d', 'www pajlada.se', 'www\tw.se www  foo.se']
+        for message in messages:
+            expected = set()
+            for match in regex.finditer(message):
+                url = match.group(0)
+                if not (url.startswith('http://') or url.startswith('https://')):
+                    url = 'http://' + url
+                if not(url[-1].isalpha() or url[-1].isnumeric() or url[-1] == '/'):
+                    url = url[:-1]
+                expected.add(url)
+            self.assertEqual(find_unique_urls(regex, message), expected, 'Wrong URLs for "{}"'.format(message))
+
+
+class TestBanphraseMatcher(unittest2.TestCase):
+    def get_banphrases(self):
+        from pajbot.models.banphrase import Banphrase
+        import pajbot.models.user
+
+        return [
+                Banphrase(phrase='Kappa', case_sensitive=True),
+                Banphrase(phrase='kappa 123'),
+                Banphrase(phrase='!Test', operator='startswith'),
+                Banphrase(phrase='LUL', operator='endswith', case_sensitive=True),
+                Banphrase(phrase='abab', sub_immunity=True),
+                Banphrase(phrase='bab'),
+                Banphrase(phrase='ÅÄÖ', operator='endswith'),
+                Banphrase(phrase='!test', operator='startswith', case_sensitive=True),
+                ]
+
+    def test_match(self):
+        from pajbot.models.banphrase import BanphraseMatcher
+
+        banphrases = self.get_banphrases()
+        matcher = BanphraseMatcher()
+        matcher.build(banphrases)
+
+        messages = ['', 'Kappa', 'kappa', 'KAPPA 123 Kappa', '!test foo', '!TEST LUL', 'lul', 'xababx', 'bab',
+                'hej åäö', 'ÅÄÖ hej', 'ababab LUL', '!test kappa 1234 LUL']
+        for message in messages:
+            expected = [banphrase for banphrase in banphrases if banphrase.predicate(message)]
+            self.assertEqual(matcher.match(message), expected, 'Wrong matches for "{}"'.format(message))
+
+    def test_update(self):
+        from pajbot.models.banphrase import BanphraseMatcher
+
+        banphrases = self.get_banphrases()
+        matcher = BanphraseMatcher()
+        matcher.build(banphrases)
+
+        self.assertEqual(matcher.match('ababab'), [banphrases[4], banphrases[5]])
+
+        matcher.remove(banphrases[4])
+        self.assertEqual(matcher.match('ababab'), [banphrases[5]])
+
+        banphrases[0].set(case_sensitive=False)
+        matcher.update(banphrases[0])
+        banphrases[4].set(phrase='b')
+        matcher.add(banphrases[4])
+        self.assertEqual(matcher.match('kappa ababab'), [banphrases[0], banphrases[5], banphrases[4]])
+
+        banphrases[5].set(operator='startswith')
+        matcher.update(banphrases[5])
+        self.assertEqual(matcher.match('ababab'), [banphrases[4]])
+        self.assertEqual(matcher.match('bab'), [banphrases[5], banphrases[4]])
+
+    def test_edit_banphrase(self):
+        from pajbot.benchmark.fakes import init_sqlite_db
+        from pajbot.models.banphrase import BanphraseManager
+        import pajbot.models.user
+
+        init_sqlite_db()
+        banphrase_manager = BanphraseManager(None).load()
+        banphrase, new_banphrase = banphrase_manager.create_banphrase('Kappa', name='kappa')
+        self.assertTrue(new_banphrase)
+        self.assertEqual(banphrase_manager.matcher.match('kappa 123'), [banphrase])
+
+        banphrase_manager.edit_banphrase(banphrase, case_sensitive=True, operator='endswith')
+        self.assertEqual(banphrase_manager.matcher.match('kappa 123'), [])
+        self.assertEqual(banphrase_manager.matcher.match('123 Kappa'), [banphrase])
+
+        banphrase_manager.edit_banphrase(banphrase, enabled=False)
+        self.assertEqual(banphrase_manager.matcher.match('123 Kappa'), [])
+        banphrase_manager.edit_banphrase(banphrase, enabled=True)
+        self.assertEqual(banphrase_manager.matcher.match('123 Kappa'), [banphrase])
+
+        # The changes were saved too
+        self.assertTrue(BanphraseManager(None).load().banphrases[0].case_sensitive)
+
+
+class TestFilterManager(unittest2.TestCase):
+    def test_check_message(self):
+        from pajbot.benchmark.fakes import init_sqlite_db
+        from pajbot.models.filter import Filter, FilterManager
+        import collections
+        import re
+
+        init_sqlite_db()
+        Source = collections.namedtuple('Source', ['username'])
+
+        filters = FilterManager()
+        for id, (type, phrase, source) in enumerate([
+                ('regex', r'f+o+', None),
+                ('regex', r'b(a)r', 'pajlada'),
+                ('banphrase', 'baz', None),
+                ('regex', r'(\w)\1{4}', None),
+                ('regex', r'[0-9]{3}', None),
+                ('regex', r'(?i)bar', None),
+                ]):
+            f = Filter(action={'type': 'say', 'message': 'hi'}, filter=phrase, type=type, name='filter {}'.format(id))
+            f.id = id + 1
+            f.source = source
+            if type == 'regex':
+                f.regex = re.compile(phrase)
+            filters.data.append(f)
+        filters.build_combined_regex()
+
+        self.assertIsNotNone(filters.combined_regex)
+        self.assertEqual(len(filters.combined_filters), 3)
+
+        pajlada = Source('pajlada')
+        forsen = Source('forsen')
+        for source, message, expected_id, expected_match in [
+                (pajlada, 'hello', None, None),
+                (pajlada, '123 foo', 1, 'foo'),
+                (pajlada, 'bar 123 foo', 1, 'foo'),
+                (forsen, 'bar 123', 5, '123'),
+                (pajlada, 'bar 123', 2, 'bar'),
+                (forsen, 'bar baz', 3, None),
+                (forsen, 'aaaaa 123', 4, 'aaaaa'),
+                (forsen, 'bar', 6, 'bar'),
+                (forsen, '123foo', 1, 'foo'),
+                (forsen, 'xbar foo', 1, 'foo'),
+                (forsen, 'xbar 1234', 5, '123'),
+                ]:
+            f, m = filters.check_message(source, message)
+            self.assertEqual(f.id if f else None, expected_id, 'Wrong filter for "{}"'.format(message))
+            self.assertEqual(m.group(0) if m else None, expected_match, 'Wrong match for "{}"'.format(message))
+
+
+class TestHandlerStats(unittest2.TestCase):
+    def test_trigger_timed(self):
+        from pajbot.models.handler import HandlerManager
+
+        class Module:
+            def on_message(self, message):
+                return message != 'stop'
+
+            def on_message_late(self, message):
+                pass
+
+        module = Module()
+        HandlerManager.init_handlers()
+        HandlerManager.add_handler('on_message', module.on_message, priority=10)
+        HandlerManager.add_handler('on_message', module.on_message_late)
+
+        HandlerManager.trigger('on_message', 'hi')
+        self.assertEqual(HandlerManager.get_stats(), [])
+
+        HandlerManager.enable_stats(num_samples=2)
+        try:
+            HandlerManager.trigger('on_message', 'hi')
+            HandlerManager.trigger('on_message', 'hi')
+            self.assertIs(HandlerManager.trigger('on_message', 'stop'), False)
+
+            stats = {handler_stats.name: handler_stats for event, handler_stats in HandlerManager.get_stats('on_message')}
+            self.assertEqual(stats['Module.on_message'].num_calls, 3)
+            self.assertEqual(stats['Module.on_message_late'].num_calls, 2)
+            self.assertEqual(sum(stats['Module.on_message'].histogram().values()), 2)
+            self.assertEqual(HandlerManager.jsonify_stats()['on_message'][0]['calls'] + HandlerManager.jsonify_stats()['on_message'][1]['calls'], 5)
+
+            HandlerManager.remove_handler('on_message', module.on_message_late)
+            HandlerManager.reset_stats()
+            HandlerManager.trigger('on_message', 'hi')
+            self.assertEqual([handler_stats.name for event, handler_stats in HandlerManager.get_stats()], ['Module.on_message'])
+        finally:
+            HandlerManager.disable_stats()
+            HandlerManager.reset_stats()
+
+
+class TestActiveChatters(unittest2.TestCase):
+    def test_lru(self):
+        from pajbot.models.user import ActiveChatters
+        import collections
+
+        Chatter = collections.namedtuple('Chatter', ['username'])
+        a, b, c, d = Chatter('a'), Chatter('B'), Chatter('c'), Chatter('d')
+
+        chatters = ActiveChatters(capacity=3)
+        for chatter in [a, b, c]:
+            chatters.touch(chatter)
+        self.assertEqual(list(chatters), [c, b, a])
+
+        chatters.touch(a)
+        self.assertEqual(list(chatters), [a, c, b])
+
+        chatters.touch(d)
+        self.assertEqual(list(chatters), [d, a, c])
+        self.assertNotIn('b', chatters)
+        self.assertIn('A', chatters)
+
+        chatters.remove('c')
+        self.assertEqual(len(chatters), 2)
+        self.assertEqual(list(chatters), [d, a])
+
+
+class TestUserManager(unittest2.TestCase):
+    def test_evict(self):
+        from pajbot.benchmark.fakes import init_sqlite_db
+        from pajbot.models.db import DBManager
+        from pajbot.models.user import User, UserManager, ActiveChatters
+
+        init_sqlite_db()
+        users = UserManager(capacity=3)
+        active_chatters = ActiveChatters()
+        users.pin_sources.append(active_chatters)
+
+        for username in ['a', 'b', 'c', 'd', 'e', 'f']:
+            users[username].points = 10
+        users.commit()
+
+        users['a'].points += 5
+        active_chatters.touch(users['b'])
+        users['c'].create_debt(100)
+        users.pin(users['d'])
+        users['e']
+
+        # f and a are the least recently used, b, c and d are pinned
+        self.assertEqual(users.evict(), 3)
+        self.assertEqual(list(users.data.keys()), ['b', 'c', 'd'])
+        self.assertEqual(users.evict(), 0)
+
+        users['g']
+        users.unpin(users.data['d'])
+        self.assertEqual(users.evict(), 1)
+        self.assertEqual(list(users.data.keys()), ['b', 'c', 'g'])
+
+        users['a'].points += 5
+        users.commit()
+        with DBManager.create_session_scope() as db_session:
+            self.assertEqual(db_session.query(User).filter_by(username='a').one().points, 20)
+
+    def test_evict_idle(self):
+        from pajbot.benchmark.fakes import init_sqlite_db
+        from pajbot.models.db import DBManager
+        from pajbot.models.user import User, UserManager
+
+        init_sqlite_db()
+        users = UserManager(max_idle=60)
+        users['a'].points = 5
+        users['b']
+        users.last_used['a'] -= 120
+
+        self.assertEqual(users.evict(), 1)
+        self.assertEqual(list(users.data.keys()), ['b'])
+
+        users.commit()
+        with DBManager.create_session_scope() as db_session:
+            self.assertEqual(db_session.query(User).filter_by(username='a').one().points, 5)
+
+
+class TestUserCounterWriter(unittest2.TestCase):
+    def test_flush_counters(self):
+        from pajbot.benchmark.fakes import init_sqlite_db
+        from pajbot.models.db import DBManager
+        from pajbot.models.user import User, UserManager, UserCounterWriter
+
+        init_sqlite_db()
+        users = UserManager(counter_writer=UserCounterWriter())
+
+        def get_row(username):
+            return DBManager.engine.execute(User.__table__.select().where(User.__table__.c.username == username)).first()
+
+        users['a'].points = 10
+        users.commit()
+
+        user = users['a']
+        user.points += 10
+        user.num_lines += 1
+        user.level = 500
+        self.assertEqual(users.flush_counters(), 1)
+        self.assertEqual(users.flush_counters(), 0)
+        users.counter_writer.wait()
+
+        row = get_row('a')
+        self.assertEqual(row.points, 20)
+        self.assertEqual(row.num_lines, 1)
+        self.assertEqual(row.level, 100)
+
+        # Only the level is left for the commit
+        self.assertIn(user, users.db_session.dirty)
+        users.commit()
+        self.assertEqual(get_row('a').level, 500)
+        self.assertEqual(user.points, 20)
+
+    def test_flushed_users_are_skipped(self):
+        from pajbot.benchmark.fakes import init_sqlite_db
+        from pajbot.models.db import DBManager
+        from pajbot.models.user import User, UserManager, UserCounterWriter
+
+        init_sqlite_db()
+        users = UserManager(counter_writer=UserCounterWriter())
+
+        # New users are flushed, so their rows are locked until the next commit
+        users['b'].points = 5
+        self.assertEqual(users.flush_counters(), 0)
+        users.commit()
+
+        users['b'].points = 15
+        self.assertEqual(users.flush_counters(), 1)
+        users.commit()
+
+        with DBManager.create_session_scope() as db_session:
+            self.assertEqual(db_session.query(User).filter_by(username='b').one().points, 15)
+
+    def test_counters_are_handed_off_before_flushes(self):
+        from pajbot.benchmark.fakes import init_sqlite_db
+        from pajbot.models.user import UserManager, UserCounterWriter
+
+        init_sqlite_db()
+        counter_writer = UserCounterWriter()
+        users = UserManager(counter_writer=counter_writer)
+        for username in ('a', 'b'):
+            users[username]
+        users.commit()
+
+        written = []
+        counter_writer.write = lambda columns, rows: written.extend(rows)
+        counter_writer.update_leaderboards = lambda scores: None
+
+        def wait(timeout=None):
+            self.fail('The counter writer has nothing to write for the flushed users')
+        counter_writer.wait = wait
+
+        # Creating a new user flushes the session, but only the new user's row is written
+        users['a'].points += 5
+        users['c']
+        users['b'].num_lines += 1
+        users['d']
+        self.assertEqual(users.flushed_usernames, {'c', 'd'})
+        self.assertEqual(users.flush_counters(), 0)
+
+        del counter_writer.wait
+        counter_writer.wait()
+        self.assertEqual(sorted(written, key=lambda row: row['b_id']), [
+            {'b_id': users['a'].id, 'b_points': 5},
+            {'b_id': users['b'].id, 'b_num_lines': 1},
+            ])
+
+        # A user with other changes is written by the flush, so its queued counters must be written first
+        waits = []
+        counter_writer.wait = lambda timeout=None: waits.append(timeout)
+        users['a'].level = 500
+        users['e']
+        self.assertEqual(len(waits), 1)
+        self.assertEqual(users.flushed_usernames, {'a', 'c', 'd', 'e'})
+
+
+class TestDBWriter(unittest2.TestCase):
+    def test_commit(self):
+        from pajbot.benchmark.fakes import init_sqlite_db
+        from pajbot.models.db import DBManager, DBWriter
+        from pajbot.models.user import User
+        from sqlalchemy import inspect
+
+        init_sqlite_db()
+        db_writer = DBWriter()
+
+        db_session = DBManager.create_session()
+        user = User('a')
+        db_session.add(user)
+        db_session.commit()
+
+        user.points += 50
+        user.level = 500
+        new_user = User('b')
+        db_session.add(new_user)
+
+        self.assertEqual(db_writer.commit('users', db_session), 1)
+        self.assertEqual(len(db_session.dirty), 0)
+        self.assertEqual(len(db_session.new), 0)
+        self.assertEqual(len(inspect(user).expired_attributes), 0)
+        db_writer.wait()
+
+        with DBManager.create_session_scope() as other_session:
+            user = other_session.query(User).filter_by(username='a').one()
+            self.assertEqual(user.points, 50)
+            self.assertEqual(user.level, 500)
+            self.assertEqual(other_session.query(User).filter_by(username='b').count(), 1)
+
+        # Nothing to write
+        self.assertEqual(db_writer.commit('users', db_session), 0)
+
+    def test_failed_write_is_retried(self):
+        from pajbot.benchmark.fakes import init_sqlite_db
+        from pajbot.models.db import DBManager, DBWriter
+        from pajbot.models.user import User
+
+        init_sqlite_db()
+        db_writer = DBWriter()
+
+        db_session = DBManager.create_session()
+        user = User('a')
+        db_session.add(user)
+        db_session.commit()
+
+        def get_points():
+            with DBManager.create_session_scope() as other_session:
+                return other_session.query(User).filter_by(username='a').one().points
+
+        def create_session_scope(**options):
+            raise ValueError('The database is gone')
+
+        user.points += 50
+        original_create_session_scope = DBManager.create_session_scope
+        DBManager.create_session_scope = create_session_scope
+        try:
+            self.assertEqual(db_writer.commit('users', db_session), 1)
+            db_writer.wait()
+        finally:
+            DBManager.create_session_scope = original_create_session_scope
+        self.assertIn('users', db_writer.failed_mappings)
+        self.assertEqual(get_points(), 0)
+
+        # The failed changes are written with the next commit, even if it has nothing new
+        self.assertEqual(db_writer.commit('users', db_session), 0)
+        db_writer.wait()
+        self.assertEqual(get_points(), 50)
+        self.assertEqual(db_writer.failed_mappings, {})
+
+        user.points += 10
+        db_writer.commit('users', db_session)
+        db_writer.wait()
+        self.assertEqual(get_points(), 60)
+
+        # A direct commit writes newer values than the failed ones, which must not be retried
+        DBManager.create_session_scope = create_session_scope
+        try:
+            user.points += 10
+            db_writer.commit('users', db_session)
+            db_writer.wait()
+        finally:
+            DBManager.create_session_scope = original_create_session_scope
+        user.points += 5
+        db_session.commit()
+        self.assertEqual(db_writer.failed_mappings, {})
+        self.assertEqual(db_writer.pending, {})
+        db_writer.commit('users', db_session)
+        db_writer.wait()
+        self.assertEqual(get_points(), 75)
+
+    def test_direct_commit_waits_for_pending_writes(self):
+        import threading
+        from pajbot.benchmark.fakes import init_sqlite_db
+        from pajbot.models.db import DBManager, DBWriter
+        from pajbot.models.user import User
+
+        init_sqlite_db()
+        db_writer = DBWriter()
+
+        db_session = DBManager.create_session()
+        user = User('a')
+        db_session.add(user)
+        db_session.commit()
+
+        # Keep the writer busy, so the snapshot is still queued when we commit directly
+        writer_busy = threading.Event()
+        db_writer.action_queue.add(writer_busy.wait)
+        user.points = 50
+        self.assertEqual(db_writer.commit('users', db_session), 1)
+
+        threading.Timer(0.1, writer_busy.set).start()
+        user.points = 70
+        db_session.commit()
+        db_writer.wait()
+
+        with DBManager.create_session_scope() as other_session:
+            self.assertEqual(other_session.query(User).filter_by(username='a').one().points, 70)
+
+
+class TestAwardChatters(unittest2.TestCase):
+    def test_award_chatters(self):
+        from pajbot.benchmark.fakes import init_sqlite_db
+        from pajbot.models.db import DBManager
+        from pajbot.models.user import User, UserManager
+
+        init_sqlite_db()
+
+        with DBManager.create_session_scope() as db_session:
+            for username, subscriber in [('a', True), ('b', False), ('c', True), ('d', False)]:
+                user = User(username)
+                user.points = 100
+                user.subscriber = subscriber
+                db_session.add(user)
+
+        users = UserManager()
+        users['a']
+        users['b'].tag_as('trump_sub')
+
+        num_inserted = users.award_chatters(['a', 'b', 'c', 'd', 'e', 'e'], 2,
+                minutes_in_chat_offline=5,
+                subscriber_multiplier=5,
+                tag_multipliers={'trump_sub': 0.5},
+                chunk_size=2)
+        self.assertEqual(num_inserted, 1)
+
+        # Cached users are updated in memory
+        self.assertEqual(users.data['a'].points, 110)
+        self.assertEqual(users.data['b'].points, 101)
+        self.assertEqual(users.data['b'].minutes_in_chat_offline, 5)
+        self.assertNotIn('c', users.data)
+        self.assertNotIn('e', users.data)
+
+        # Uncached users are committed right away
+        with DBManager.create_session_scope() as db_session:
+            self.assertEqual(db_session.query(User).filter_by(username='c').one().points, 110)
+            self.assertEqual(db_session.query(User).filter_by(username='e').one().points, 2)
+
+        self.assertEqual(users['c'].points, 110)
+        self.assertEqual(users['d'].points, 102)
+        self.assertEqual(users['d'].minutes_in_chat_offline, 5)
+        self.assertEqual(users['e'].points, 2)
+        self.assertEqual(users['e'].level, 100)
+        users.commit()
+
+        with DBManager.create_session_scope() as db_session:
+            points = {user.username: user.points for user in db_session.query(User)}
+            self.assertEqual(points, {'a': 110, 'b': 101, 'c': 110, 'd': 102, 'e': 2})
+
+
+    def test_award_uncached_session_users(self):
+        from pajbot.benchmark.fakes import init_sqlite_db
+        from pajbot.models.db import DBManager
+        from pajbot.models.user import User, UserManager
+
+        init_sqlite_db()
+
+        with DBManager.create_session_scope() as db_session:
+            for username in ['a', 'b']:
+                user = User(username)
+                user.points = 100
+                db_session.add(user)
+
+        users = UserManager()
+        # find() loads the user without caching it
+        user = users.find('a')
+        user.points -= 50
+        self.assertNotIn('a', users.data)
+
+        users.award_chatters(['a', 'b'], 2)
+        self.assertEqual(user.points, 52)
+        users.commit()
+
+        with DBManager.create_session_scope() as db_session:
+            points = {user.username: user.points for user in db_session.query(User)}
+            self.assertEqual(points, {'a': 52, 'b': 102})
+
+
+class TestUpdateSubscribers(unittest2.TestCase):
+    def test_update_subscribers(self):
+        from pajbot.benchmark.fakes import init_sqlite_db
+        from pajbot.models.db import DBManager
+        from pajbot.models.user import User, UserManager
+
+        init_sqlite_db()
+
+        with DBManager.create_session_scope() as db_session:
+            for username, subscriber in [('a', True), ('b', True), ('c', False), ('d', True)]:
+                user = User(username)
+                user.subscriber = subscriber
+                db_session.add(user)
+
+        users = UserManager()
+        users['b']
+        users['c'].subscriber = True
+        self.assertEqual(users.get_subscriber_usernames(), set(['a', 'b', 'c', 'd']))
+
+        self.assertEqual(users.update_subscribers(['e'], ['b', 'd'], chunk_size=1), 1)
+        self.assertFalse(users.data['b'].subscriber)
+        self.assertNotIn('d', users.data)
+        self.assertEqual(users.get_subscriber_usernames(), set(['a', 'c', 'e']))
+
+        users.commit()
+        with DBManager.create_session_scope() as db_session:
+            subscribers = set(user.username for user in db_session.query(User).filter_by(subscriber=True))
+            self.assertEqual(subscribers, set(['a', 'c', 'e']))
+
+    def test_award_known_chatters(self):
+        from pajbot.benchmark.fakes import init_sqlite_db
+        from pajbot.models.user import UserManager
+
+        init_sqlite_db()
+        users = UserManager()
+
+        self.assertEqual(users.award_chatters(['a', 'b'], 1), 2)
+        self.assertEqual(users.award_chatters(['a', 'b', 'c'], 1, known_usernames=set(['a', 'b'])), 1)
+        self.assertEqual(users['a'].points, 2)
+        self.assertEqual(users['c'].points, 1)
+
+
+class TestGetAllSubscribers(unittest2.TestCase):
+    def get_api(self, total, failing_offsets):
+        from pajbot.apiwrappers import TwitchAPI
+
+        class SubscribersAPI(TwitchAPI):
+            def get_subscribers_page(self, streamer, limit=100, offset=0):
+                if failing_offsets.get(offset, 0) > 0:
+                    failing_offsets[offset] -= 1
+                    raise ValueError('No data returned while fetching subscribers')
+                return ['sub{0}'.format(i) for i in range(offset, min(offset + limit, total))], total
+
+        return SubscribersAPI()
+
+    def test_get_all_subscribers(self):
+        api = self.get_api(950, {0: 1, 300: 2})
+        chunks = []
+
+        res = api.get_all_subscribers('pajlada', lambda *args: chunks.append(args),
+                requests_per_second=1000, retry_delay=0, chunk_size=300)
+        self.assertTrue(res)
+
+        self.assertEqual([(first, last) for subscribers, first, last in chunks], [(True, False), (False, False), (False, False), (False, True)])
+        subscribers = [subscriber for chunk in chunks for subscriber in chunk[0]]
+        self.assertEqual(sorted(subscribers), sorted('sub{0}'.format(i) for i in range(0, 950)))
+
+    def test_get_all_subscribers_failing_page(self):
+        api = self.get_api(950, {500: 3})
+        chunks = []
+
+        res = api.get_all_subscribers('pajlada', lambda *args: chunks.append(args),
+                requests_per_second=1000, retry_delay=0, chunk_size=300)
+        self.assertFalse(res)
+        self.assertNotIn(True, [last for subscribers, first, last in chunks])
+
+
+class TestLeaderboardManager(unittest2.TestCase):
+    def setUp(self):
+        from pajbot.benchmark.fakes import FakeRedis
+        from pajbot.managers.redis import RedisManager
+        from pajbot.streamhelper import StreamHelper
+
+        RedisManager.redis = FakeRedis()
+        StreamHelper.init_streamer('pajlada')
+
+    def test_rank(self):
+        from pajbot.managers.leaderboard import LeaderboardManager
+
+        self.assertIsNone(LeaderboardManager.get_rank('points', 'a', 10))
+        self.assertIsNone(LeaderboardManager.get_top('points', 3))
+
+        LeaderboardManager.update({
+            'a': {'points': 10, 'num_lines': 5},
+            'b': {'points': 20, 'num_lines': 5},
+            'c': {'points': 20, 'num_lines': 1},
+            'd': {'points': 5, 'num_lines': 0},
+            })
+
+        self.assertEqual(LeaderboardManager.get_rank('points', 'b', 20), 1)
+        self.assertEqual(LeaderboardManager.get_rank('points', 'a', 10), 3)
+        self.assertEqual(LeaderboardManager.get_rank('num_lines', 'c', 1), 3)
+        # The leaderboard doesn't know about a's new score yet
+        self.assertEqual(LeaderboardManager.get_rank('points', 'd', 30), 1)
+        self.assertEqual(LeaderboardManager.get_rank('points', 'b', 15), 2)
+        self.assertEqual(LeaderboardManager.get_rank('points', 'e', 0), 5)
+
+        self.assertEqual(LeaderboardManager.get_top('points', 3), [('c', 20), ('b', 20), ('a', 10)])
+
+    def test_rebuild_and_counter_writer(self):
+        from pajbot.benchmark.fakes import init_sqlite_db, FakeRedis
+        from pajbot.managers.leaderboard import LeaderboardManager
+        from pajbot.managers.redis import RedisManager
+        from pajbot.models.user import UserManager, UserCounterWriter
+
+        init_sqlite_db()
+        users = UserManager(counter_writer=UserCounterWriter())
+        for i, username in enumerate(['a', 'b', 'c']):
+            users[username].points = i * 10
+            users[username].num_lines = i
+            users[username].minutes_in_chat_offline = 3 - i
+        users.commit()
+
+        # New users are written with the commit, and the counter writer updates their leaderboards
+        self.assertEqual(LeaderboardManager.get_top('points', 1), [('c', 20)])
+        RedisManager.redis = FakeRedis()
+
+        self.assertFalse(LeaderboardManager.exists())
+        self.assertEqual(LeaderboardManager.rebuild(), 3)
+        self.assertTrue(LeaderboardManager.exists())
+        self.assertEqual(LeaderboardManager.get_top('points', 5), [('c', 20), ('b', 10), ('a', 0)])
+        self.assertEqual(LeaderboardManager.get_top('minutes_in_chat', 1), [('a', 3)])
+
+        users['a'].points += 100
+        users.flush_counters()
+        users.counter_writer.wait()
+        self.assertEqual(LeaderboardManager.get_top('points', 1), [('a', 100)])
+
+        users.award_chatters(['d'], 5, minutes_in_chat_offline=10)
+        users.counter_writer.wait()
+        self.assertEqual(LeaderboardManager.get_top('minutes_in_chat', 1), [('d', 10)])
+
+        # d wasn't cached when it was awarded
+        users['d'].num_lines += 50
+        users.flush_counters()
+        users.counter_writer.wait()
+        self.assertEqual(LeaderboardManager.get_top('num_lines', 1), [('d', 50)])
+
+        # New users are flushed, so their counters are written with the commit
+        users['e'].num_lines += 70
+        self.assertEqual(users.flush_counters(), 0)
+        users.commit()
+        self.assertEqual(LeaderboardManager.get_top('num_lines', 1), [('e', 70)])
+        self.assertEqual(LeaderboardManager.rebuild(), 5)
+        self.assertEqual(LeaderboardManager.get_top('num_lines', 2), [('e', 70), ('d', 50)])
+
+    def test_updates_during_rebuild(self):
+        from pajbot.benchmark.fakes import init_sqlite_db
+        from pajbot.managers.leaderboard import LeaderboardManager
+        from pajbot.managers.redis import RedisManager
+        from pajbot.models.db import DBManager
+        from pajbot.models.user import User
+
+        init_sqlite_db()
+        with DBManager.create_session_scope() as db_session:
+            for i, username in enumerate(['a', 'b']):
+                user = User(username)
+                user.points = i * 10
+                db_session.add(user)
+
+        original_select_scores = LeaderboardManager.select_scores
+
+        def select_scores():
+            # a's new points aren't in the database yet when the rows are read
+            LeaderboardManager.update({'a': {'points': 50}})
+            return original_select_scores()
+
+        LeaderboardManager.select_scores = select_scores
+        try:
+            self.assertEqual(LeaderboardManager.rebuild(), 2)
+        finally:
+            LeaderboardManager.select_scores = original_select_scores
+
+        self.assertFalse(LeaderboardManager.rebuilding)
+        self.assertEqual(LeaderboardManager.get_top('points', 2), [('a', 50), ('b', 10)])
+        self.assertFalse(RedisManager.get().exists(LeaderboardManager.get_updates_key('points')))
+
+
+class TestUserTokens(unittest2.TestCase):
+    def setUp(self):
+        from pajbot.benchmark.fakes import FakeRedis
+        from pajbot.managers.redis import RedisManager
+        from pajbot.streamhelper import StreamHelper
+
+        RedisManager.redis = FakeRedis()
+        StreamHelper.init_streamer('pajlada')
+
+    def tearDown(self):
+        from pajbot.streamhelper import StreamHelper
+
+        StreamHelper.stream_manager = None
+
+    def set_current_stream_id(self, stream_id):
+        from types import SimpleNamespace
+        from pajbot.streamhelper import StreamHelper
+
+        current_stream = SimpleNamespace(id=stream_id) if stream_id is not None else None
+        StreamHelper.stream_manager = SimpleNamespace(current_stream=current_stream)
+
+    def test_award_and_spend(self):
+        from pajbot.managers.redis import RedisManager
+        from pajbot.models.user import User
+
+        user = User(username='pajlada')
+        self.assertEqual(user.get_tokens(), 0)
+        # The stream is offline
+        self.set_current_stream_id(None)
+        self.assertFalse(user.award_tokens(3))
+
+        self.set_current_stream_id(1)
+        self.assertTrue(user.award_tokens(3))
+        self.assertFalse(user.award_tokens(3))
+        self.set_current_stream_id(2)
+        self.assertTrue(user.award_tokens(4))
+        self.assertEqual(user.get_tokens(), 7)
+
+        num_calls = RedisManager.redis.num_calls
+        self.assertFalse(user.spend_tokens(8))
+        self.assertEqual(user.get_tokens(), 7)
+        self.assertTrue(user.spend_tokens(5))
+        self.assertEqual(user.get_tokens(), 2)
+        self.assertTrue(user.can_afford_with_tokens(2))
+        self.assertFalse(user.can_afford_with_tokens(3))
+        # Every operation is a single round trip
+        self.assertEqual(RedisManager.redis.num_calls - num_calls, 6)
+
+    def test_take_and_refund(self):
+        from pajbot.models.user import User
+
+        user = User(username='pajlada')
+        self.set_current_stream_id(1)
+        user.award_tokens(3)
+        self.set_current_stream_id(2)
+        user.award_tokens(4)
+
+        self.assertIsNone(user.take_tokens(10))
+        spent = user.take_tokens(5)
+        self.assertEqual(sum(spent.values()), 5)
+        self.assertEqual(user.get_tokens(), 2)
+        user.refund_tokens(spent)
+        self.assertEqual(user.get_tokens(), 7)
+        # The tokens are given back to the stream they were taken from
+        self.assertFalse(user.award_tokens(4))
+
+    def test_refund_when_command_raises(self):
+        from pajbot.models.command import Command
+        from pajbot.models.user import User
+
+        user = User(username='pajlada')
+        self.set_current_stream_id(1)
+        user.award_tokens(5)
+
+        def cb(**options):
+            raise ValueError('The action failed')
+
+        command = Command.raw_command(cb, tokens_cost=3)
+        with self.assertRaises(ValueError):
+            command.run(None, user, None)
+        self.assertEqual(user.get_tokens(), 5)
+
+
+class TestUserWarnings(unittest2.TestCase):
+    def setUp(self):
+        from types import SimpleNamespace
+        from pajbot.benchmark.fakes import FakeRedis
+        from pajbot.managers.redis import RedisManager
+
+        RedisManager.redis = FakeRedis()
+        self.warning_module = SimpleNamespace(settings={
+            'total_chances': 2,
+            'length': 600,
+            'base_timeout': 10,
+            'redis_prefix': '',
+            })
+
+    def test_timeout(self):
+        from pajbot.managers.redis import RedisManager
+        from pajbot.models.user import User
+
+        user = User(username='pajlada')
+        self.assertEqual(user.timeout(300, warning_module=self.warning_module), (10, 'timed out for 10 seconds (warning)'))
+        self.assertEqual(user.timeout(300, warning_module=self.warning_module), (20, 'timed out for 20 seconds (warning)'))
+        self.assertEqual(user.timeout(300, warning_module=self.warning_module), (300, 'timed out for 300 seconds'))
+        self.assertEqual(user.timeout(300, warning_module=self.warning_module, use_warnings=False), (300, 'timed out for 300 seconds'))
+
+        # The first warning ran out, so the user gets that chance back
+        RedisManager.redis.delete(user.get_warning_keys(2, '')[0])
+        self.assertEqual(user.timeout(300, warning_module=self.warning_module), (20, 'timed out for 20 seconds (warning)'))
+        self.assertEqual(user.timeout(300, warning_module=self.warning_module), (300, 'timed out for 300 seconds'))
+
+    def test_timeout_warn_many(self):
+        from types import SimpleNamespace
+        from pajbot.bot import Bot
+        from pajbot.managers.redis import RedisManager
+        from pajbot.models.user import User
+
+        timeouts = []
+        bot = SimpleNamespace(
+                module_manager={'warning': self.warning_module},
+                timeout=lambda username, duration: timeouts.append((username, duration)))
+        a = User(username='a')
+        b = User(username='b')
+        mod = User(username='mod')
+        mod.ban_immune = True
+        a.timeout(300, warning_module=self.warning_module)
+
+        num_calls = RedisManager.redis.num_calls
+        punishments = Bot.timeout_warn_many(bot, [(a, 300), (b, 300), (mod, 300), (a, 300)])
+        self.assertEqual(RedisManager.redis.num_calls - num_calls, 1)
+        self.assertEqual(punishments, [
+            (20, 'timed out for 20 seconds (warning)'),
+            (10, 'timed out for 10 seconds (warning)'),
+            (0, 'timed out for 10 seconds (warning)'),
+            (300, 'timed out for 300 seconds'),
+            ])
+        self.assertEqual(timeouts, [('a', 20), ('b', 10), ('a', 300)])
+
+
+class TestQuestTokenExpiry(unittest2.TestCase):
+    def test_expire_tokens(self):
+        from pajbot.benchmark.fakes import FakeRedis
+        from pajbot.managers.redis import RedisManager
+        from pajbot.modules.quest import QuestModule
+        from pajbot.streamhelper import StreamHelper
+
+        redis = RedisManager.redis = FakeRedis()
+        StreamHelper.init_streamer('pajlada')
+
+        for i in range(25):
+            redis.hmset('pajlada:user{0}:tokens'.format(i), {'1': 3, '2': 3, '5': 3, '6': 3})
+        redis.hmset('pajlada:new:tokens', {'6': 3})
+        redis.set('pajlada:current_quest', 'quest-typeemote')
+
+        num_calls = redis.num_calls
+        self.assertEqual(QuestModule().expire_tokens(6, batch_size=10), (25, 50))
+        # 3 SCAN batches, each read and pruned with one pipeline each
+        self.assertEqual(redis.num_calls - num_calls, 3 + 3 * 2)
+
+        self.assertEqual(redis.hgetall('pajlada:user0:tokens'), {'5': '3', '6': '3'})
+        self.assertEqual(redis.hgetall('pajlada:new:tokens'), {'6': '3'})
+        self.assertEqual(redis.get('pajlada:current_quest'), 'quest-typeemote')
+
+
+class TestQuestProgress(unittest2.TestCase):
+    def test_buffered_progress(self):
+        from types import SimpleNamespace
+        from pajbot.benchmark.fakes import FakeRedis
+        from pajbot.managers.redis import RedisManager
+        from pajbot.models.handler import HandlerManager
+        from pajbot.models.user import User
+        from pajbot.modules.quests.typeemote import TypeEmoteQuestModule
+        from pajbot.streamhelper import StreamHelper
+
+        redis = RedisManager.redis = FakeRedis()
+        StreamHelper.init_streamer('pajlada')
+        StreamHelper.stream_manager = SimpleNamespace(current_stream=SimpleNamespace(id=1))
+        HandlerManager.init_handlers()
+        awarded = []
+        HandlerManager.add_handler('on_user_gain_tokens', lambda user, tokens: awarded.append(user.username))
+
+        try:
+            quest = TypeEmoteQuestModule()
+            quest.current_emote = 'Kappa'
+            quest.LIMIT = 3
+            users = [User(username=username) for username in ('a', 'b')]
+
+            num_calls = redis.num_calls
+            for i in range(5):
+                for user in users:
+                    quest.on_message(user, 'Kappa', [{'code': 'Kappa'}], False, [], None)
+            # Only completing the quest touches redis until the progress is flushed
+            self.assertEqual(redis.num_calls - num_calls, 2)
+            self.assertEqual(awarded, ['a', 'b'])
+            self.assertEqual(users[0].get_tokens(), 5)
+            self.assertEqual(redis.hgetall(quest.progress_key), {})
+
+            quest.flush_progress()
+            self.assertEqual(redis.hgetall(quest.progress_key), {'a': '3', 'b': '3'})
+            num_calls = redis.num_calls
+            quest.flush_progress()
+            self.assertEqual(redis.num_calls, num_calls)
+
+            quest.load_progress()
+            self.assertEqual(quest.get_user_progress('a'), 3)
+        finally:
+            StreamHelper.stream_manager = None
+
+    def test_flush_timer_and_stream_stop(self):
+        from types import SimpleNamespace
+        from pajbot.benchmark.fakes import FakeRedis
+        from pajbot.managers.redis import RedisManager
+        from pajbot.models.handler import HandlerManager
+        from pajbot.modules.quest import QuestModule
+        from pajbot.modules.quests.winraffle import WinRaffleQuestModule
+        from pajbot.streamhelper import StreamHelper
+
+        redis = RedisManager.redis = FakeRedis()
+        StreamHelper.init_streamer('pajlada')
+        HandlerManager.init_handlers()
+
+        timers = []
+        bot = SimpleNamespace(streamer='pajlada', say=lambda message: None,
+                execute_every=lambda period, function: timers.append(function),
+                action_queue=SimpleNamespace(add=lambda f, args=[], kwargs={}: None))
+
+        module = QuestModule()
+        module.enable(bot)
+        module.on_loaded()
+        quest = module.current_quest = WinRaffleQuestModule()
+        quest.set_user_progress('a', 1)
+
+        # The timer keeps running after the module is disabled, but it doesn't flush anymore
+        module.disable(bot)
+        self.assertEqual(redis.hgetall(quest.progress_key), {'a': '1'})
+        quest.set_user_progress('a', 2)
+        timers[0]()
+        self.assertEqual(redis.hgetall(quest.progress_key), {'a': '1'})
+
+        module.enable(bot)
+        self.assertEqual(len(timers), 1)
+        timers[0]()
+        self.assertEqual(redis.hgetall(quest.progress_key), {'a': '2'})
+
+        # The progress of a stopped quest is thrown away instead of being written
+        quest.set_user_progress('a', 3)
+        redis.hmset = lambda key, mapping: self.fail('The progress of a stopped quest was written')
+        module.on_stream_stop()
+        self.assertEqual(quest.pending_progress, {})
+        self.assertEqual(redis.hgetall(quest.progress_key), {})
+
+
+class TestUserCooldowns(unittest2.TestCase):
+    def test_purge(self):
+        from pajbot.models.command import UserCooldowns
+
+        cooldowns = UserCooldowns()
+        cooldowns.set('a', 1000.0, 15)
+        cooldowns.set('b', 1005.0, 15)
+        cooldowns.set('a', 1010.0, 15)
+        self.assertEqual(cooldowns.get('a'), 1010.0)
+        self.assertEqual(len(cooldowns), 2)
+
+        cooldowns.set('c', 1021.0, 15)
+        self.assertEqual(cooldowns.get('b'), 0)
+        self.assertEqual(cooldowns.get('a'), 1010.0)
+        self.assertEqual(len(cooldowns), 2)
+        self.assertEqual(len(cooldowns.runs), 2)
+
+        cooldowns.purge(15, now=1100.0)
+        self.assertEqual(len(cooldowns), 0)
+        self.assertEqual(len(cooldowns.runs), 0)
+
+    def test_snapshot(self):
+        import time
+        from pajbot.benchmark.fakes import FakeRedis
+        from pajbot.managers.redis import RedisManager
+        from pajbot.models.command import Command, CommandManager
+        from pajbot.streamhelper import StreamHelper
+
+        redis = RedisManager.redis = FakeRedis()
+        StreamHelper.init_streamer('pajlada')
+
+        now = time.time()
+        commands = CommandManager()
+        points = Command(command='points|p', delay_user=15)
+        commands.data = {'points': points, 'p': points, 'ping': Command(command='ping', delay_user=10)}
+        points.last_run_by_user.set('a', now - 20, 15)
+        points.last_run_by_user.set('b', now - 5, 15)
+        points.last_run_by_user.set('c', now - 1, 15)
+
+        num_calls = redis.num_calls
+        self.assertEqual(commands.snapshot_cooldowns(), 2)
+        self.assertEqual(redis.num_calls - num_calls, 1)
+        self.assertEqual(set(redis.hgetall('pajlada:cooldowns:p')), {'b', 'c'})
+        self.assertFalse(redis.exists('pajlada:cooldowns:ping'))
+
+        new_commands = CommandManager()
+        new_points = Command(command='points|p', delay_user=15)
+        new_commands.data = {'p': new_points, 'points': new_points}
+        self.assertEqual(new_commands.restore_cooldowns(), 2)
+        self.assertAlmostEqual(new_points.last_run_by_user.get('b'), now - 5)
+        self.assertEqual(new_points.last_run_by_user.get('a'), 0)
+
+
+class TestCommandManagerRebuild(unittest2.TestCase):
+    def get_state(self, commands):
+        return {alias: (command, dict(command.action.commands) if command.action.type == 'multi' else None) for alias, command in commands.data.items()}
+
+    def assertRebuilt(self, commands):
+        """ Makes sure the incremental rebuild matches a full rebuild """
+        state = self.get_state(commands)
+        commands.rebuild()
+        self.assertEqual(state, self.get_state(commands))
+
+    def test_incremental_rebuild(self):
+        from pajbot.benchmark.fakes import init_sqlite_db
+        from pajbot.models.command import Command, CommandManager
+        import pajbot.models.user
+
+        class FakeModule:
+            def __init__(self, ID, commands):
+                self.ID = ID
+                self.commands = commands
+
+        class FakeModuleManager:
+            def __init__(self, modules):
+                self.modules = modules
+
+            def __getitem__(self, module_id):
+                for module in self.modules:
+                    if module.ID == module_id:
+                        return module
+                return None
+
+        def say(message, **options):
+            return Command(action={'type': 'say', 'message': message}, **options)
+
+        def multi(commands, **options):
+            return Command.multiaction_command(commands=commands, **options)
+
+        points = multi({'give': say('give'), 'check': say('check')}, command='points|p')
+        db_ping = say('pong', command='ping|pong')
+        disabled = say('disabled', command='ping2')
+        disabled.enabled = False
+        internal_points = multi({'check': say('internal check'), 'top': say('top')})
+        ping = say('internal ping')
+
+        module_points = multi({'give': say('module give')})
+        module = FakeModule('points', {'points': module_points, 'p': module_points, 'ping2': say('module ping2')})
+        other = FakeModule('other', {'pong': say('module pong'), 'p': say('override')})
+        module_manager = FakeModuleManager([module, other])
+
+        init_sqlite_db()
+        commands = CommandManager(module_manager=module_manager)
+        commands.internal_commands = {'points': internal_points, 'ping': ping}
+        for command in (points, db_ping, disabled):
+            commands.add_db_command_aliases(command)
+        commands.rebuild()
+
+        self.assertIs(commands['points'], internal_points)
+        self.assertIs(commands['points'].action.commands['give'], module_points.action.commands['give'])
+        self.assertIs(commands['points'].action.commands['check'], points.action.commands['check'])
+        self.assertIs(commands['p'], other.commands['p'])
+        self.assertIs(commands['ping'], db_ping)
+        self.assertIs(commands['ping2'], module.commands['ping2'])
+        self.assertEqual(commands.module_aliases, {'points': {'points', 'p', 'ping2'}, 'other': {'pong', 'p'}})
+
+        # Reload a module with a different set of commands
+        pong = commands['pong']
+        new_points = multi({'take': say('take')})
+        module.commands = {'points': new_points, 'tp': new_points}
+        commands.on_module_reload({'id': 'points'}, None)
+        self.assertIs(commands['tp'], new_points)
+        self.assertNotIn('ping2', commands)
+        self.assertIs(commands['points'].action.commands['give'], points.action.commands['give'])
+        self.assertIn('take', commands['points'].action.commands)
+        self.assertIs(commands['pong'], pong)
+        self.assertRebuilt(commands)
+
+        # Disable a module
+        module_manager.modules.remove(other)
+        commands.on_module_reload({'id': 'other', 'new_state': False}, None)
+        self.assertIs(commands['pong'], db_ping)
+        self.assertIs(commands['p'], points)
+        self.assertEqual(set(commands['p'].action.commands), {'give', 'check'})
+        self.assertRebuilt(commands)
+
+        # Remove a db command
+        commands.remove_command_aliases(points)
+        commands.rebuild(['points', 'p'])
+        self.assertNotIn('p', commands)
+        self.assertIs(commands['points'], internal_points)
+        self.assertEqual(set(commands['points'].action.commands), {'check', 'top', 'take'})
+        self.assertRebuilt(commands)
+
+        # Enable a module again
+        module_manager.modules.append(other)
+        commands.on_module_reload({'id': 'other', 'new_state': True}, None)
+        self.assertIs(commands['p'], other.commands['p'])
+        self.assertEqual(commands.module_aliases['other'], {'pong', 'p'})
+        self.assertRebuilt(commands)
+
+
+class TestConnectionManager(unittest2.TestCase):
+    def get_connection_manager(self, num_conns, message_limit=3):
+        from pajbot.models.connection import Connection, ConnectionManager
+        from irc.client import MessageTooLong, ServerNotConnectedError
+        import types
+
+        class FakeServerConnection:
+            def __init__(self):
+                self.connected = True
+                self.sent = []
+
+            def is_connected(self):
+                return self.connected
+
+            def privmsg(self, channel, message):
+                if not self.connected:
+                    raise ServerNotConnectedError('Not connected.')
+                if len(message) > 20:
+                    raise MessageTooLong('Messages limited to 20 characters')
+                self.sent.append(message)
+
+        def execute_delayed(delay, function, arguments=()):
+            # The reactor's mutex is held while it runs handlers, so this must never be called with the queue locked
+            self.assertFalse(connection_manager.queue_lock.locked())
+            reactor.delayed.append((delay, function))
+
+        reactor = types.SimpleNamespace(delayed=[], execute_delayed=execute_delayed)
+
+        connection_manager = ConnectionManager(reactor, None, message_limit, 'pajlada', time_interval=30)
+        connection_manager.run_maintenance = lambda: None
+        connection_manager.connlist = [Connection(FakeServerConnection(), 30) for i in range(num_conns)]
+        return connection_manager
+
+    def test_send_in_order(self):
+        connection_manager = self.get_connection_manager(1)
+        conn = connection_manager.connlist[0]
+
+        for i in range(5):
+            connection_manager.privmsg('#pajlada', str(i))
+        self.assertEqual(conn.conn.sent, ['0', '1', '2'])
+        self.assertEqual(connection_manager.get_stats()['queue_depth'], 2)
+
+        # Only one flush is scheduled, for when the oldest message leaves the window
+        self.assertEqual(len(connection_manager.reactor.delayed), 1)
+        delay, flush = connection_manager.reactor.delayed[0]
+        self.assertAlmostEqual(delay, 30, delta=1)
+
+        # Messages that don't count towards the limit don't wait behind the rate limited ones
+        connection_manager.privmsg('#pajlada', 'mod', increase_message=False)
+        self.assertEqual(conn.conn.sent, ['0', '1', '2', 'mod'])
+        self.assertEqual(len(connection_manager.reactor.delayed), 1)
+        self.assertEqual(conn.num_msgs_sent, 3)
+
+        for i in range(2):
+            conn.sent_times[i] -= 30
+        flush()
+        self.assertEqual(conn.conn.sent, ['0', '1', '2', 'mod', '3', '4'])
+        self.assertEqual(len(connection_manager.reactor.delayed), 1)
+        self.assertEqual(conn.num_msgs_sent, 3)
+
+        stats = connection_manager.get_stats()
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertEqual(stats['max_queue_depth'], 3)
+        self.assertEqual(stats['num_sent'], 6)
+        self.assertGreaterEqual(stats['max_wait_time'], stats['avg_wait_time'])
+
+    def test_multiple_connections(self):
+        connection_manager = self.get_connection_manager(3)
+        first, second, third = connection_manager.connlist
+        third.conn.connected = False
+
+        for i in range(7):
+            connection_manager.privmsg('#pajlada', str(i))
+        self.assertEqual(first.conn.sent + second.conn.sent, [str(i) for i in range(6)])
+        self.assertEqual(len(first.conn.sent), 3)
+        self.assertEqual(third.conn.sent, [])
+        self.assertEqual(first.num_msgs_sent, 3)
+
+        second.conn.connected = False
+        first.conn.connected = False
+        first.sent_times.clear()
+        connection_manager.reactor.delayed = []
+        connection_manager.run_scheduled_flush()
+        self.assertEqual(connection_manager.reactor.delayed[0][0], connection_manager.RETRY_DELAY)
+        self.assertEqual(connection_manager.get_stats()['queue_depth'], 1)
+
+    def test_send_errors(self):
+        connection_manager = self.get_connection_manager(1, message_limit=10)
+        conn = connection_manager.connlist[0]
+
+        for message in ('first', 'this message is way too long', 'second'):
+            connection_manager.privmsg('#pajlada', message)
+        self.assertEqual(conn.conn.sent, ['first', 'second'])
+        self.assertEqual(connection_manager.get_stats()['num_sent'], 2)
+        self.assertEqual(connection_manager.reactor.delayed, [])
+
+        # A connection that drops while sending keeps the message at the front of the queue
+        connection_manager.get_send_connection = lambda increase_message, now: (conn, 0)
+        conn.conn.connected = False
+        self.assertFalse(connection_manager.privmsg('#pajlada', 'third'))
+        connection_manager.privmsg('#pajlada', 'fourth')
+        self.assertEqual(len(connection_manager.reactor.delayed), 1)
+        self.assertEqual(connection_manager.reactor.delayed[0][0], connection_manager.RETRY_DELAY)
+
+        # Moderation messages queued while disconnected are sent first, in order
+        connection_manager.privmsg('#pajlada', 'ban', increase_message=False)
+        connection_manager.privmsg('#pajlada', 'unban', increase_message=False)
+        self.assertEqual(len(connection_manager.reactor.delayed), 1)
+
+        conn.conn.connected = True
+        connection_manager.reactor.delayed[0][1]()
+        self.assertEqual(conn.conn.sent, ['first', 'second', 'ban', 'unban', 'third', 'fourth'])
+        self.assertEqual(connection_manager.get_stats()['queue_depth'], 0)
+
+
+class TestCustomEmotes(unittest2.TestCase):
+    def test_match_custom_emotes(self):
+        from pajbot.benchmark import BenchmarkBot, create_benchmark_config, seed_benchmark_data
+
+        seed = seed_benchmark_data()
+        bot = BenchmarkBot(create_benchmark_config(), modules=[], seed_data=seed)
+        for code in ['FeelsBadMan', 'FeelsGoodMan', '(puke)', ':tf:', 'D:', '( ͡° ͜ʖ ͡°)']:
+            bot.emotes.add_emote(code=code, emote_hash='abc')
+        bot.emotes.add_emote(code='D:', emote_hash='def')
+        bot.emotes.rebuild_custom_index()
+
+        messages = ['', 'FeelsBadMan', ' FeelsBadMan  FeelsBadMan', 'FeelsBadManFeelsBadMan', 'D: xD: D:D D:',
+                ':tf: (puke) FeelsGoodMan :tf:', 'lol ( ͡° ͜ʖ ͡°) ( ͡° ͜ʖ ͡°)', 'FeelsBadMan\tD:']
+        for message in messages:
+            expected = []
+            for emote in bot.emotes.custom_data:
+                spans = [(match.start(), match.end() - 1) for match in emote.regex.finditer(message)]
+                if len(spans) > 0:
+                    expected.append((emote, spans))
+            self.assertEqual(bot.emotes.match_custom_emotes(message), expected, 'Wrong emotes for "{}"'.format(message))
+
+
+class TestSlidingWindowCounter(unittest2.TestCase):
+    def test_counter(self):
+        from pajbot.tbutil import SlidingWindowCounter
+
+        counter = SlidingWindowCounter(window=60, num_buckets=60)
+        self.assertEqual(counter.add(5, now=1000.0), 5)
+        self.assertEqual(counter.add(3, now=1000.9), 8)
+        self.assertEqual(counter.add(2, now=1030.5), 10)
+        self.assertEqual(counter.get(now=1059.9), 10)
+        self.assertEqual(counter.get(now=1060.0), 2)
+        self.assertEqual(counter.get(now=1089.9), 2)
+        self.assertEqual(counter.get(now=1090.0), 0)
+        self.assertEqual(counter.add(1, now=5000.0), 1)
+        self.assertEqual(counter.get(now=5000.0), 1)
+
+    def test_emote_stats(self):
+        from pajbot.models.emote import EmoteStats
+
+        stats = EmoteStats('Kappa')
+        stats.add(3)
+        stats.add(4)
+        self.assertEqual(stats.count, 7)
+        self.assertEqual(stats.tm, 7)
+        self.assertEqual(stats.tm_record, 7)
+        self.assertIsNotNone(stats.tm_record_date)
+
+
+class TestEmoteManager(unittest2.TestCase):
+    def test_preload_stats(self):
+        from types import SimpleNamespace
+        from sqlalchemy import event
+        from pajbot.benchmark.fakes import init_sqlite_db
+        from pajbot.models.db import DBManager
+        from pajbot.models.emote import Emote, EmoteManager, EmoteStats
+
+        init_sqlite_db()
+        with DBManager.create_session_scope() as db_session:
+            kappa = Emote(None, emote_id=25, code='Kappa')
+            kappa.stats = EmoteStats('Kappa')
+            kappa.stats.count = 10
+            db_session.add(kappa)
+            db_session.add(Emote(None, emote_id=88, code='PogChamp'))
+            db_session.add(Emote(None, emote_hash='abc', code='FeelsBadMan'))
+
+        bot = SimpleNamespace(
+                streamer='pajlada',
+                action_queue=SimpleNamespace(add=None),
+                execute_delayed=lambda *args: None,
+                execute_every=lambda *args: None)
+        emotes = EmoteManager(bot)
+
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(DBManager.engine, 'before_cursor_execute', listener)
+        try:
+            emotes.reload()
+            # One query for the stats, one for the emotes
+            self.assertEqual(len(statements), 2)
+
+            emotes[25].add(1)
+            emotes[88].add(2)
+            emotes.data['custom_FeelsBadMan'].add(3)
+            emotes[88].add(2)
+            self.assertEqual(len(statements), 2)
+            self.assertEqual(emotes[25].count, 11)
+            self.assertEqual(emotes[88].count, 4)
+
+            emotes.commit()
+        finally:
+            event.remove(DBManager.engine, 'before_cursor_execute', listener)
+
+        with DBManager.create_session_scope() as db_session:
+            counts = {stats.emote_code: stats.count for stats in db_session.query(EmoteStats)}
+        self.assertEqual(counts, {'Kappa': 11, 'PogChamp': 4, 'FeelsBadMan': 3})
+
+
+class TestChatReplay(unittest2.TestCase):
+    def test_parse_chat_line(self):
+        from pajbot.benchmark import parse_chat_line
+
+        event = parse_chat_line('@color=;display-name=PajladA;emotes=25:0-4;subscriber=1;user-type=mod :pajlada!pajlada@pajlada.tmi.twitch.tv PRIVMSG #forsenlol :Kappa 123\r\n')
+        self.assertEqual(event.type, 'pubmsg')
+        self.assertEqual(event.source.user, 'pajlada')
+        self.assertEqual(event.target, '#forsenlol')
+        self.assertEqual(event.arguments, ['Kappa 123'])
+        self.assertIn({'key': 'emotes', 'value': '25:0-4'}, event.tags)
+        self.assertIn({'key': 'user-type', 'value': 'mod'}, event.tags)
+
+        event = parse_chat_line(':pajlada!pajlada@pajlada.tmi.twitch.tv PRIVMSG #forsenlol :\x01ACTION waves\x01')
+        self.assertEqual(event.type, 'action')
+        self.assertEqual(event.arguments, ['waves'])
+
+        self.assertIsNone(parse_chat_line(':tmi.twitch.tv PING'))
+        self.assertIsNone(parse_chat_line(''))
+
+    def test_replay(self):
+        from pajbot.benchmark import BenchmarkBot, create_benchmark_config, generate_chat_log, parse_chat_line, seed_benchmark_data
+        from pajbot.benchmark.replay import DEFAULT_TWITCH_EMOTES
+
+        seed = seed_benchmark_data(num_banphrases=20, num_custom_emotes=5, num_commands=5, twitch_emotes=DEFAULT_TWITCH_EMOTES)
+        bot = BenchmarkBot(create_benchmark_config(streamer='pajlada'), modules=['banphrase', 'linefarming', 'warning'], seed_data=seed)
+        lines = generate_chat_log(200, 'pajlada', twitch_emotes=DEFAULT_TWITCH_EMOTES, num_users=50)
+        result = bot.replay([parse_chat_line(line) for line in lines], warmup=20)
+
+        self.assertEqual(result.num_messages, 180)
+        self.assertEqual(result.sections.calls['on_message BanphraseModule.on_message'], 180)
+        self.assertEqual(result.sections.calls['on_pubmsg LineFarmingModule.on_pubmsg'], 180)
+        self.assertGreater(bot.emotes['Kappa'].count, 0)
+
+
+class TestResponseTemplate(unittest2.TestCase):
+    def test_corpus(self):
+        """ The responses of typical command actions must be the same as before responses were compiled """
+        import datetime
+        from types import SimpleNamespace
+        from pajbot.bot import Bot
+        from pajbot.models.action import SayAction, MessageAction, IfSubstitution
+
+        class KVI:
+            def __init__(self, data):
+                self.data = data
+
+            def __getitem__(self, key):
+                return self.data[key]
+
+        class CorpusBot:
+            get_source_value = Bot.get_source_value
+            get_user_value = Bot.get_user_value
+            get_usersource_value = Bot.get_usersource_value
+            get_args_value = Bot.get_args_value
+            get_kvi_value = Bot.get_kvi_value
+            get_value = Bot.get_value
+            get_filter = Bot.get_filter
+            apply_filter = Bot.apply_filter
+
+            def __init__(self):
+                users = {
+                    'pajlada': SimpleNamespace(username='pajlada', username_raw='PajladA', points=1234567, num_lines=420),
+                    'forsen': SimpleNamespace(username='forsen', username_raw='Forsen', points=5000, num_lines=9001),
+                    }
+                self.users = SimpleNamespace(find=lambda username: users.get((username or '').lower(), None))
+                self.kvi = KVI({'active_subs': SimpleNamespace(get=lambda: 1337)})
+                self.data = {'broadcaster': 'pajlada'}
+                self.data_cb = {'current_time': lambda: '13:37'}
+                self.decks = SimpleNamespace(action_get_curdeck=lambda key, extra={}: 'Zoo Hunter')
+                self.stream_manager = SimpleNamespace(
+                        get_current_stream_value=lambda key, extra={}: 'online',
+                        get_last_stream_value=lambda key, extra={}: 'offline')
+
+            def get_last_tweet(self, key, extra={}):
+                return 'tweet by {0}'.format(key)
+
+            def get_emote_tm(self, key, extra={}):
+                return 5 if key == 'Kappa' else None
+
+            def get_emote_count(self, key, extra={}):
+                return 1234567 if key == 'Kappa' else None
+
+            def get_emote_tm_record(self, key, extra={}):
+                return 42
+
+            def get_time_value(self, key, extra={}):
+                return '12:00'
+
+            def get_current_song_value(self, key, extra={}):
+                return 'Darude - Sandstorm'
+
+            def get_notify_value(self, key, extra={}):
+                return ''
+
+        # The previous implementation, which replaced one needle at a time
+        def apply_substitutions(text, substitutions, bot, extra):
+            for needle, sub in substitutions.items():
+                if sub.key and sub.argument:
+                    param = sub.key
+                    extra['argument'] = MessageAction.get_argument_value(extra['message'], sub.argument - 1)
+                elif sub.key:
+                    param = sub.key
+                elif sub.argument:
+                    param = MessageAction.get_argument_value(extra['message'], sub.argument - 1)
+                else:
+                    continue
+                if isinstance(sub.cb, IfSubstitution):
+                    value = if_substitution(sub.cb, extra)
+                else:
+                    value = sub.cb(param, extra)
+                try:
+                    if sub.filter is not None:
+                        value = bot.apply_filter(value, sub.filter)
+                except:
+                    pass
+                if value is None:
+                    return None
+                text = text.replace(needle, str(value))
+
+            return text
+
+        def if_substitution(if_sub, extra):
+            if if_sub.sub.key is None:
+                condition = MessageAction.get_argument_value(extra.get('message', ''), if_sub.sub.argument - 1)
+            else:
+                condition = if_sub.sub.cb(if_sub.sub.key, extra)
+            if condition:
+                return apply_substitutions(if_sub.true_response, if_sub.true_subs, if_sub.bot, extra)
+            return apply_substitutions(if_sub.false_response, if_sub.false_subs, if_sub.bot, extra)
+
+        def get_response(action, bot, extra):
+            resp = apply_substitutions(action.response, action.subs, bot, extra)
+            if resp is None:
+                return None
+
+            for sub in action.argument_subs:
+                resp = resp.replace(sub.needle, str(MessageAction.get_argument_value(extra['message'], sub.argument - 1)))
+
+            return resp
+
+        responses = [
+            'hi',
+            'costs $5, $(1) $',
+            '$(source:username_raw) has $(source:points) points',
+            '$(source:username_raw), you have $(source:points|number_format) points and $(source:num_lines) lines',
+            '$(user;1:username_raw) has $(user;1:points|number_format) points',
+            '$(usersource;1:username_raw) has $(usersource;1:points) points',
+            '$(1) $(2) $(1) $(3)',
+            '$(0) $(1)',
+            '$(1)$(1)$(2)',
+            '$$(1)',
+            '$(source:$(1))',
+            'Kappa $(args:1) Keepo',
+            '$(source:username|upper) $(source:username_raw|lower) $(source:last_seen|strftime(%H:%M:%S))',
+            '$(if:$(1),"Hello $(1)","Hello nobody")',
+            'BEFORE $(if:$(1),"YES","NO") AFTER',
+            'BEFORE $(if:$(1),"YES","NO") AFTER $(1)',
+            '$(if:$(source:points),"$(source:username_raw) is rich","$(source:username_raw) is poor") $(source:points)',
+            '$(if:$(1),"$(source:username_raw) says $(1) $(2)","$(source:username_raw) says nothing")',
+            '$(tb:broadcaster) at $(tb:current_time)',
+            '$(kvi:active_subs) subs, $(ecount:Kappa|number_format) Kappas, $(etm:Kappa) in the last minute',
+            '$(source:username) $(source:username) $(1) $(source:username)',
+            '$(args) lol',
+            '$(user;1:username_raw|join) $(args:0|join(-))',
+            '$(notify:x)Poggers $(curdeck:name) $(current_song:title)',
+            'Wow $(time:Europe/Stockholm) $(lasttweet:forsen) $(etmrecord:Kappa)',
+            '$(etm:NotAnEmote) nope',
+            '$(args:2) $(args:1) $(args:0) $(args:9)',
+            '$(usersource;2:points|number_format) $(user;1:num_lines)',
+            ]
+
+        messages = [
+            None,
+            '',
+            'forsen',
+            'nobody',
+            'FORSEN xd',
+            'a b',
+            'a b c',
+            'hi there',
+            'pajlada forsen',
+            'forsen a b',
+            # Values that contain needles themselves
+            '$(2) b',
+            '$(source:points) $(1)',
+            '(2) x',
+            'x$ (1)',
+            'username_raw) $(2)',
+            ]
+
+        bot = CorpusBot()
+        source = SimpleNamespace(username='pajlada', username_raw='PajladA', points=1234567, num_lines=420,
+                                 last_seen=datetime.datetime(2016, 5, 1, 17, 1, 42))
+        for response in responses:
+            action = SayAction(response, bot)
+            for message in messages:
+                extra = {'source': source, 'user': 'pajlada', 'message': message}
+                expected_extra = dict(extra)
+                expected = get_response(action, bot, expected_extra)
+                self.assertEqual(action.get_response(bot, extra), expected, 'Wrong response for "{0}" with message "{1}"'.format(response, message))
+                self.assertEqual(extra, expected_extra)
+
+
+class TestActionParser(unittest2.TestCase):
+    def tearDown(self):
+        from pajbot.models.action import ActionParser
+
+        ActionParser.bot = None
+
+    def test_parse_cache(self):
+        from pajbot.models.action import ActionParser
+        from pajbot.dispatch import Dispatch
+
+        ActionParser.bot = None
+        say = ActionParser.parse('{"type": "say", "message": "Hello $(1)"}')
+        self.assertIs(ActionParser.parse('{"type": "say", "message": "Hello $(1)"}'), say)
+        self.assertIsNot(ActionParser.parse('{"type": "me", "message": "Hello $(1)"}'), say)
+
+        func = ActionParser.parse('{"type": "func", "cb": "ban_source"}')
+        self.assertEqual(func.cb, Dispatch.ban_source)
+        self.assertIs(ActionParser.parse('{"type": "func", "cb": "ban_source"}'), func)
+        self.assertIsNone(ActionParser.parse('{"type": "func", "cb": "this_does_not_exist"}'))
+
+        # Multi actions keep their own commands, so they're never shared
+        multi = '{"type": "multi", "args": [], "default": null}'
+        self.assertIsNot(ActionParser.parse(multi), ActionParser.parse(multi))
+
+        # Message actions are compiled for a specific bot
+        ActionParser.bot = object()
+        self.assertIsNot(ActionParser.parse('{"type": "say", "message": "Hello $(1)"}'), say)
+
 
 class ActionsTester(unittest2.TestCase):
     def setUp(self):